@@ -13,7 +13,7 @@
 # limitations under the License.
 import logging
 
-from flask import Flask, request, jsonify, render_template, json
+from flask import Flask, request, render_template
 from flask_cors import CORS
 from flask_talisman import Talisman
 from werkzeug.exceptions import HTTPException
@@ -22,16 +22,83 @@ from werkzeug.wrappers import Response
 from app.routes.server_initiated import serverInitiated
 from app.routes.client_initiated import clientInitiated
 from app.routes.users import users
+from app.routes.status import status as status_blueprint
+from app.routes.diagnostics import diagnostics
+from app.utils import static_files
+from app.utils.carrier_guard import init_carrier_guard
+from app.utils.carrier_token_store import init_carrier_token_store
+from app.utils.compression import init_compression
+from app.utils.create_jwt import init_jwt_claim_profile
+from app.utils.discovery_failure_cache import init_discovery_failure_cache
+from app.utils.http_cassette import init_http_session
+from app.utils.id_token_verifier import init_id_token_verifier
+from app.utils.json_provider import init_json_provider
+from app.utils.log_pipeline import init_log_pipeline
+from app.utils.memory_diagnostics import init_memory_diagnostics
+from app.utils.refresh_token_store import init_refresh_token_store
+from app.utils.replay_store import init_replay_store
+from app.utils.request_profiler import init_request_profiler
+from app.utils.response_format import encode_body, init_response_formats, respond
+from app.utils.static_files import init_static_files
+from app.utils.tracing import init_tracing
+from app.utils.zenkey_oidc_service import refresh_carrier_tokens
 
 logging.basicConfig(level=logging.DEBUG)
 
 # set up Flask
-application = Flask(__name__) # pylint: disable=invalid-name
+# the static files are served by init_static_files
+application = Flask(__name__, static_folder=None) # pylint: disable=invalid-name
 # use Talisman to add security headers
 Talisman(application, content_security_policy=None)
 
 # load configuration from config.py
 application.config.from_object('config')
+init_jwt_claim_profile(application)
+
+# write the logs from a background thread, with sampling, when configured
+init_log_pipeline(application)
+
+# use the fastest available JSON backend for responses and request bodies
+init_json_provider(application, application.config['JSON_BACKEND'])
+
+# encode the responses as JSON, or MessagePack or CBOR for the clients that ask for them
+init_response_formats(application)
+
+# compress the responses the client accepts compressed. Registered first so it runs after
+# every other after_request function
+init_compression(application)
+
+# serve the static files from memory, precompressed, with ETags and cache headers
+init_static_files(application)
+
+# one requests session for every request to ZenKey and the carriers, which can record them
+# to a cassette or replay them from one
+init_http_session(application)
+
+# verify id tokens with cached carrier keys, and remember the id tokens we have accepted
+# so they can't be replayed
+init_id_token_verifier(application)
+init_replay_store(application)
+
+# the refresh tokens we issue with the short-lived access tokens, stored as hashes
+init_refresh_token_store(application)
+
+# the carriers' refresh tokens, encrypted, to get fresh ZenKey user info without a redirect,
+# refreshed in the background ahead of their expiry, when configured
+init_carrier_token_store(application, refresh_carrier_tokens)
+
+# fail fast with a 503 when a carrier endpoint is degraded
+init_carrier_guard(application)
+init_discovery_failure_cache(application)
+
+# profile requests on demand and log the slow ones, when configured
+init_request_profiler(application)
+
+# trace the phases of each sign-in and propagate the trace to the carriers, when configured
+init_tracing(application)
+
+# memory snapshots for the admin diagnostics routes, and an optional RSS threshold
+init_memory_diagnostics(application)
 
 # we default to allowing all domains for simplicity
 CORS(application)
@@ -45,12 +112,18 @@ application.register_blueprint(serverInitiated)
 # add user routes
 application.register_blueprint(users)
 
+# add metrics routes
+application.register_blueprint(status_blueprint)
+
+# add admin diagnostics routes
+application.register_blueprint(diagnostics)
+
 # add error handler
 @application.errorhandler(Exception)
 def handle_exception(error):
     """Return JSON instead of HTML for HTTP errors."""
     if not isinstance(error, HTTPException):
-        application.logger.exception(('Unhandled Exception: %s', (error)), extra={'stack': True})
+        application.logger.exception('Unhandled Exception: %s', error)
 
     # create the response body
     data = {
@@ -62,12 +135,11 @@ def handle_exception(error):
     if hasattr(error, 'get_response'):
         # start with the correct headers and status code from the error
         response = error.get_response()
-        response.data = json.dumps(data)
-        response.mimetype = 'application/json'
+        response.data, response.mimetype = encode_body(data)
+        response.vary.add('Accept')
     else:
-        response = application.response_class(response=json.dumps(data),
-                                  status=getattr(error, 'code', 500),
-                                  mimetype='application/json')
+        response = respond(data)
+        response.status_code = getattr(error, 'code', 500)
     return response
 
 # add index route for status
@@ -76,7 +148,7 @@ def index_route():
     """status page"""
     status = "Service is UP and running"
     if request.is_json:
-        return jsonify({"status": status})
+        return respond({"status": status})
 
     return status
 
@@ -87,4 +159,4 @@ def swagger():
     """
     Swagger UI documentation
     """
-    return render_template('swagger.html')
+    return render_template('swagger.html', swagger_url=static_files.static_url('swagger.yml'))
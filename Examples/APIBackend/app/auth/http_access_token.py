@@ -6,6 +6,8 @@ import jwt
 from jwt.exceptions import InvalidTokenError
 from werkzeug.exceptions import Unauthorized
 
+from app.utils.create_jwt import jwt_user_attributes
+
 # TODO make logging global
 logging.basicConfig(level=logging.DEBUG)
 
@@ -21,7 +23,7 @@ def verify_access_token(access_token):
     try:
         # this method will throw an error if the access token has been tampered with
         decoded = jwt.decode(access_token, current_app.config['SECRET_KEY'], algorithms='HS256')
-        g.current_user = decoded
+        g.current_user = jwt_user_attributes(decoded)
         return True
     except InvalidTokenError as error:
         logging.exception(error)
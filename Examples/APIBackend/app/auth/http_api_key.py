@@ -35,3 +35,20 @@ def verify_api_key(api_key):
 def api_key_error_handler():
     '''handle unauthorized case in the HTTPAuth'''
     raise Unauthorized('Missing or invalid API key')
+
+# a separate set of keys for the diagnostics routes, which the API clients never get
+adminApiKeyAuth = HTTPAPIKeyAuth() # pylint: disable=invalid-name
+
+@adminApiKeyAuth.verify_token
+def verify_admin_api_key(api_key):
+    """
+    verify an admin API key in the X-API-Key header by checking it against the environment
+    """
+    if api_key in current_app.config['ADMIN_API_KEYS']:
+        return True
+    return False
+
+@adminApiKeyAuth.error_handler
+def admin_api_key_error_handler():
+    '''handle unauthorized case in the HTTPAuth'''
+    raise Unauthorized('Missing or invalid admin API key')
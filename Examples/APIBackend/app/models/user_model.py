@@ -1,58 +1,104 @@
-import pdb
+def claim_value(raw_zenkey_attributes, claim_name):
+    """
+    Read the value of a nested ZenKey claim like {"email": {"value": "..."}}
+    Different mobile carriers return different formats, so return None for anything unexpected
+    """
+    try:
+        return raw_zenkey_attributes.get(claim_name)['value']
+    except (AttributeError, KeyError, TypeError):
+        return None
 
-def gather_zenkey_values(raw_zenkey_attributes):
-    sub = raw_zenkey_attributes.get('sub', None)
-    if sub is None:
-        sub = raw_zenkey_attributes.get('zenkey_sub', None)
+class User():
+    """
+    A compact user record
 
-    try:
-        name = raw_zenkey_attributes['name']['value']
-    except(AttributeError, KeyError, TypeError):
-        name = None
-    try:
-        email = raw_zenkey_attributes['email']['value']
-    except(AttributeError, KeyError, TypeError):
-        email = None
-    try:
-        postal_code = raw_zenkey_attributes['postal_code']['value']
-    except(AttributeError, KeyError, TypeError):
-        postal_code = None
-    try:
-        phone_number = raw_zenkey_attributes['phone']['value']
-    except(AttributeError, KeyError, TypeError):
-        phone_number = None
-
-    return {
-        'zenkey_sub': sub,
-        'name': name,
-        'email': email,
-        'postal_code': postal_code,
-        'phone_number': phone_number,
-    }
+    Users are built several times per request on the sign-in path, so this uses __slots__
+    instead of a dictionary per user
+    """
+    __slots__ = ('user_id', 'username', 'zenkey_sub', 'name', 'email', 'postal_code',
+                 'phone_number')
+
+    # these attributes are embedded in the JWTs we issue with the full claim profile. The
+    # user_id identifies the user to the routes that only act on the user's own data
+    jwt_attributes = ('user_id', 'name', 'email', 'postal_code', 'phone_number', 'zenkey_sub')
+
+    def __init__(self, user_id=None, username=None, zenkey_sub=None, name=None, email=None,
+                 postal_code=None, phone_number=None):
+        self.user_id = user_id
+        self.username = username
+        self.zenkey_sub = zenkey_sub
+        self.name = name
+        self.email = email
+        self.postal_code = postal_code
+        self.phone_number = phone_number
+
+    @classmethod
+    def from_zenkey_attributes(cls, raw_zenkey_attributes, **kwargs):
+        """
+        Build a user from the attributes returned by the ZenKey userinfo endpoint
+        """
+        sub = raw_zenkey_attributes.get('sub')
+        if sub is None:
+            sub = raw_zenkey_attributes.get('zenkey_sub')
+
+        return cls(zenkey_sub=sub,
+                   name=claim_value(raw_zenkey_attributes, 'name'),
+                   email=claim_value(raw_zenkey_attributes, 'email'),
+                   postal_code=claim_value(raw_zenkey_attributes, 'postal_code'),
+                   phone_number=claim_value(raw_zenkey_attributes, 'phone'),
+                   **kwargs)
+
+    @classmethod
+    def from_attributes(cls, user_attributes, **kwargs):
+        """
+        Build a user from flat attributes, like registration form params or a decoded JWT
+        """
+        return cls(zenkey_sub=user_attributes.get('zenkey_sub'),
+                   name=user_attributes.get('name'),
+                   email=user_attributes.get('email'),
+                   postal_code=user_attributes.get('postal_code'),
+                   phone_number=user_attributes.get('phone_number'),
+                   **kwargs)
+
+    def jwt_claims(self, attributes=jwt_attributes):
+        """
+        The user attributes to embed in a JWT
+        """
+        return {attribute: getattr(self, attribute) for attribute in attributes}
+
+    def to_dict(self):
+        """
+        The user attributes to return in a JSON response
+        """
+        return {attribute: getattr(self, attribute) for attribute in self.__slots__}
 
 class UserModel():
     """
     This example class is used to interact with users stored in a fake database
     """
     @classmethod
-    def find_zenkey_user(cls, raw_zenkey_attributes):
+    def find_zenkey_user(cls, raw_zenkey_attributes, deadline=None):
         """
         Look up a ZenKey user in the database based on the "sub" attribute.
         If no users with a matching "sub" exist in our database, return None
 
+        When a Deadline is given, the lookup must finish before it
+
         This method is nonfunctional because this example app does not have a database.
         For demonstration purposes we've built it to always return a fake user built
         from the ZenKey attributes
         """
+        if deadline is not None:
+            deadline.check('the user lookup')
+
         # production code would be something like this:
-        # return db.find('users', 'zenkey_sub', zenkey_attributes.get('sub'))
+        # return db.find('users', 'zenkey_sub', zenkey_attributes.get('sub'),
+        #                timeout=deadline.remaining())
 
         # our fake user based on what we received from ZenKey:
-        return {
-            'user_id': 123,
-            'username': 'Fake Username',
-            **gather_zenkey_values(raw_zenkey_attributes)
-        }
+        return User.from_zenkey_attributes(raw_zenkey_attributes,
+                                           user_id=123,
+                                           username='Fake Username')
 
     @classmethod
     def find_user(cls, user_attributes):
@@ -65,17 +111,11 @@ class UserModel():
         """
         # production code would be something like this:
         # return db.find_by('users', attributes)
+        # with the minimal JWT claim profile the attributes are only the user's IDs, and the
+        # rest of the profile comes from the database
 
          # our fake user based on the attributes passed to this method
-        return {
-            'user_id': 123,
-            'username': 'Fake Username',
-            'zenkey_sub': user_attributes.get('zenkey_sub'),
-            'name': user_attributes.get('name'),
-            'email': user_attributes.get('email'),
-            'postal_code': user_attributes.get('postal_code'),
-            'phone_number': user_attributes.get('phone_number'),
-        }
+        return User.from_attributes(user_attributes, user_id=123, username='Fake Username')
 
     @classmethod
     def create_new_user(cls, user_attributes):
@@ -93,12 +133,4 @@ class UserModel():
         # return db.create('users', attributes)
 
          # our fake user based on the attributes passed to this method
-        return {
-            'user_id': 123,
-            'username': 'Fake Username',
-            'zenkey_sub': user_attributes.get('zenkey_sub'),
-            'name': user_attributes.get('name'),
-            'email': user_attributes.get('email'),
-            'postal_code': user_attributes.get('postal_code'),
-            'phone_number': user_attributes.get('phone_number'),
-        }
+        return User.from_attributes(user_attributes, user_id=123, username='Fake Username')
@@ -1,17 +1,36 @@
-from flask import Blueprint, current_app, request, jsonify
+from flask import Blueprint, current_app, g, request
 from werkzeug.exceptions import BadRequest
 
 from app.auth.http_api_key import apiKeyAuth
 from app.auth.http_access_token import accessTokenAuth
-from app.models.user_model import UserModel
+from app.models.user_model import User, UserModel
 from app.utils.create_jwt import create_jwt
+from app.utils.deadline import request_deadline
+from app.utils.refresh_token_store import (issue_refresh_token, revoke_refresh_token,
+                                           rotate_refresh_token)
+from app.utils.request_schema import ParamGroup, RequestSchema
+from app.utils.response_format import respond
+from app.utils.signin_replay_cache import signin_cache_key, signin_replay_cache
+from app.utils.tracing import set_correlation_id, span
 from app.utils.validate_client_credentials import validate_client_credentials
-from app.utils.validate_params import validate_params
-from app.utils.zenkey_oidc_service import zenkey_oidc_service
+from app.utils.zenkey_oidc_service import save_carrier_tokens, zenkey_oidc_service
 # from app.zenkey_oidc_service import ZenKeyOIDCService
 
 clientInitiated = Blueprint('clientAuth', __name__) # pylint: disable=invalid-name
 
+# the sign-in parameters, validated in one pass
+SIGNIN_SCHEMA = RequestSchema(
+    # required by zenkey oidc service
+    ParamGroup(required=['client_id', 'code', 'redirect_uri', 'mccmnc']),
+    # passed in the openid token request
+    ParamGroup(optional=['correlation_id', 'code_verifier', 'sdk_version']),
+    # used to validate the id_token in the oidc response
+    ParamGroup(optional=['acr_values', 'context', 'nonce']))
+
+REFRESH_TOKEN_SCHEMA = RequestSchema(ParamGroup(required=['grant_type', 'refresh_token']))
+
+DELETE_SESSION_SCHEMA = RequestSchema(ParamGroup(optional=['refresh_token']))
+
 def parse_signin_request():
     """
     Passes request params to pass to the zenkey_oidc_service to get the user info
@@ -19,13 +38,11 @@ def parse_signin_request():
     This method has access to the request scope because it's called from the
     zenkey-signin route
     """
-    # these parameters are required by zenkey oidc service
-    required_params = validate_params(request, [
-        'client_id',
-        'code',
-        'redirect_uri',
-        'mccmnc'
-    ])
+    (
+        required_params,
+        optional_token_request_params,
+        id_token_validator_params
+    ) = SIGNIN_SCHEMA.validate(request)
 
     # validate client credentials and get the client secret
     _, client_secret = validate_client_credentials(
@@ -40,20 +57,6 @@ def parse_signin_request():
         current_app.config['OIDC_PROVIDER_CONFIG_ENDPOINT']
     )
 
-    # these optional parameters are passed in the openid token request
-    optional_token_request_params = validate_params(request, optional_params=[
-        'correlation_id',
-        'code_verifier',
-        'sdk_version'
-    ])
-
-    # these optoinal parameters are used to validate the id_token in the oidc response
-    id_token_validator_params = validate_params(request, optional_params=[
-        'acr_values',
-        'context',
-        'nonce'
-    ])
-
     return (required_params, optional_token_request_params, id_token_validator_params)
 
 @clientInitiated.route('/auth/zenkey-signin', methods=['POST'])
@@ -77,13 +80,49 @@ def token_route():
         id_token_validator_params
     ) = parse_signin_request()
 
-    zenkey_user_info = zenkey_oidc_service(
+    # tag the trace with the client's correlation ID
+    set_correlation_id(optional_token_request_params.get('correlation_id'))
+
+    # every request made during the sign-in shares one time budget
+    deadline = request_deadline(request)
+
+    def signin():
+        return zenkey_signin(required_params,
+                             optional_token_request_params,
+                             id_token_validator_params,
+                             deadline)
+
+    code_verifier = optional_token_request_params.get('code_verifier')
+    if code_verifier:
+        # a client that retries after a timeout gets the response to its first attempt:
+        # the auth code has already been used, so the retry can't be sent to the carrier again
+        cache_key = signin_cache_key(required_params['client_id'],
+                                     required_params['code'],
+                                     code_verifier)
+        response_body, status_code = signin_replay_cache.get_or_create(
+            cache_key, signin, current_app.config['SIGNIN_REPLAY_CACHE_TTL'],
+            timeout=deadline.remaining())
+    else:
+        response_body, status_code = signin()
+
+    return respond(response_body), status_code
+
+def zenkey_signin(required_params, optional_token_request_params, id_token_validator_params,
+                  deadline):
+    """
+    Get the user's ZenKey info, look up the user and create a JWT
+
+    Returns the response body and status code for the zenkey-signin route
+    """
+    zenkey_user_info, carrier_tokens = zenkey_oidc_service(
         required_params,
         optional_token_request_params,
-        id_token_validator_params
+        id_token_validator_params,
+        deadline
     )
 
-    existing_user = UserModel.find_zenkey_user(zenkey_user_info)
+    with span('user_lookup'):
+        existing_user = UserModel.find_zenkey_user(zenkey_user_info, deadline)
 
     if existing_user is None:
         # This user doesn't have an account in our database yet.
@@ -111,48 +150,69 @@ def token_route():
         # with their new "sub" value
         # As of March 2020 this feature has not yet been released
 
-        return jsonify({
+        return {
             'zenkey_attributes': zenkey_user_info.to_dict(),
             'error': 'ZenKey user does not exist',
             'error_description': 'Unable to find a user with a matching "zenkey_sub" value'
-        }), 403
-
-    jwt_token = create_jwt(existing_user,
-                           current_app.config['TOKEN_EXPIRATION_TIME'],
-                           current_app.config['BASE_URL'],
-                           current_app.config['SECRET_KEY'])
-
-    # we omit the refresh token for brevity in this example codebase
-    # in production the API client should be able to optain a new token after this token expires
-
-    return jsonify({
+        }, 403
+
+    # keep the carrier's tokens, to get fresh user info later without another redirect.
+    # They're saved under our own user ID: a user registered through /users could claim
+    # any ZenKey sub
+    save_carrier_tokens(existing_user.user_id, carrier_tokens.id_token['sub'],
+                        required_params['client_id'], required_params['mccmnc'],
+                        carrier_tokens)
+
+    with span('create_jwt'):
+        jwt_token = create_jwt(existing_user,
+                               current_app.config['TOKEN_EXPIRATION_TIME'],
+                               current_app.config['BASE_URL'],
+                               current_app.config['SECRET_KEY'],
+                               current_app.config['JWT_CLAIM_PROFILE'],
+                               current_app.config['JWT_SHORT_CLAIMS'])
+
+    # the API client uses the refresh token to get a new token after this token expires
+    refresh_token = issue_refresh_token(existing_user,
+                                        current_app.config['REFRESH_TOKEN_EXPIRATION_TIME'])
+
+    return {
         'token': jwt_token,
-        'refresh_token': 'omitted',
+        'refresh_token': refresh_token,
         'token_type': 'bearer',
         'expires': current_app.config['TOKEN_EXPIRATION_TIME'].total_seconds()
-    })
+    }, 200
 
 @clientInitiated.route('/auth/token', methods=['POST'])
 @apiKeyAuth.login_required
 def refresh_token_route():
     """
     Use a refresh token to create a new token
+
+    Each refresh token can be used once: the response has a new refresh token. A refresh
+    token that is used twice revokes every refresh token of the session, since it was
+    probably stolen
     """
-    required_params = ['grant_type', 'refresh_token']
-    validated_params = validate_params(request, required_params)
+    validated_params, = REFRESH_TOKEN_SCHEMA.validate(request)
 
-    # refresh token functionality has been omitted for brevity in this example codebase
-    # here you would deactive the user's current token and generate a new one for the user
     if validated_params['grant_type'] != 'refresh_token':
         raise BadRequest('Only "refresh_token" grant types are accepted')
 
-    # here you would also validated the refresh token before issuing a new token
+    rotated = rotate_refresh_token(validated_params['refresh_token'],
+                                   current_app.config['REFRESH_TOKEN_EXPIRATION_TIME'])
+    if rotated is None:
+        raise BadRequest('The refresh token is invalid, expired or revoked')
+    refresh_token, user_attributes = rotated
+
+    jwt_token = create_jwt(User(**user_attributes),
+                           current_app.config['TOKEN_EXPIRATION_TIME'],
+                           current_app.config['BASE_URL'],
+                           current_app.config['SECRET_KEY'],
+                           current_app.config['JWT_CLAIM_PROFILE'],
+                           current_app.config['JWT_SHORT_CLAIMS'])
 
-    return jsonify({
-        # for brevity we just respond with a fake, unusable token
-        'token': 'new_fake_token',
-        # we omit the refresh token for brevity in this example
-        'refresh_token': 'new_fake_refresh_token',
+    return respond({
+        'token': jwt_token,
+        'refresh_token': refresh_token,
         'token_type': 'bearer',
         'expires': current_app.config['TOKEN_EXPIRATION_TIME'].total_seconds()
     })
@@ -163,8 +223,15 @@ def refresh_token_route():
 def delete_session_route():
     """
     Delete a session
+
+    Revokes the session's refresh tokens when the request includes one of the current
+    user's refresh tokens
     """
-    # this functionality has been omitted for brevity in this example codebase
-    # here you would deactivate the token and any refresh tokens. If using JWTs, you might add
-    # this user's JWT to a blacklist
+    validated_params, = DELETE_SESSION_SCHEMA.validate(request)
+    if 'refresh_token' in validated_params:
+        # someone else's refresh token is ignored like an unknown one, so the response
+        # doesn't tell whether the token is valid
+        revoke_refresh_token(validated_params['refresh_token'], g.current_user.get('user_id'))
+    # the access token expires on its own shortly. If you need to end the session right
+    # away, you might add this user's JWT to a blacklist until it expires
     return ""
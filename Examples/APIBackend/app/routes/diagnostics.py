@@ -0,0 +1,88 @@
+from flask import Blueprint, request
+from werkzeug.exceptions import BadRequest, NotFound
+
+from app.auth.http_api_key import adminApiKeyAuth
+from app.utils import memory_diagnostics
+from app.utils.response_format import respond
+
+diagnostics = Blueprint('diagnostics', __name__) # pylint: disable=invalid-name
+
+def get_snapshot_params():
+    """parse the group_by and limit query parameters"""
+    group_by = request.args.get('group_by', 'lineno')
+    if group_by not in memory_diagnostics.GROUP_BY:
+        raise BadRequest('group_by must be one of %s' % ', '.join(memory_diagnostics.GROUP_BY))
+    try:
+        limit = int(request.args.get('limit', '20'))
+    except ValueError:
+        raise BadRequest('limit must be a number')
+    return group_by, limit
+
+@diagnostics.route('/admin/memory', methods=['GET'])
+@adminApiKeyAuth.login_required
+def memory_route():
+    """
+    Report this worker's memory, its tracemalloc snapshots and, with ?objects=true, the
+    number of live Pyoidc, pyjwkest and requests objects
+
+    Each worker process has its own memory and snapshots
+    """
+    report = memory_diagnostics.memory_diagnostics.stats()
+    if request.args.get('objects', 'false').lower() == 'true':
+        report['live_objects'] = memory_diagnostics.live_object_counts()
+    return respond(report)
+
+@diagnostics.route('/admin/memory/snapshots', methods=['POST'])
+@adminApiKeyAuth.login_required
+def take_snapshot_route():
+    """
+    Take a tracemalloc snapshot and return its top allocation sites
+
+    Tracing starts with the first snapshot, so that snapshot is nearly empty: take another
+    one later and compare them
+    """
+    group_by, limit = get_snapshot_params()
+    diagnostics_state = memory_diagnostics.memory_diagnostics
+    info = diagnostics_state.take_snapshot()
+    return respond(dict(info,
+                        top_sites=diagnostics_state.top_sites(info['id'], group_by, limit))), 201
+
+@diagnostics.route('/admin/memory/snapshots/<int:snapshot_id>', methods=['GET'])
+@adminApiKeyAuth.login_required
+def snapshot_route(snapshot_id):
+    """
+    Return the top allocation sites of a snapshot or, with ?compare_to=<snapshot id>, the
+    sites that grew the most since that snapshot (?compare_to=previous for the one before)
+    """
+    group_by, limit = get_snapshot_params()
+    diagnostics_state = memory_diagnostics.memory_diagnostics
+    compare_to = request.args.get('compare_to')
+    try:
+        info, _ = diagnostics_state.get_snapshot(snapshot_id)
+        if compare_to is None:
+            return respond(dict(info,
+                                top_sites=diagnostics_state.top_sites(snapshot_id, group_by,
+                                                                      limit)))
+        if compare_to == 'previous':
+            base_id = diagnostics_state.previous_snapshot_id(snapshot_id)
+            if base_id is None:
+                raise BadRequest('snapshot %d is the oldest snapshot' % snapshot_id)
+        elif compare_to.isdigit():
+            base_id = int(compare_to)
+        else:
+            raise BadRequest('compare_to must be a snapshot id or "previous"')
+        return respond(dict(info,
+                            compared_to=base_id,
+                            top_growth=diagnostics_state.compare(snapshot_id, base_id,
+                                                                 group_by, limit)))
+    except KeyError as error:
+        raise NotFound('no snapshot %s' % error)
+
+@diagnostics.route('/admin/memory/snapshots', methods=['DELETE'])
+@adminApiKeyAuth.login_required
+def stop_tracing_route():
+    """
+    Stop tracing allocations, which removes the tracemalloc overhead, and drop the snapshots
+    """
+    memory_diagnostics.memory_diagnostics.stop_tracing()
+    return '', 204
@@ -1,13 +1,25 @@
 import secrets
-from flask import Blueprint, current_app, request, jsonify
+from flask import Blueprint, current_app, request
 
 from app.auth.http_api_key import apiKeyAuth
 from app.models.user_model import UserModel
 from app.utils.create_jwt import create_jwt
-from app.utils.validate_params import validate_params
+from app.utils.refresh_token_store import issue_refresh_token
+from app.utils.request_schema import ParamGroup, RequestSchema
+from app.utils.response_format import respond
+from app.utils.tracing import set_correlation_id
 
 serverInitiated = Blueprint('serverAuth', __name__) # pylint: disable=invalid-name
 
+ASYNC_SIGNIN_SCHEMA = RequestSchema(ParamGroup(
+    required=['login_hint', 'client_id', 'scope', 'mccmnc', 'redirect_uri'],
+    optional=['correlation_id']))
+
+TOKEN_GRANT_SCHEMA = RequestSchema(ParamGroup(
+    required=['auth_req_id', 'state', 'scope'],
+    optional=['access_token', 'expires_in', 'refresh_token', 'id_token', 'error',
+              'error_description', 'correlation_id']))
+
 # send header: "X-API-Key: my_api_key"
 @serverInitiated.route('/auth/zenkey-async-signin', methods=['POST'])
 @apiKeyAuth.login_required
@@ -26,20 +38,15 @@ def async_token_request():
     NOTE: at the moment this endpoint is only a mock, no request is actually
     made
     """
-    required_params = ['login_hint',
-                       'client_id',
-                       'scope',
-                       'mccmnc',
-                       'redirect_uri']
-    optional_params = ['correlation_id']
-    validated_params = validate_params(request, required_params, optional_params)
+    validated_params, = ASYNC_SIGNIN_SCHEMA.validate(request)
+    set_correlation_id(validated_params.get('correlation_id'))
 
     # if this was not a mock we would request a token from zenkey
 
     # create mock auth req id
     auth_req_id = validated_params['login_hint'] + '_' + str(secrets.SystemRandom().randrange(100000))
 
-    return jsonify({
+    return respond({
         'auth_req_id': auth_req_id,
         'expires_in': 3600
     })
@@ -74,14 +81,17 @@ def async_token_result(auth_req_id):
     jwt_token = create_jwt(new_user,
                            current_app.config['TOKEN_EXPIRATION_TIME'],
                            current_app.config['BASE_URL'],
-                           current_app.config['SECRET_KEY'])
+                           current_app.config['SECRET_KEY'],
+                           current_app.config['JWT_CLAIM_PROFILE'],
+                           current_app.config['JWT_SHORT_CLAIMS'])
+    refresh_token = issue_refresh_token(new_user,
+                                        current_app.config['REFRESH_TOKEN_EXPIRATION_TIME'])
 
-    return jsonify({
+    return respond({
         'auth_req_id': auth_req_id,
         'token': jwt_token,
         'token_type': 'bearer',
-        # we omit the refresh token for brevity in this example codebase
-        'refresh_token': 'omitted',
+        'refresh_token': refresh_token,
         'expires': current_app.config['TOKEN_EXPIRATION_TIME'].total_seconds()
     })
 
@@ -96,7 +106,7 @@ This endpoint retries the request made in the '/auth/zenkey-async-signin'
     NOTE: at the moment this endpoint is only a mock, there is no request to
     retry
     """
-    return jsonify({'auth_req_id': auth_req_id})
+    return respond({'auth_req_id': auth_req_id})
 
 @serverInitiated.route('/auth/zenkey-async-signin/<string:auth_req_id>', methods=['DELETE'])
 @apiKeyAuth.login_required
@@ -126,17 +136,7 @@ def async_token_grant():
     NOTE: at the moment this endpoint is only a mock, there is no actual token
     request to grant
     """
-    required_params = ['auth_req_id',
-                       'state',
-                       'scope']
-    optional_params = ['access_token',
-                       'expires_in',
-                       'refresh_token',
-                       'id_token',
-                       'error',
-                       'error_description',
-                       'correlation_id']
-    validate_params(request, required_params, optional_params)
+    TOKEN_GRANT_SCHEMA.validate(request)
 
     # if this was not a mock we would save the ranted token infromation to a db
 
@@ -0,0 +1,31 @@
+from flask import Blueprint
+
+from app.auth.http_api_key import apiKeyAuth
+from app.utils import (carrier_guard, carrier_token_store, discovery_failure_cache,
+                       http_cassette, id_token_verifier, log_pipeline, refresh_token_store,
+                       replay_store, tracing)
+from app.utils.response_format import respond
+from app.utils.signin_replay_cache import signin_replay_cache
+
+status = Blueprint('status', __name__) # pylint: disable=invalid-name
+
+@status.route('/status/metrics', methods=['GET'])
+@apiKeyAuth.login_required
+def metrics_route():
+    """
+    Report the state and counters of this worker's sign-in caches and carrier protections
+
+    Each worker process keeps its own metrics
+    """
+    return respond({
+        'carriers': carrier_guard.carrier_guard.stats(),
+        'carrier_tokens': carrier_token_store.carrier_token_stats(),
+        'discovery_failures': discovery_failure_cache.discovery_failure_cache.stats(),
+        'http_cassette': http_cassette.cassette_stats(http_cassette.http_session),
+        'id_token_verifier': id_token_verifier.id_token_verifier.stats(),
+        'logging': log_pipeline.log_pipeline_stats(),
+        'refresh_tokens': refresh_token_store.refresh_token_store.stats(),
+        'replay_store': replay_store.replay_store.stats(),
+        'signin_replay_cache': signin_replay_cache.stats(),
+        'tracing': tracing.tracing_stats(),
+    })
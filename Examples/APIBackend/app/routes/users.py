@@ -1,13 +1,22 @@
-from flask import Blueprint, current_app, request, jsonify, g
+from flask import Blueprint, current_app, request, g
 
 from app.auth.http_api_key import apiKeyAuth
 from app.auth.http_access_token import accessTokenAuth
 from app.models.user_model import UserModel
 from app.utils.create_jwt import create_jwt
-from app.utils.validate_params import validate_params
+from app.utils.deadline import request_deadline
+from app.utils.refresh_token_store import issue_refresh_token
+from app.utils.request_schema import ParamGroup, RequestSchema
+from app.utils.response_format import respond
+from app.utils.zenkey_oidc_service import refresh_zenkey_user_info
 
 users = Blueprint('users', __name__) # pylint: disable=invalid-name
 
+# the new user must include the ZenKey "sub" to match them with a ZenKey account
+CREATE_USER_SCHEMA = RequestSchema(ParamGroup(
+    required=['zenkey_sub'],
+    optional=['name', 'phone_number', 'postal_code', 'email', 'username', 'password']))
+
 @users.route('/users', methods=['POST'])
 @apiKeyAuth.login_required
 def create_user_route():
@@ -21,27 +30,22 @@ def create_user_route():
     Here we receive the contents of that registration form, create a new user,
     log the user in and return a token
     """
-    # the new user must include the ZenKey "sub" to match them with a ZenKey account
-    required_params = ['zenkey_sub']
-    optional_params = ['name',
-                       'phone_number',
-                       'postal_code',
-                       'email',
-                       'username',
-                       'password']
-    new_user_params = validate_params(request, required_params, optional_params)
+    new_user_params, = CREATE_USER_SCHEMA.validate(request)
     new_user = UserModel.create_new_user(new_user_params)
     g.current_user = new_user
 
     jwt_token = create_jwt(new_user,
                            current_app.config['TOKEN_EXPIRATION_TIME'],
                            current_app.config['BASE_URL'],
-                           current_app.config['SECRET_KEY'])
+                           current_app.config['SECRET_KEY'],
+                           current_app.config['JWT_CLAIM_PROFILE'],
+                           current_app.config['JWT_SHORT_CLAIMS'])
+    refresh_token = issue_refresh_token(new_user,
+                                        current_app.config['REFRESH_TOKEN_EXPIRATION_TIME'])
 
-    return jsonify({
+    return respond({
         'token': jwt_token,
-        # we omit the refresh token for brevity in this example codebase
-        'refresh_token': 'fake_refresh_token',
+        'refresh_token': refresh_token,
         'token_type': 'bearer',
         'expires': current_app.config['TOKEN_EXPIRATION_TIME'].total_seconds()
     }), 201
@@ -55,4 +59,20 @@ def current_user_route():
     """
     user = UserModel.find_user(g.current_user)
 
-    return jsonify(user)
+    return respond(user.to_dict())
+
+@users.route('/users/me/zenkey-refresh', methods=['POST'])
+@accessTokenAuth.login_required
+@apiKeyAuth.login_required
+def refresh_zenkey_attributes_route():
+    """
+    Get the current user's ZenKey attributes from their carrier again
+
+    Uses the carrier tokens saved when the user signed in with ZenKey, server-to-server,
+    so the user doesn't go through carrier discovery and authorization again
+    """
+    zenkey_user_info = refresh_zenkey_user_info(g.current_user.get('user_id'),
+                                                request_deadline(request))
+
+    # you might update the user's record with the fresh attributes here
+    return respond({'zenkey_attributes': zenkey_user_info.to_dict()})
@@ -0,0 +1,338 @@
+from collections import deque
+import logging
+import threading
+import time
+
+import requests
+from werkzeug.exceptions import BadGateway, GatewayTimeout, ServiceUnavailable
+
+from app.utils import http_cassette
+from app.utils.tracing import span
+
+# Protects the app from a degraded carrier.
+# Every outbound call to a carrier goes through a circuit breaker for its (issuer, endpoint)
+# and a bulkhead (a cap on concurrent calls) for its issuer:
+# - the circuit breaker opens when too many recent calls failed or were slow. While it is
+#   open, calls fail immediately instead of waiting for the carrier. After open_seconds it
+#   lets a trial call through ("half open") and closes again if that call succeeds
+# - the bulkhead stops one slow carrier from tying up every worker thread, so sign-ins
+#   with the other carriers keep working
+# Both reject calls with a 503 Service Unavailable. A call that times out fails with a 504
+# Gateway Timeout, and one that can't reach the carrier with a 502 Bad Gateway.
+# Each endpoint's timeout adapts to the carrier: it is a multiple of the p99 latency of the
+# recent calls, between min_timeout and max_timeout. A request's Deadline can shorten it further.
+
+logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker():
+    """
+    a circuit breaker for one carrier endpoint
+
+    failure_rate: open when this fraction of the recent calls failed
+    slow_call_seconds: calls that take longer than this count as slow
+    slow_call_rate: open when this fraction of the recent calls were slow
+    window_size: the number of recent calls the rates are computed from
+    min_calls: the rates are only checked once the window has this many calls
+    open_seconds: how long the breaker stays open before letting a trial call through
+    """
+    def __init__(self, name, failure_rate=0.5, slow_call_seconds=5, slow_call_rate=0.5,
+                 window_size=20, min_calls=10, open_seconds=30):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        # (failed, slow) for each recent call
+        self.window = deque(maxlen=window_size)
+        self.state = CLOSED
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.lock = threading.Lock()
+        self.metrics = {'calls': 0, 'failures': 0, 'slow_calls': 0, 'rejected': 0,
+                        'opened': 0, 'closed': 0}
+
+    def _transition(self, state):
+        logger.warning('circuit breaker %s: %s -> %s', self.name, self.state, state)
+        self.state = state
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+            self.metrics['opened'] += 1
+        elif state == CLOSED:
+            self.window.clear()
+            self.metrics['closed'] += 1
+
+    def allow_call(self):
+        """
+        Returns True if a call may go through now
+        """
+        with self.lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    self.metrics['rejected'] += 1
+                    return False
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                # only one trial call at a time
+                if self.trial_in_progress:
+                    self.metrics['rejected'] += 1
+                    return False
+                self.trial_in_progress = True
+            return True
+
+    def cancel(self):
+        """
+        Forget a call that allow_call() let through but that was never made
+        """
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.trial_in_progress = False
+
+    def record(self, failed, seconds):
+        """
+        Record the outcome of a call that allow_call() let through
+        """
+        slow = seconds > self.slow_call_seconds
+        with self.lock:
+            self.metrics['calls'] += 1
+            self.metrics['failures'] += failed
+            self.metrics['slow_calls'] += slow
+            if self.state == OPEN:
+                # a call that started before the breaker opened
+                return
+            if self.state == HALF_OPEN:
+                self.trial_in_progress = False
+                self._transition(OPEN if failed or slow else CLOSED)
+                return
+            self.window.append((failed, slow))
+            calls = len(self.window)
+            if calls < self.min_calls:
+                return
+            failures = sum(1 for call_failed, _ in self.window if call_failed)
+            slow_calls = sum(1 for _, call_slow in self.window if call_slow)
+            if (failures / calls >= self.failure_rate or
+                    slow_calls / calls >= self.slow_call_rate):
+                self._transition(OPEN)
+
+    def stats(self):
+        """the state and counters for monitoring"""
+        with self.lock:
+            calls = len(self.window)
+            return dict(self.metrics,
+                        state=self.state,
+                        window_failure_rate=(sum(failed for failed, _ in self.window) / calls
+                                             if calls else 0),
+                        window_slow_call_rate=(sum(slow for _, slow in self.window) / calls
+                                               if calls else 0))
+
+class Bulkhead():
+    """
+    a cap on the number of concurrent calls to one carrier
+    """
+    def __init__(self, name, max_concurrent_calls=20):
+        self.name = name
+        self.max_concurrent_calls = max_concurrent_calls
+        self.in_flight = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Returns False instead of waiting when the carrier already has too many calls"""
+        with self.lock:
+            if self.in_flight >= self.max_concurrent_calls:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        """release a call slot"""
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        """counters for monitoring"""
+        return {'in_flight': self.in_flight,
+                'max_concurrent_calls': self.max_concurrent_calls,
+                'rejected': self.rejected}
+
+class LatencyTracker():
+    """
+    the recent latencies of one carrier endpoint, and the timeout they suggest
+    """
+    # the timeout is this multiple of the p99 latency
+    p99_multiplier = 2
+    # until there are this many samples, use the max timeout
+    min_samples = 20
+    # recompute the timeout after this many new samples
+    update_interval = 10
+
+    def __init__(self, min_timeout, max_timeout, window_size=200):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.samples = deque(maxlen=window_size)
+        self.new_samples = 0
+        self.p99 = None
+        self.timeout = max_timeout
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        """
+        record the latency of a call that got a response, or the timeout of one that
+        timed out: its latency was at least that long
+        """
+        with self.lock:
+            self.samples.append(seconds)
+            self.new_samples += 1
+            if len(self.samples) < self.min_samples or self.new_samples < self.update_interval:
+                return
+            self.new_samples = 0
+            samples = sorted(self.samples)
+        self.p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+        self.timeout = min(max(self.p99 * self.p99_multiplier, self.min_timeout),
+                           self.max_timeout)
+
+    def stats(self):
+        """the current timeout for monitoring"""
+        return {'samples': len(self.samples), 'p99': self.p99, 'timeout': self.timeout}
+
+class CarrierGuard():
+    """
+    the circuit breakers and bulkheads for every carrier, created as carriers are seen
+    """
+    def __init__(self, max_concurrent_calls=20, min_timeout=1, max_timeout=10,
+                 **breaker_settings):
+        self.max_concurrent_calls = max_concurrent_calls
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.breaker_settings = breaker_settings
+        self.breakers = {}
+        self.bulkheads = {}
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def _breaker(self, issuer, endpoint):
+        breaker = self.breakers.get((issuer, endpoint))
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(
+                    (issuer, endpoint),
+                    CircuitBreaker('%s %s' % (issuer, endpoint), **self.breaker_settings))
+        return breaker
+
+    def _bulkhead(self, issuer):
+        bulkhead = self.bulkheads.get(issuer)
+        if bulkhead is None:
+            with self.lock:
+                bulkhead = self.bulkheads.setdefault(
+                    issuer, Bulkhead(issuer, self.max_concurrent_calls))
+        return bulkhead
+
+    def _latency_tracker(self, issuer, endpoint):
+        latency_tracker = self.latencies.get((issuer, endpoint))
+        if latency_tracker is None:
+            with self.lock:
+                latency_tracker = self.latencies.setdefault(
+                    (issuer, endpoint), LatencyTracker(self.min_timeout, self.max_timeout))
+        return latency_tracker
+
+    def request(self, issuer, endpoint, method, url, deadline=None, **kwargs):
+        """
+        Make an HTTP request to a carrier endpoint with the shared requests session
+
+        The timeout is the endpoint's adaptive timeout, shortened to the time left before
+        the deadline. Raises GatewayTimeout if there is no time left or the request times out,
+        and BadGateway if the carrier can't be reached or the request fails without a response.
+        Connection errors, timeouts and 5xx responses count as failures, but not a timeout
+        cut short by the deadline, which also isn't a latency sample. Raises
+        ServiceUnavailable without making the request if the endpoint's circuit breaker
+        is open or the carrier has too many requests in progress
+        """
+        latency_tracker = self._latency_tracker(issuer, endpoint)
+        adaptive_timeout = latency_tracker.timeout
+        timeout = adaptive_timeout
+        if deadline is not None:
+            timeout = deadline.timeout('the carrier %s request' % endpoint, adaptive_timeout)
+
+        breaker = self._breaker(issuer, endpoint)
+        if not breaker.allow_call():
+            raise ServiceUnavailable('The carrier %s endpoint is temporarily unavailable. '
+                                     'Try again later' % endpoint)
+        bulkhead = self._bulkhead(issuer)
+        if not bulkhead.acquire():
+            # the call never happened: don't leave a half open breaker waiting for it
+            breaker.cancel()
+            raise ServiceUnavailable('Too many requests in progress with this carrier. '
+                                     'Try again later')
+
+        started = time.monotonic()
+        failed = True
+        with span(endpoint, issuer=issuer, method=method.upper(), timeout=timeout) as carrier_span:
+            # propagate the trace and the correlation ID to the carrier
+            kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                     **carrier_span.outbound_headers())
+            try:
+                response = http_cassette.http_session.request(method, url, timeout=timeout,
+                                                              **kwargs)
+                latency_tracker.record(time.monotonic() - started)
+                failed = response.status_code >= 500
+                carrier_span.set('status', response.status_code)
+                return response
+            except requests.Timeout:
+                if timeout < adaptive_timeout:
+                    # the request's own, shorter deadline ran out: that says nothing about
+                    # the carrier, so it is kept out of the latencies and the circuit breaker
+                    # that every request shares
+                    failed = None
+                    raise GatewayTimeout('The sign-in ran out of time waiting for the carrier '
+                                         '%s endpoint' % endpoint)
+                # leaving timeouts out would make the p99 of a slowing carrier look better
+                # than it is, and shrink its timeout when it should grow
+                latency_tracker.record(timeout)
+                raise GatewayTimeout('The carrier %s endpoint did not respond in time' % endpoint)
+            except requests.RequestException as error:
+                logger.warning('the carrier %s request to %s failed: %s', endpoint, issuer, error)
+                raise BadGateway('The carrier %s endpoint could not be reached' % endpoint)
+            finally:
+                if failed is None:
+                    breaker.cancel()
+                else:
+                    breaker.record(failed, time.monotonic() - started)
+                bulkhead.release()
+
+    def stats(self):
+        """the state and counters of every circuit breaker and bulkhead"""
+        return {
+            'circuit_breakers': {breaker.name: breaker.stats()
+                                 for breaker in list(self.breakers.values())},
+            'bulkheads': {bulkhead.name: bulkhead.stats()
+                          for bulkhead in list(self.bulkheads.values())},
+            'timeouts': {'%s %s' % key: latency_tracker.stats()
+                         for key, latency_tracker in list(self.latencies.items())},
+        }
+
+carrier_guard = CarrierGuard() # pylint: disable=invalid-name
+
+def init_carrier_guard(app):
+    """
+    Configure the circuit breakers and bulkheads from the app configuration
+    """
+    global carrier_guard # pylint: disable=invalid-name,global-statement
+    carrier_guard = CarrierGuard(
+        max_concurrent_calls=app.config['CARRIER_MAX_CONCURRENT_REQUESTS'],
+        min_timeout=app.config['CARRIER_TIMEOUT_MIN_SECONDS'],
+        max_timeout=app.config['CARRIER_TIMEOUT_MAX_SECONDS'],
+        failure_rate=app.config['CIRCUIT_BREAKER_FAILURE_RATE'],
+        slow_call_seconds=app.config['CIRCUIT_BREAKER_SLOW_CALL_SECONDS'],
+        slow_call_rate=app.config['CIRCUIT_BREAKER_SLOW_CALL_RATE'],
+        window_size=app.config['CIRCUIT_BREAKER_WINDOW_SIZE'],
+        min_calls=app.config['CIRCUIT_BREAKER_MIN_CALLS'],
+        open_seconds=app.config['CIRCUIT_BREAKER_OPEN_SECONDS'])
+
+def carrier_request(issuer, endpoint, method, url, deadline=None, **kwargs):
+    """make an HTTP request to a carrier endpoint through the configured carrier guard"""
+    return carrier_guard.request(issuer, endpoint, method, url, deadline=deadline, **kwargs)
@@ -0,0 +1,447 @@
+from base64 import urlsafe_b64encode
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+from werkzeug.exceptions import GatewayTimeout
+
+# The carriers' tokens, saved when a user signs in with ZenKey, so we can get fresh ZenKey
+# attributes for the user later with one server-to-server call instead of sending them
+# through carrier discovery and the authorization redirect again.
+# - encrypted at rest: each record (the refresh token, the access token and its expiry) is
+#   encrypted and authenticated with a Fernet key derived from the app's secret key. Records
+#   are keyed by a hash of our own user ID, never by a ZenKey sub a client could claim, and
+#   only the times of their next refresh, lease and eviction are stored in the clear
+# - refresh ahead: a background thread exchanges the refresh tokens of the access tokens that
+#   expire within refresh_ahead seconds, so a fresh access token is at hand when it's needed.
+#   Tokens are only kept fresh for keep_fresh seconds after the user signed in or their
+#   tokens were last refreshed on demand, then they are refreshed on demand
+# - leases: a record being refreshed, in the background or on demand, is claimed for lease
+#   seconds, so two threads or workers sharing the SQLite store don't both use the same
+#   refresh token: carriers can rotate them. Saving the record releases its lease
+# - eviction: a record is forgotten max_idle seconds after it was last used
+# With several worker processes, use the SQLite store so every worker sees the same tokens.
+
+logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+# returned by claim() when another thread or worker holds the record's lease
+LEASED = 'leased'
+
+def hash_user_id(user_id):
+    """the key a user's tokens are stored under"""
+    return hashlib.sha256(str(user_id).encode('utf-8')).digest()
+
+class MemoryCarrierTokenBackend():
+    """
+    An in-memory, per-process store of encrypted carrier token records
+
+    sweep_interval: the time (in seconds) between two sweeps of the evicted records
+    """
+    name = 'memory'
+
+    def __init__(self, sweep_interval=60):
+        self.sweep_interval = sweep_interval
+        # key: [encrypted record, refresh_at, leased_until, evict_at]
+        self.records = {}
+        self.next_sweep = time.time() + sweep_interval
+        self.lock = threading.Lock()
+
+    def _sweep(self, now):
+        """forget the records past their eviction time, when a sweep is due"""
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + self.sweep_interval
+        for key in [key for key, entry in self.records.items() if entry[3] <= now]:
+            del self.records[key]
+
+    def _entry(self, key, now):
+        entry = self.records.get(key)
+        return entry if entry is not None and entry[3] > now else None
+
+    def save(self, key, record, refresh_at, evict_at):
+        """
+        save a record, to be refreshed at refresh_at (None: only on demand) and forgotten
+        at evict_at, and release its lease
+        """
+        now = time.time()
+        with self.lock:
+            self._sweep(now)
+            self.records[key] = [record, refresh_at, None, evict_at]
+
+    def load(self, key):
+        """an encrypted record, or None"""
+        with self.lock:
+            entry = self._entry(key, time.time())
+        return entry[0] if entry is not None else None
+
+    def delete(self, key):
+        """forget a record"""
+        with self.lock:
+            self.records.pop(key, None)
+
+    def claim(self, key, now, lease):
+        """
+        lease a record for lease seconds and return it: None if there is no record, or
+        LEASED if it is already leased
+        """
+        with self.lock:
+            entry = self._entry(key, now)
+            if entry is None:
+                return None
+            if entry[2] is not None and entry[2] > now:
+                return LEASED
+            entry[2] = now + lease
+            return entry[0]
+
+    def release(self, key):
+        """release the lease of a record that wasn't saved"""
+        with self.lock:
+            entry = self.records.get(key)
+            if entry is not None:
+                entry[2] = None
+
+    def claim_due(self, now, lease, limit):
+        """
+        the records due for a refresh that aren't leased, at most limit of them. Each one
+        is leased for lease seconds
+        """
+        claimed = []
+        with self.lock:
+            self._sweep(now)
+            for key, entry in self.records.items():
+                if (entry[1] is not None and entry[1] <= now and entry[3] > now and
+                        (entry[2] is None or entry[2] <= now)):
+                    entry[2] = now + lease
+                    claimed.append((key, entry[0]))
+                    if len(claimed) >= limit:
+                        break
+        return claimed
+
+    def count(self):
+        """the number of records, and the number of them kept fresh"""
+        with self.lock:
+            return (len(self.records),
+                    sum(1 for entry in self.records.values() if entry[1] is not None))
+
+class SQLiteCarrierTokenBackend():
+    """
+    A store of encrypted carrier token records in a SQLite database file shared by every
+    worker on the host
+
+    sweep_interval: the time (in seconds) between two sweeps of the evicted records
+    """
+    name = 'sqlite'
+
+    def __init__(self, path, sweep_interval=60):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self.next_sweep = time.time() + sweep_interval
+        # sqlite3 connections can't be shared between threads
+        self.local = threading.local()
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS carrier_tokens '
+                           '(user_hash BLOB PRIMARY KEY, record BLOB NOT NULL, refresh_at REAL, '
+                           'leased_until REAL, evict_at REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS carrier_tokens_refresh_at '
+                           'ON carrier_tokens (refresh_at)')
+        connection.execute('CREATE INDEX IF NOT EXISTS carrier_tokens_evict_at '
+                           'ON carrier_tokens (evict_at)')
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # autocommit mode: transactions are started explicitly
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def _sweep(self, connection, now):
+        """forget the records past their eviction time, when a sweep is due"""
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + self.sweep_interval
+        connection.execute('DELETE FROM carrier_tokens WHERE evict_at <= ?', (now,))
+
+    def _transaction(self, operation):
+        """run operation(connection, now) in a write transaction"""
+        now = time.time()
+        connection = self._connection()
+        # lock the database for writing so two workers can't lease the same records
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            self._sweep(connection, now)
+            result = operation(connection, now)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return result
+
+    def save(self, key, record, refresh_at, evict_at):
+        """
+        save a record, to be refreshed at refresh_at (None: only on demand) and forgotten
+        at evict_at, and release its lease
+        """
+        self._connection().execute('INSERT OR REPLACE INTO carrier_tokens '
+                                   '(user_hash, record, refresh_at, leased_until, evict_at) '
+                                   'VALUES (?, ?, ?, NULL, ?)',
+                                   (key, record, refresh_at, evict_at))
+
+    def load(self, key):
+        """an encrypted record, or None"""
+        row = self._connection().execute('SELECT record FROM carrier_tokens '
+                                         'WHERE user_hash = ? AND evict_at > ?',
+                                         (key, time.time())).fetchone()
+        return row[0] if row is not None else None
+
+    def delete(self, key):
+        """forget a record"""
+        self._connection().execute('DELETE FROM carrier_tokens WHERE user_hash = ?', (key,))
+
+    def claim(self, key, now, lease):
+        """
+        lease a record for lease seconds and return it: None if there is no record, or
+        LEASED if it is already leased
+        """
+        def claim_record(connection, _):
+            row = connection.execute('SELECT record, leased_until FROM carrier_tokens '
+                                     'WHERE user_hash = ? AND evict_at > ?',
+                                     (key, now)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] > now:
+                return LEASED
+            connection.execute('UPDATE carrier_tokens SET leased_until = ? WHERE user_hash = ?',
+                               (now + lease, key))
+            return row[0]
+
+        return self._transaction(claim_record)
+
+    def release(self, key):
+        """release the lease of a record that wasn't saved"""
+        self._connection().execute('UPDATE carrier_tokens SET leased_until = NULL '
+                                   'WHERE user_hash = ?', (key,))
+
+    def claim_due(self, now, lease, limit):
+        """
+        the records due for a refresh that aren't leased, at most limit of them. Each one
+        is leased for lease seconds
+        """
+        def claim_records(connection, _):
+            claimed = connection.execute('SELECT user_hash, record FROM carrier_tokens '
+                                         'WHERE refresh_at <= ? AND evict_at > ? AND '
+                                         '(leased_until IS NULL OR leased_until <= ?) LIMIT ?',
+                                         (now, now, now, limit)).fetchall()
+            connection.executemany('UPDATE carrier_tokens SET leased_until = ? '
+                                   'WHERE user_hash = ?',
+                                   [(now + lease, key) for key, _ in claimed])
+            return claimed
+
+        return self._transaction(claim_records)
+
+    def count(self):
+        """the number of records, and the number of them kept fresh"""
+        return self._connection().execute('SELECT COUNT(*), COUNT(refresh_at) '
+                                          'FROM carrier_tokens').fetchone()
+
+class CarrierTokenStore():
+    """
+    Encrypts the carrier token records and schedules their refreshes
+
+    A record is a dictionary with our user_id, the user's ZenKey sub, the client_id and
+    mccmnc they signed in with, the carrier's refresh_token, access_token and its expires_at
+    time, the active_until time until which the tokens are kept fresh and the evict_at time
+    when they are forgotten
+
+    backend: a MemoryCarrierTokenBackend or SQLiteCarrierTokenBackend
+    secret_key: the app's secret key, the encryption key is derived from it
+    refresh_ahead: how long (in seconds) before the access token expires it is refreshed
+    keep_fresh: how long (in seconds) after they were last used the tokens are kept fresh
+    max_idle: how long (in seconds) after they were last used the tokens are forgotten
+    lease: how long (in seconds) a record is claimed for while it is refreshed
+    """
+    def __init__(self, backend, secret_key, refresh_ahead=60, keep_fresh=3600,
+                 max_idle=2592000, lease=60):
+        self.backend = backend
+        self.name = backend.name
+        self.refresh_ahead = refresh_ahead
+        self.keep_fresh = keep_fresh
+        self.max_idle = max_idle
+        self.lease = lease
+        # derive a dedicated Fernet key so the app's secret key is never used directly
+        key_material = hashlib.sha256(('zenkey-carrier-tokens:%s' % secret_key).encode('utf-8'))
+        self.fernet = Fernet(urlsafe_b64encode(key_material.digest()))
+        self.metrics = {'saved': 0, 'undecryptable': 0, 'lease_waits': 0}
+
+    def _decrypt(self, key, encrypted):
+        try:
+            return json.loads(self.fernet.decrypt(encrypted).decode('utf-8'))
+        except InvalidToken:
+            # encrypted with another secret key: the user has to sign in again
+            self.metrics['undecryptable'] += 1
+            self.backend.delete(key)
+            return None
+
+    def save(self, record, used=False):
+        """
+        Save a record and release its lease. Using the tokens (used=True), like signing in,
+        keeps them fresh for keep_fresh seconds and saved for max_idle seconds
+        """
+        now = time.time()
+        if used:
+            record['active_until'] = now + self.keep_fresh
+            record['evict_at'] = now + self.max_idle
+        # refresh_ahead before the expiry, or halfway through the life of a shorter token
+        refresh_at = max(record['expires_at'] - self.refresh_ahead,
+                         (now + record['expires_at']) / 2)
+        if refresh_at >= record.get('active_until', 0):
+            # nobody is likely to need the tokens by then
+            refresh_at = None
+        encrypted = self.fernet.encrypt(json.dumps(record).encode('utf-8'))
+        self.backend.save(hash_user_id(record['user_id']), encrypted, refresh_at,
+                          record.get('evict_at', now + self.max_idle))
+        self.metrics['saved'] += 1
+
+    def load(self, user_id):
+        """the record of a user, or None"""
+        key = hash_user_id(user_id)
+        encrypted = self.backend.load(key)
+        return self._decrypt(key, encrypted) if encrypted is not None else None
+
+    def delete(self, user_id):
+        """forget a user's tokens, e.g. when the carrier has revoked them"""
+        self.backend.delete(hash_user_id(user_id))
+
+    def claim(self, user_id, timeout):
+        """
+        Lease a user's record to refresh it, waiting up to timeout seconds while another
+        thread or worker holds the lease. Save the record or release() it when done
+        Returns the record, read once the lease is held, or None if there is none
+        Raises a 504 Gateway Timeout if the lease is still held after timeout seconds
+        """
+        key = hash_user_id(user_id)
+        give_up_at = time.monotonic() + timeout
+        encrypted = self.backend.claim(key, time.time(), self.lease)
+        if encrypted == LEASED:
+            self.metrics['lease_waits'] += 1
+        while encrypted == LEASED:
+            remaining = give_up_at - time.monotonic()
+            if remaining <= 0:
+                raise GatewayTimeout('The ZenKey tokens of this user are being refreshed. '
+                                     'Try again later')
+            time.sleep(min(0.05, remaining))
+            encrypted = self.backend.claim(key, time.time(), self.lease)
+        return self._decrypt(key, encrypted) if encrypted is not None else None
+
+    def release(self, user_id):
+        """release the lease of a claimed record that isn't saved"""
+        self.backend.release(hash_user_id(user_id))
+
+    def claim_due(self, limit):
+        """the records due for a refresh, leased for lease seconds"""
+        claimed = (self._decrypt(key, encrypted)
+                   for key, encrypted in self.backend.claim_due(time.time(), self.lease, limit))
+        return [record for record in claimed if record is not None]
+
+    def stats(self):
+        """counters for monitoring (the counters are for this process only)"""
+        records, kept_fresh = self.backend.count()
+        return dict(self.metrics, backend=self.name, records=records, kept_fresh=kept_fresh)
+
+class CarrierTokenRefresher():
+    """
+    refreshes the carrier tokens that are about to expire from a background thread
+
+    refresh: a callable that takes a record, refreshes its tokens and saves them. It's called
+             in an app context
+    interval: the time (in seconds) between two checks for tokens that are due
+    batch_size: the most records refreshed after each check
+    """
+    def __init__(self, app, store, refresh, interval=15, batch_size=100):
+        self.app = app
+        self.store = store
+        self.refresh = refresh
+        self.interval = interval
+        self.batch_size = batch_size
+        self.metrics = {'refreshed': 0, 'refresh_errors': 0}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='carrier-token-refresher',
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                records = self.store.claim_due(self.batch_size)
+            except Exception: # pylint: disable=broad-except
+                logger.exception('unable to claim the carrier tokens due for a refresh')
+                continue
+            for record in records:
+                self._refresh(record)
+
+    def _refresh(self, record):
+        try:
+            with self.app.app_context():
+                self.refresh(record)
+            self.metrics['refreshed'] += 1
+        except Exception: # pylint: disable=broad-except
+            # the lease expires and the refresh is tried again, unless the carrier rejected
+            # the refresh token and the record was deleted
+            self.metrics['refresh_errors'] += 1
+            logger.exception('unable to refresh the carrier tokens for mccmnc %s',
+                             record.get('mccmnc'))
+
+    def close(self):
+        """stop the thread"""
+        self.stopped.set()
+
+    def stats(self):
+        """counters for monitoring"""
+        return dict(self.metrics)
+
+carrier_token_store = None # pylint: disable=invalid-name
+carrier_token_refresher = None # pylint: disable=invalid-name
+
+def init_carrier_token_store(app, refresh):
+    """
+    Create the carrier token store selected by the app configuration, and start refreshing
+    the tokens in the background with refresh(record)
+    """
+    # pylint: disable=invalid-name,global-statement
+    global carrier_token_store, carrier_token_refresher
+    backend = app.config['CARRIER_TOKEN_STORE_BACKEND']
+    if backend == 'off':
+        return
+    if backend == MemoryCarrierTokenBackend.name:
+        store_backend = MemoryCarrierTokenBackend()
+    elif backend == SQLiteCarrierTokenBackend.name:
+        store_backend = SQLiteCarrierTokenBackend(app.config['CARRIER_TOKEN_STORE_PATH'])
+    else:
+        raise ValueError('unknown carrier token store backend: %s' % backend)
+    if not app.config['SECRET_KEY']:
+        raise ValueError('the carrier token store requires SECRET_KEY_BASE')
+    carrier_token_store = CarrierTokenStore(store_backend,
+                                            app.config['SECRET_KEY'],
+                                            app.config['CARRIER_TOKEN_REFRESH_AHEAD'],
+                                            app.config['CARRIER_TOKEN_KEEP_FRESH'],
+                                            app.config['CARRIER_TOKEN_MAX_IDLE'])
+    if app.config['CARRIER_TOKEN_REFRESH_INTERVAL'] > 0:
+        carrier_token_refresher = CarrierTokenRefresher(
+            app, carrier_token_store, refresh,
+            interval=app.config['CARRIER_TOKEN_REFRESH_INTERVAL'])
+    app.logger.info('Using the %s carrier token store', carrier_token_store.name)
+
+def carrier_token_stats():
+    """the carrier token store and refresher counters, or None when they're disabled"""
+    if carrier_token_store is None:
+        return None
+    stats = carrier_token_store.stats()
+    if carrier_token_refresher is not None:
+        stats.update(carrier_token_refresher.stats())
+    return stats
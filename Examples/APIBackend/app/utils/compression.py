@@ -0,0 +1,103 @@
+import gzip
+from flask import request
+
+try:
+    import brotli
+except ImportError: # pragma: no cover - brotli is an optional dependency
+    brotli = None # pylint: disable=invalid-name
+
+# Compression of the responses, negotiated with the Accept-Encoding request header.
+# Brotli is used when the optional brotli package is installed and the client accepts it,
+# otherwise gzip. Small responses aren't compressed: the headers would cost more than the
+# bytes saved. Responses that already have a Content-Encoding, like the precompressed
+# static files, are left alone.
+
+GZIP = 'gzip'
+BROTLI = 'br'
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'application/xml',
+                      'application/x-yaml', 'application/yaml', 'image/svg+xml',
+                      # the binary API responses are mostly strings, like tokens
+                      'application/msgpack', 'application/x-msgpack',
+                      'application/vnd.msgpack', 'application/cbor')
+
+def available_encodings():
+    """the encodings we can produce, preferred first"""
+    return (BROTLI, GZIP) if brotli is not None else (GZIP,)
+
+def is_compressible(mimetype):
+    """text and structured data compress well, images and archives don't"""
+    return mimetype is not None and (mimetype.startswith('text/') or
+                                     mimetype in COMPRESSIBLE_TYPES or
+                                     mimetype.endswith('+json'))
+
+def negotiate_encoding(accept_encodings, encodings=None):
+    """
+    the encoding the client prefers among the ones given (by default the ones
+    available), or None. Ties go to the first one
+    """
+    best, best_quality = None, 0
+    for encoding in available_encodings() if encodings is None else encodings:
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def compress(data, encoding, level=6):
+    """
+    compress bytes with gzip (level 1 to 9) or brotli, whose quality is the level minus one,
+    or its best quality (11) for level 9
+    """
+    if encoding == BROTLI:
+        return brotli.compress(data, quality=11 if level >= 9 else max(level - 1, 0))
+    # mtime=0 keeps the output the same for the same input
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+class ResponseCompressor():
+    """
+    compresses the responses of a Flask app that are larger than min_size bytes
+
+    min_size: the smallest response body that is compressed
+    level: the compression level, from 1 (fastest) to 9 (smallest)
+    """
+    def __init__(self, min_size=500, level=6):
+        self.min_size = min_size
+        self.level = level
+
+    def __call__(self, response):
+        # responses to Accept-Encoding vary with it, even when they aren't compressed
+        if is_compressible(response.mimetype):
+            response.vary.add('Accept-Encoding')
+        if (response.direct_passthrough or response.is_streamed or
+                'Content-Encoding' in response.headers or
+                response.status_code < 200 or response.status_code in (204, 304) or
+                not is_compressible(response.mimetype)):
+            return response
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+        encoding = negotiate_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        response.set_data(compress(data, encoding, self.level))
+        response.headers['Content-Encoding'] = encoding
+        # an ETag set for the uncompressed body doesn't identify the compressed one
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag('%s-%s' % (etag, encoding))
+        return response
+
+def init_compression(app):
+    """
+    Compress the app's responses, unless the app configuration sets COMPRESSION_MIN_SIZE
+    to 0
+    """
+    if app.config['COMPRESSION_MIN_SIZE'] <= 0:
+        return
+    compressor = ResponseCompressor(app.config['COMPRESSION_MIN_SIZE'],
+                                    app.config['COMPRESSION_LEVEL'])
+
+    @app.after_request
+    def compress_response(response): # pylint: disable=unused-variable
+        return compressor(response)
@@ -2,20 +2,65 @@ from datetime import (datetime)
 
 import jwt
 
-def create_jwt(user, expiration_time, base_url, secret_key):
+from app.models.user_model import User
+
+# The claim profiles of the JWTs we issue. These tokens are sent with every API call, so
+# the smaller the better:
+# - full: the user attributes, and the exp, iat, nbf and iss claims
+# - minimal: the user's IDs and the exp claim. The rest of the profile is available from
+#   /users/me
+# Either profile can use short claim names.
+
+FULL = 'full'
+MINIMAL = 'minimal'
+
+# profile: (the user attributes embedded, whether iat, nbf and iss are embedded)
+CLAIM_PROFILES = {
+    FULL: (User.jwt_attributes, True),
+    MINIMAL: (('user_id', 'zenkey_sub'), False),
+}
+
+# the short claim name of each user attribute. They are all private claims: the ZenKey sub
+# identifies the user at the carrier, not the subject of our token, so it isn't put in the
+# registered "sub" claim
+SHORT_CLAIMS = {
+    'user_id': 'uid',
+    'zenkey_sub': 'zsub',
+    'name': 'nm',
+    'email': 'em',
+    'postal_code': 'pc',
+    'phone_number': 'ph',
+}
+SHORT_CLAIM_ATTRIBUTES = {claim: attribute for attribute, claim in SHORT_CLAIMS.items()}
+
+def create_jwt(user, expiration_time, base_url, secret_key, claim_profile=FULL,
+               short_claims=False):
     """
-    Create a new JWT containing the user attributes
+    Create a new JWT containing the user attributes of the claim profile
     """
+    try:
+        attributes, registered_claims = CLAIM_PROFILES[claim_profile]
+    except KeyError:
+        raise ValueError('unknown JWT claim profile: %s' % claim_profile)
     now = datetime.utcnow()
-    jwt_payload = {
-        'name': user.get('name'),
-        'email': user.get('email'),
-        'postal_code': user.get('postal_code'),
-        'phone_number': user.get('phone_number'),
-        'zenkey_sub': user.get('zenkey_sub'),
-        'exp': now + expiration_time,
-        'iat': now,
-        'nbf': now,
-        'iss': base_url,
-    }
+    jwt_payload = user.jwt_claims(attributes)
+    if short_claims:
+        jwt_payload = {SHORT_CLAIMS[attribute]: value for attribute, value in jwt_payload.items()}
+    jwt_payload['exp'] = now + expiration_time
+    if registered_claims:
+        jwt_payload.update(iat=now, nbf=now, iss=base_url)
     return jwt.encode(jwt_payload, secret_key, algorithm='HS256').decode('utf-8')
+
+def init_jwt_claim_profile(app):
+    """
+    Check the JWT claim profile of the app configuration, so an unknown one stops the app
+    from starting instead of failing every sign-in
+    """
+    if app.config['JWT_CLAIM_PROFILE'] not in CLAIM_PROFILES:
+        raise ValueError('unknown JWT claim profile: %s' % app.config['JWT_CLAIM_PROFILE'])
+
+def jwt_user_attributes(claims):
+    """
+    The user attributes in the claims of a decoded JWT, whichever claim names it uses
+    """
+    return {SHORT_CLAIM_ATTRIBUTES.get(claim, claim): value for claim, value in claims.items()}
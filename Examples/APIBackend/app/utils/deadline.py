@@ -0,0 +1,60 @@
+import time
+
+from flask import current_app
+from werkzeug.exceptions import BadRequest, GatewayTimeout
+
+# A sign-in makes several calls in a row (discovery, token, userinfo, user lookup).
+# Instead of giving each call its own fixed timeout, the sign-in gets one time budget and
+# each call may only use what is left of it. The time a sign-in takes is then capped by the
+# budget, however the carrier behaves.
+
+class Deadline():
+    """
+    the time left to finish a request
+    """
+    __slots__ = ('expires_at',)
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        """the seconds left, which can be negative once the deadline has passed"""
+        return self.expires_at - time.monotonic()
+
+    def check(self, phase):
+        """
+        Raise a 504 Gateway Timeout if the deadline has passed before starting a phase
+        """
+        if self.remaining() <= 0:
+            raise GatewayTimeout('The sign-in ran out of time before %s' % phase)
+
+    def timeout(self, phase, cap=None):
+        """
+        The timeout for the next call: the time left, no more than cap
+        Raises a 504 Gateway Timeout if there is no time left
+        """
+        self.check(phase)
+        remaining = self.remaining()
+        return remaining if cap is None else min(remaining, cap)
+
+def request_deadline(request):
+    """
+    The deadline for a sign-in request
+
+    Clients can ask for a shorter budget (in seconds) with a header, but never a longer
+    one than SIGNIN_DEADLINE_SECONDS. A budget below SIGNIN_DEADLINE_MIN_SECONDS is raised
+    to it, so a client can't make the carrier calls time out on purpose
+    """
+    budget = current_app.config['SIGNIN_DEADLINE_SECONDS']
+    requested_budget = request.headers.get(current_app.config['SIGNIN_DEADLINE_HEADER'])
+    if requested_budget is not None:
+        try:
+            requested_budget = float(requested_budget)
+        except ValueError:
+            raise BadRequest('%s must be a number of seconds' %
+                             current_app.config['SIGNIN_DEADLINE_HEADER'])
+        if requested_budget <= 0:
+            raise BadRequest('%s must be positive' % current_app.config['SIGNIN_DEADLINE_HEADER'])
+        budget = min(budget, max(requested_budget,
+                                 current_app.config['SIGNIN_DEADLINE_MIN_SECONDS']))
+    return Deadline(budget)
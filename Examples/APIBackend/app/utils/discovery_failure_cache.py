@@ -0,0 +1,124 @@
+from collections import OrderedDict
+import threading
+import time
+
+# Remembers failed OIDC discovery lookups for a short time.
+# A client that sends a bogus or unsupported mccmnc, and retries, would otherwise cost a full
+# round trip to the ZenKey discovery service every time. With this cache, repeats of a
+# failed (client_id, mccmnc) lookup get the same error straight away.
+# Lookups for mccmncs that have never been discovered successfully are also rate limited,
+# with a token bucket per mccmnc so a client cycling through bogus mccmncs can't use up the
+# lookups of a new carrier. Only the most recently used max_tracked_mccmncs buckets are kept.
+# Known mccmncs are never limited.
+
+class DiscoveryFailureCache():
+    """
+    a short-lived cache of failed discovery lookups
+
+    ttl: how long (in seconds) a failed lookup is remembered
+    unknown_lookups_per_second: the rate of lookups allowed for each mccmnc that has never
+                                been discovered successfully. 0 disables the limit
+    max_entries: the maximum number of remembered failures
+    max_tracked_mccmncs: the maximum number of unknown mccmncs with a token bucket
+    """
+    # keep failure counts for this many client IDs
+    max_tracked_clients = 100
+
+    def __init__(self, ttl=60, unknown_lookups_per_second=5, max_entries=10000,
+                 max_tracked_mccmncs=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (client_id, mccmnc): expires_at. Every entry has the same TTL, so insertion order is
+        # also expiry order
+        self.failures = OrderedDict()
+        self.known_mccmncs = set()
+        # mccmnc: [tokens, updated_at], a token bucket for the lookups of each unknown mccmnc
+        # allowing bursts of one second of lookups, least recently used first
+        self.unknown_lookups_per_second = unknown_lookups_per_second
+        self.burst = max(unknown_lookups_per_second, 1)
+        self.max_tracked_mccmncs = max_tracked_mccmncs
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.metrics = {'cached_failures': 0, 'hits': 0, 'unknown_lookups_limited': 0}
+        self.failures_by_client = {}
+
+    def has_failed(self, client_id, mccmnc):
+        """
+        Returns True if discovery recently failed for this client_id and mccmnc
+        """
+        now = time.monotonic()
+        with self.lock:
+            while self.failures:
+                key, expires_at = next(iter(self.failures.items()))
+                if expires_at > now:
+                    break
+                del self.failures[key]
+            if (client_id, mccmnc) in self.failures:
+                self.metrics['hits'] += 1
+                return True
+            return False
+
+    def allow_lookup(self, mccmnc):
+        """
+        Returns False if the lookup should not be made because there have been too many
+        lookups of this unknown mccmnc
+        """
+        if mccmnc in self.known_mccmncs or not self.unknown_lookups_per_second:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(mccmnc)
+            if bucket is None:
+                bucket = self.buckets[mccmnc] = [self.burst, now]
+                while len(self.buckets) > self.max_tracked_mccmncs:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(mccmnc)
+                bucket[0] = min(self.burst,
+                                bucket[0] + (now - bucket[1]) * self.unknown_lookups_per_second)
+                bucket[1] = now
+            if bucket[0] < 1:
+                self.metrics['unknown_lookups_limited'] += 1
+                return False
+            bucket[0] -= 1
+            return True
+
+    def add_failure(self, client_id, mccmnc):
+        """remember a failed lookup"""
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            self.failures[(client_id, mccmnc)] = time.monotonic() + self.ttl
+            self.failures.move_to_end((client_id, mccmnc))
+            while len(self.failures) > self.max_entries:
+                self.failures.popitem(last=False)
+            self.metrics['cached_failures'] += 1
+            if (client_id in self.failures_by_client or
+                    len(self.failures_by_client) < self.max_tracked_clients):
+                self.failures_by_client[client_id] = self.failures_by_client.get(client_id, 0) + 1
+
+    def add_success(self, mccmnc):
+        """remember an mccmnc that was discovered successfully"""
+        self.known_mccmncs.add(mccmnc)
+        with self.lock:
+            self.buckets.pop(mccmnc, None)
+
+    def stats(self):
+        """counters for monitoring, including the client IDs with the most failures"""
+        top_clients = sorted(self.failures_by_client.items(), key=lambda item: -item[1])[:10]
+        return dict(self.metrics,
+                    entries=len(self.failures),
+                    known_mccmncs=len(self.known_mccmncs),
+                    tracked_unknown_mccmncs=len(self.buckets),
+                    failures_by_client=dict(top_clients))
+
+discovery_failure_cache = DiscoveryFailureCache() # pylint: disable=invalid-name
+
+def init_discovery_failure_cache(app):
+    """
+    Configure the discovery failure cache from the app configuration
+    """
+    global discovery_failure_cache # pylint: disable=invalid-name,global-statement
+    discovery_failure_cache = DiscoveryFailureCache(
+        ttl=app.config['DISCOVERY_FAILURE_CACHE_TTL'],
+        unknown_lookups_per_second=app.config['DISCOVERY_UNKNOWN_MCCMNC_RATE'])
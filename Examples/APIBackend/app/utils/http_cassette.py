@@ -0,0 +1,216 @@
+from base64 import b64decode, b64encode
+import atexit
+from datetime import timedelta
+import gzip
+from http.cookiejar import DefaultCookiePolicy
+import io
+import json
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.response import HTTPResponse
+
+# Every request to ZenKey and the carriers goes through one shared requests session, which
+# reuses connections. Its transport adapter can also record the exchanges to a cassette file,
+# or replay them from one without any network, so benchmark runs get the same carrier
+# responses on every machine:
+# - record: requests are sent as usual, and each request and its response are appended to a
+#   gzipped JSON lines cassette
+# - replay: the cassette is loaded in memory and requests are answered from it. Requests are
+#   matched by method and URL (request headers and bodies are ignored), and the recorded
+#   responses for a request are served in order, starting over when they run out. With
+#   replay_timing, each response takes as long as it did when it was recorded
+
+OFF = 'off'
+RECORD = 'record'
+REPLAY = 'replay'
+
+# response headers that describe the recorded connection rather than the response
+SKIPPED_HEADERS = ('connection', 'content-encoding', 'content-length', 'date', 'keep-alive',
+                   'server', 'set-cookie', 'transfer-encoding')
+
+class CassetteMiss(requests.ConnectionError):
+    """a replayed request has no recorded response"""
+
+def interaction_key(method, url):
+    """the method and URL, with the query parameters sorted"""
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return '%s %s' % (method.upper(), urlunsplit(parts._replace(query=query, fragment='')))
+
+class Cassette():
+    """
+    the recorded exchanges, in a gzipped JSON lines file
+    """
+    def __init__(self, path, mode):
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        # key: [next index, recorded interactions]
+        self.interactions = {}
+        self.metrics = {'recorded': 0, 'replayed': 0, 'misses': 0}
+        self.file = None
+        if mode == REPLAY:
+            self.load()
+        else:
+            # appending adds a gzip member, which gzip.open() reads as one stream
+            self.file = gzip.open(path, 'at', encoding='utf-8')
+            atexit.register(self.close)
+
+    def load(self):
+        """load every recorded interaction in memory"""
+        with gzip.open(self.path, 'rt', encoding='utf-8') as cassette_file:
+            try:
+                for line in cassette_file:
+                    self.add(json.loads(line))
+            except EOFError:
+                # the recording process was killed before it could close the file: every
+                # line was flushed, so only the gzip trailer is missing
+                pass
+
+    def add(self, interaction):
+        """add a recorded interaction to the ones being replayed"""
+        if 'body_base64' in interaction:
+            interaction['body'] = b64decode(interaction.pop('body_base64'))
+        else:
+            interaction['body'] = interaction['body'].encode('utf-8')
+        key = interaction_key(interaction['method'], interaction['url'])
+        self.interactions.setdefault(key, [0, []])[1].append(interaction)
+
+    def record(self, request, response, elapsed):
+        """append an exchange to the cassette"""
+        interaction = {
+            'method': request.method,
+            'url': request.url,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': {name: value for name, value in response.headers.items()
+                        if name.lower() not in SKIPPED_HEADERS},
+            'elapsed': round(elapsed, 4),
+        }
+        try:
+            interaction['body'] = response.content.decode('utf-8')
+        except UnicodeDecodeError:
+            interaction['body_base64'] = b64encode(response.content).decode('ascii')
+        line = json.dumps(interaction, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            self.metrics['recorded'] += 1
+
+    def next_interaction(self, request):
+        """the next recorded response for a request. Raises CassetteMiss if there is none"""
+        key = interaction_key(request.method, request.url)
+        with self.lock:
+            recorded = self.interactions.get(key)
+            if recorded is None:
+                self.metrics['misses'] += 1
+                raise CassetteMiss('no recorded response for %s' % key, request=request)
+            index, interactions = recorded
+            recorded[0] = (index + 1) % len(interactions)
+            self.metrics['replayed'] += 1
+        return interactions[index]
+
+    def close(self):
+        """finish writing the cassette"""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def stats(self):
+        """counters for monitoring"""
+        return dict(self.metrics, mode=self.mode, path=self.path,
+                    requests=len(self.interactions))
+
+class CassetteAdapter(HTTPAdapter):
+    """
+    a transport adapter that records exchanges to a cassette, or replays them from one
+    """
+    def __init__(self, cassette, replay_timing=False, **kwargs):
+        self.cassette = cassette
+        self.replay_timing = replay_timing
+        super(CassetteAdapter, self).__init__(**kwargs)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None): # pylint: disable=too-many-arguments
+        if self.cassette.mode == REPLAY:
+            return self.replay(request, timeout)
+
+        started = time.monotonic()
+        response = super(CassetteAdapter, self).send(request, stream=stream, timeout=timeout,
+                                                     verify=verify, cert=cert, proxies=proxies)
+        # read the body here so the time to download it is recorded too
+        response.content # pylint: disable=pointless-statement
+        self.cassette.record(request, response, time.monotonic() - started)
+        return response
+
+    def replay(self, request, timeout):
+        """build the response from the cassette"""
+        interaction = self.cassette.next_interaction(request)
+        elapsed = interaction['elapsed']
+        if self.replay_timing:
+            read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+            if read_timeout is not None and elapsed > read_timeout:
+                time.sleep(read_timeout)
+                raise requests.ReadTimeout('replayed response took %ss' % elapsed,
+                                           request=request)
+            time.sleep(elapsed)
+
+        raw = HTTPResponse(body=io.BytesIO(interaction['body']),
+                           headers=interaction['headers'],
+                           status=interaction['status'],
+                           reason=interaction['reason'],
+                           preload_content=False)
+        response = self.build_response(request, raw)
+        response.elapsed = timedelta(seconds=elapsed)
+        return response
+
+def create_http_session(mode=OFF, path=None, replay_timing=False, pool_size=10):
+    """
+    Create the requests session used for every request to ZenKey and the carriers
+
+    mode: "off", "record" or "replay"
+    path: the cassette file
+    replay_timing: replayed responses take as long as they did when they were recorded
+    pool_size: the number of connections kept open to each host
+    """
+    if mode == OFF:
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+    elif mode in (RECORD, REPLAY):
+        adapter = CassetteAdapter(Cassette(path, mode), replay_timing, pool_maxsize=pool_size)
+    else:
+        raise ValueError('unknown HTTP cassette mode: %s' % mode)
+
+    session = requests.Session()
+    # the session is shared by every sign-in: never send one user's carrier cookies
+    # with another user's requests
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def cassette_stats(session):
+    """the counters of the session's cassette, or None when there is no cassette"""
+    adapter = session.get_adapter('https://')
+    return adapter.cassette.stats() if isinstance(adapter, CassetteAdapter) else None
+
+http_session = create_http_session() # pylint: disable=invalid-name
+
+def init_http_session(app):
+    """
+    Create the shared requests session, recording or replaying a cassette when the app
+    configuration asks for it
+    """
+    global http_session # pylint: disable=invalid-name,global-statement
+    http_session = create_http_session(app.config['HTTP_CASSETTE_MODE'],
+                                       app.config['HTTP_CASSETTE_PATH'],
+                                       app.config['HTTP_CASSETTE_REPLAY_TIMING'],
+                                       app.config['CARRIER_MAX_CONCURRENT_REQUESTS'])
+    if app.config['HTTP_CASSETTE_MODE'] != OFF:
+        app.logger.warning('%s carrier requests with the cassette %s',
+                           'Recording' if app.config['HTTP_CASSETTE_MODE'] == RECORD
+                           else 'Replaying',
+                           app.config['HTTP_CASSETTE_PATH'])
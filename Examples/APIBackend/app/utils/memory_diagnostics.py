@@ -0,0 +1,257 @@
+from collections import OrderedDict
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None # pylint: disable=invalid-name
+
+# Memory diagnostics for long-running workers.
+# Each sign-in builds Pyoidc clients, messages and keys, so a leak shows up as a worker's
+# RSS creeping up over days. These diagnostics find where the memory goes:
+# - tracemalloc snapshots, kept in memory, with the top allocation sites of a snapshot and
+#   the growth between two snapshots
+# - counts of the live Pyoidc, pyjwkest and requests objects
+# - an RSS threshold: when the worker's RSS goes over it, a snapshot is taken and the
+#   allocation sites that grew the most since the previous snapshot are logged
+# tracemalloc slows down every allocation, so it only runs once a snapshot has been asked
+# for, or from the start with MEMORY_TRACEMALLOC. Each worker process has its own diagnostics.
+
+logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+# the live objects of these packages are counted
+TRACKED_PACKAGES = ('oic', 'jwkest', 'Cryptodome', 'requests', 'urllib3')
+
+# allocations made by the diagnostics themselves
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+GROUP_BY = ('lineno', 'filename', 'traceback')
+
+def rss_bytes():
+    """the current resident set size of this process, or None when it is unknown"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def peak_rss_bytes():
+    """the highest resident set size of this process, or None when it is unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def live_object_counts(packages=TRACKED_PACKAGES):
+    """
+    the number of live objects of each class defined in the packages, largest first
+
+    this walks every object tracked by the garbage collector, so it takes a while on a
+    large heap
+    """
+    counts = {}
+    for obj in gc.get_objects():
+        cls = type(obj)
+        module = getattr(cls, '__module__', None)
+        if isinstance(module, str) and module.split('.', 1)[0] in packages:
+            name = '%s.%s' % (module, cls.__qualname__)
+            counts[name] = counts.get(name, 0) + 1
+    return OrderedDict(sorted(counts.items(), key=lambda item: item[1], reverse=True))
+
+def format_statistic(statistic):
+    """a tracemalloc Statistic or StatisticDiff as a dictionary"""
+    formatted = {
+        'size': statistic.size,
+        'count': statistic.count,
+        'traceback': ['%s:%d' % (frame.filename, frame.lineno)
+                      for frame in statistic.traceback],
+    }
+    if isinstance(statistic, tracemalloc.StatisticDiff):
+        formatted['size_diff'] = statistic.size_diff
+        formatted['count_diff'] = statistic.count_diff
+    return formatted
+
+class MemoryDiagnostics():
+    """
+    tracemalloc snapshots, live object counts and an RSS threshold for one worker process
+
+    frames: the number of frames tracemalloc keeps for each allocation
+    max_snapshots: the number of snapshots kept. The first one is always kept as a baseline
+    rss_threshold: take a snapshot when the RSS goes over this many bytes. 0 disables it
+    rss_step: the threshold goes up by this many bytes each time it is crossed
+    check_interval: the minimum time (in seconds) between two RSS checks
+    snapshot_dir: a directory where the snapshots are also dumped, for offline analysis
+    """
+    def __init__(self, frames=10, max_snapshots=10, rss_threshold=0, rss_step=64 * 1024 * 1024,
+                 check_interval=60, snapshot_dir=None):
+        self.frames = frames
+        self.max_snapshots = max(max_snapshots, 2)
+        self.rss_threshold = rss_threshold
+        self.rss_step = rss_step
+        self.check_interval = check_interval
+        self.snapshot_dir = snapshot_dir
+        # id: (info, snapshot)
+        self.snapshots = OrderedDict()
+        self.next_id = 1
+        self.next_check_at = 0
+        self.lock = threading.Lock()
+        self.metrics = {'snapshots': 0, 'rss_threshold_crossed': 0}
+
+    def start_tracing(self):
+        """start tracing allocations. Returns False if they were already traced"""
+        if tracemalloc.is_tracing():
+            return False
+        tracemalloc.start(self.frames)
+        logger.warning('started tracing memory allocations with %d frames', self.frames)
+        return True
+
+    def stop_tracing(self):
+        """stop tracing allocations and forget the snapshots"""
+        with self.lock:
+            self.snapshots.clear()
+        tracemalloc.stop()
+
+    def take_snapshot(self, reason='manual'):
+        """
+        Take a tracemalloc snapshot, starting to trace allocations if needed, and return
+        its description. A snapshot taken right after tracing starts is nearly empty: the
+        growth shows in the next ones
+        """
+        started_tracing = self.start_tracing()
+        snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+        traced, peak_traced = tracemalloc.get_traced_memory()
+        with self.lock:
+            snapshot_id = self.next_id
+            self.next_id += 1
+            info = {
+                'id': snapshot_id,
+                'taken_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'reason': reason,
+                'started_tracing': started_tracing,
+                'rss': rss_bytes(),
+                'traced': traced,
+                'peak_traced': peak_traced,
+            }
+            self.snapshots[snapshot_id] = (info, snapshot)
+            if len(self.snapshots) > self.max_snapshots:
+                # keep the first snapshot as a baseline and drop the oldest after it
+                del self.snapshots[list(self.snapshots)[1]]
+            self.metrics['snapshots'] += 1
+
+        if self.snapshot_dir:
+            path = os.path.join(self.snapshot_dir,
+                                'memory-%d-%d.tracemalloc' % (os.getpid(), snapshot_id))
+            try:
+                os.makedirs(self.snapshot_dir, exist_ok=True)
+                snapshot.dump(path)
+                info['path'] = path
+            except OSError:
+                logger.exception('unable to dump the memory snapshot %s', path)
+        return info
+
+    def get_snapshot(self, snapshot_id):
+        """the snapshot with this ID. Raises KeyError if it was dropped or never existed"""
+        with self.lock:
+            return self.snapshots[snapshot_id]
+
+    def previous_snapshot_id(self, snapshot_id):
+        """the ID of the snapshot taken before this one, or None"""
+        with self.lock:
+            earlier = [other for other in self.snapshots if other < snapshot_id]
+        return earlier[-1] if earlier else None
+
+    def top_sites(self, snapshot_id, group_by='lineno', limit=20):
+        """the allocation sites holding the most memory in a snapshot"""
+        _, snapshot = self.get_snapshot(snapshot_id)
+        return [format_statistic(statistic)
+                for statistic in snapshot.statistics(group_by)[:limit]]
+
+    def compare(self, snapshot_id, base_id, group_by='lineno', limit=20):
+        """the allocation sites that grew the most between the base snapshot and this one"""
+        _, snapshot = self.get_snapshot(snapshot_id)
+        _, base = self.get_snapshot(base_id)
+        return [format_statistic(statistic)
+                for statistic in snapshot.compare_to(base, group_by)[:limit]]
+
+    def check_rss(self):
+        """
+        Take a snapshot and log the top growth when the RSS is over the threshold.
+        Called after every request: the RSS is read at most once per check_interval
+        """
+        now = time.monotonic()
+        if self.rss_threshold <= 0 or now < self.next_check_at:
+            return
+        with self.lock:
+            if now < self.next_check_at:
+                return
+            self.next_check_at = now + self.check_interval
+        rss = rss_bytes()
+        if rss is None or rss <= self.rss_threshold:
+            return
+
+        threshold = self.rss_threshold
+        self.rss_threshold = rss + self.rss_step
+        self.metrics['rss_threshold_crossed'] += 1
+        info = self.take_snapshot('rss')
+        previous_id = self.previous_snapshot_id(info['id'])
+        if previous_id is None:
+            logger.warning('RSS %d MB is over %d MB: started tracing memory allocations, the '
+                           'next snapshot will show the growth', rss >> 20, threshold >> 20)
+            return
+        growth = self.compare(info['id'], previous_id, limit=10)
+        logger.warning('RSS %d MB is over %d MB, top growth since snapshot %d:\n%s',
+                       rss >> 20, threshold >> 20, previous_id,
+                       '\n'.join('%+d KB (%+d blocks) %s' % (site['size_diff'] >> 10,
+                                                             site['count_diff'],
+                                                             site['traceback'][0])
+                                 for site in growth))
+
+    def stats(self):
+        """the memory of this worker and the snapshots kept"""
+        traced, peak_traced = tracemalloc.get_traced_memory()
+        with self.lock:
+            snapshots = [info for info, _ in self.snapshots.values()]
+        return dict(self.metrics,
+                    rss=rss_bytes(),
+                    peak_rss=peak_rss_bytes(),
+                    rss_threshold=self.rss_threshold,
+                    tracing=tracemalloc.is_tracing(),
+                    traced=traced,
+                    peak_traced=peak_traced,
+                    gc_counts=gc.get_count(),
+                    gc_objects=len(gc.get_objects()),
+                    snapshots=snapshots)
+
+memory_diagnostics = MemoryDiagnostics() # pylint: disable=invalid-name
+
+def init_memory_diagnostics(app):
+    """
+    Configure the memory diagnostics from the app configuration, and check the RSS after
+    each request when an RSS threshold is set
+    """
+    global memory_diagnostics # pylint: disable=invalid-name,global-statement
+    memory_diagnostics = MemoryDiagnostics(
+        frames=app.config['MEMORY_TRACEMALLOC_FRAMES'],
+        rss_threshold=app.config['MEMORY_RSS_THRESHOLD_MB'] * 1024 * 1024,
+        rss_step=app.config['MEMORY_RSS_STEP_MB'] * 1024 * 1024,
+        check_interval=app.config['MEMORY_RSS_CHECK_INTERVAL'],
+        snapshot_dir=app.config['MEMORY_SNAPSHOT_DIR'])
+    if app.config['MEMORY_TRACEMALLOC']:
+        memory_diagnostics.start_tracing()
+
+    if memory_diagnostics.rss_threshold > 0:
+        @app.after_request
+        def check_rss(response): # pylint: disable=unused-variable
+            memory_diagnostics.check_rss()
+            return response
@@ -0,0 +1,307 @@
+import hashlib
+import json
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+
+# The refresh tokens we issue with the short-lived access tokens.
+# A refresh token is an opaque random string. Only its SHA-256 hash is stored, so a leaked
+# store can't be used to refresh anyone's session, and looking a token up is a single
+# index lookup in either store.
+# - rotation: each refresh token can be used once, and is replaced by a new one
+# - families: a token and the ones that replace it form a family, one per sign-in
+# - reuse detection: a token that is used again after it has been rotated has probably been
+#   stolen, so its whole family is revoked and the user has to sign in again
+# - sweeping: expired tokens are deleted every sweep_interval seconds
+# Used tokens are kept until they expire, to detect their reuse.
+# With several worker processes, use the SQLite store so every worker sees the same tokens.
+
+logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+def new_refresh_token():
+    """a new opaque refresh token"""
+    return secrets.token_urlsafe(32)
+
+def hash_token(token):
+    """
+    the key a refresh token is stored under. The tokens are random, so a plain hash
+    can't be reversed
+    """
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+class RefreshTokenRecord():
+    """a stored refresh token"""
+    __slots__ = ('family_id', 'user', 'expires_at', 'used')
+
+    def __init__(self, family_id, user, expires_at):
+        self.family_id = family_id
+        self.user = user
+        self.expires_at = expires_at
+        self.used = False
+
+class MemoryRefreshTokenStore():
+    """
+    An in-memory, per-process refresh token store
+
+    sweep_interval: the time (in seconds) between two sweeps of the expired tokens
+    """
+    name = 'memory'
+
+    def __init__(self, sweep_interval=60):
+        self.sweep_interval = sweep_interval
+        # token hash: RefreshTokenRecord
+        self.tokens = {}
+        # family ID: the hashes of its tokens
+        self.families = {}
+        self.next_sweep = time.time() + sweep_interval
+        self.lock = threading.Lock()
+        self.metrics = {'issued': 0, 'rotated': 0, 'rejected': 0, 'reuses': 0,
+                        'families_revoked': 0, 'expired': 0}
+
+    def _add(self, family_id, user, ttl, now):
+        token = new_refresh_token()
+        key = hash_token(token)
+        self.tokens[key] = RefreshTokenRecord(family_id, user, now + ttl)
+        self.families.setdefault(family_id, set()).add(key)
+        self.metrics['issued'] += 1
+        return token
+
+    def _revoke_family(self, family_id):
+        for key in self.families.pop(family_id, ()):
+            del self.tokens[key]
+        self.metrics['families_revoked'] += 1
+
+    def _sweep(self, now):
+        """delete the expired tokens, when a sweep is due"""
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + self.sweep_interval
+        expired = [key for key, record in self.tokens.items() if record.expires_at <= now]
+        for key in expired:
+            record = self.tokens.pop(key)
+            family = self.families[record.family_id]
+            family.discard(key)
+            if not family:
+                del self.families[record.family_id]
+        self.metrics['expired'] += len(expired)
+
+    def issue(self, user, ttl):
+        """
+        Issue a refresh token that starts a new family
+        user: the user attributes the access tokens are created from
+        ttl: how long (in seconds) the token can be used
+        """
+        now = time.time()
+        with self.lock:
+            self._sweep(now)
+            return self._add(secrets.token_hex(8), user, ttl, now)
+
+    def rotate(self, token, ttl):
+        """
+        Use a refresh token: returns a new refresh token, in the same family, and the user
+        attributes, or None if the token is unknown, expired or has already been used
+        """
+        key = hash_token(token)
+        now = time.time()
+        with self.lock:
+            self._sweep(now)
+            record = self.tokens.get(key)
+            if record is None or record.expires_at <= now:
+                self.metrics['rejected'] += 1
+                return None
+            if record.used:
+                self.metrics['reuses'] += 1
+                self._revoke_family(record.family_id)
+                logger.warning('refresh token reused, revoked its family %s', record.family_id)
+                return None
+            record.used = True
+            self.metrics['rotated'] += 1
+            return self._add(record.family_id, record.user, ttl, now), record.user
+
+    def revoke(self, token, user_id):
+        """
+        Revoke the family of a refresh token, e.g. when the user signs out
+        Returns False if the token is unknown or belongs to another user than user_id
+        """
+        with self.lock:
+            record = self.tokens.get(hash_token(token))
+            if record is None or record.user.get('user_id') != user_id:
+                return False
+            self._revoke_family(record.family_id)
+            return True
+
+    def stats(self):
+        """counters for monitoring"""
+        return dict(self.metrics, backend=self.name, tokens=len(self.tokens),
+                    families=len(self.families))
+
+class SQLiteRefreshTokenStore():
+    """
+    A refresh token store in a SQLite database file shared by every worker on the host
+
+    sweep_interval: the time (in seconds) between two sweeps of the expired tokens, by
+                    each worker
+    """
+    name = 'sqlite'
+
+    def __init__(self, path, sweep_interval=60):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self.next_sweep = time.time() + sweep_interval
+        # sqlite3 connections can't be shared between threads
+        self.local = threading.local()
+        self.metrics = {'issued': 0, 'rotated': 0, 'rejected': 0, 'reuses': 0,
+                        'families_revoked': 0, 'expired': 0}
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS refresh_tokens '
+                           '(token_hash BLOB PRIMARY KEY, family_id TEXT NOT NULL, '
+                           'user TEXT NOT NULL, expires_at REAL NOT NULL, '
+                           'used INTEGER NOT NULL DEFAULT 0)')
+        connection.execute('CREATE INDEX IF NOT EXISTS refresh_tokens_family_id '
+                           'ON refresh_tokens (family_id)')
+        connection.execute('CREATE INDEX IF NOT EXISTS refresh_tokens_expires_at '
+                           'ON refresh_tokens (expires_at)')
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # autocommit mode: transactions are started explicitly
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def _add(self, connection, family_id, user, ttl, now):
+        token = new_refresh_token()
+        connection.execute('INSERT INTO refresh_tokens (token_hash, family_id, user, expires_at) '
+                           'VALUES (?, ?, ?, ?)',
+                           (hash_token(token), family_id, user, now + ttl))
+        self.metrics['issued'] += 1
+        return token
+
+    def _revoke_family(self, connection, family_id):
+        connection.execute('DELETE FROM refresh_tokens WHERE family_id = ?', (family_id,))
+        self.metrics['families_revoked'] += 1
+
+    def _sweep(self, connection, now):
+        """delete the expired tokens, when a sweep is due"""
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + self.sweep_interval
+        self.metrics['expired'] += connection.execute(
+            'DELETE FROM refresh_tokens WHERE expires_at <= ?', (now,)).rowcount
+
+    def _transaction(self, operation):
+        """run operation(connection, now) in a write transaction"""
+        now = time.time()
+        connection = self._connection()
+        # lock the database for writing so two workers can't both rotate the same token
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            self._sweep(connection, now)
+            result = operation(connection, now)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return result
+
+    def issue(self, user, ttl):
+        """
+        Issue a refresh token that starts a new family
+        user: the user attributes the access tokens are created from
+        ttl: how long (in seconds) the token can be used
+        """
+        return self._transaction(lambda connection, now: self._add(
+            connection, secrets.token_hex(8), json.dumps(user), ttl, now))
+
+    def rotate(self, token, ttl):
+        """
+        Use a refresh token: returns a new refresh token, in the same family, and the user
+        attributes, or None if the token is unknown, expired or has already been used
+        """
+        key = hash_token(token)
+
+        def rotate_token(connection, now):
+            row = connection.execute('SELECT family_id, user, expires_at, used '
+                                     'FROM refresh_tokens WHERE token_hash = ?',
+                                     (key,)).fetchone()
+            if row is None or row[2] <= now:
+                self.metrics['rejected'] += 1
+                return None
+            family_id, user, _, used = row
+            if used:
+                self.metrics['reuses'] += 1
+                self._revoke_family(connection, family_id)
+                logger.warning('refresh token reused, revoked its family %s', family_id)
+                return None
+            connection.execute('UPDATE refresh_tokens SET used = 1 WHERE token_hash = ?', (key,))
+            self.metrics['rotated'] += 1
+            return self._add(connection, family_id, user, ttl, now), json.loads(user)
+
+        return self._transaction(rotate_token)
+
+    def revoke(self, token, user_id):
+        """
+        Revoke the family of a refresh token, e.g. when the user signs out
+        Returns False if the token is unknown or belongs to another user than user_id
+        """
+        def revoke_family(connection, _):
+            row = connection.execute('SELECT family_id, user FROM refresh_tokens '
+                                     'WHERE token_hash = ?', (hash_token(token),)).fetchone()
+            if row is None or json.loads(row[1]).get('user_id') != user_id:
+                return False
+            self._revoke_family(connection, row[0])
+            return True
+
+        return self._transaction(revoke_family)
+
+    def stats(self):
+        """counters for monitoring (the counters are for this process only)"""
+        tokens, families = self._connection().execute(
+            'SELECT COUNT(*), COUNT(DISTINCT family_id) FROM refresh_tokens').fetchone()
+        return dict(self.metrics, backend=self.name, tokens=tokens, families=families)
+
+refresh_token_store = MemoryRefreshTokenStore() # pylint: disable=invalid-name
+
+def init_refresh_token_store(app):
+    """
+    Create the refresh token store selected by the app configuration
+    """
+    global refresh_token_store # pylint: disable=invalid-name,global-statement
+    backend = app.config['REFRESH_TOKEN_STORE_BACKEND']
+    sweep_interval = app.config['REFRESH_TOKEN_SWEEP_INTERVAL']
+    if backend == MemoryRefreshTokenStore.name:
+        refresh_token_store = MemoryRefreshTokenStore(sweep_interval)
+    elif backend == SQLiteRefreshTokenStore.name:
+        refresh_token_store = SQLiteRefreshTokenStore(app.config['REFRESH_TOKEN_STORE_PATH'],
+                                                      sweep_interval)
+    else:
+        raise ValueError('unknown refresh token store backend: %s' % backend)
+    app.logger.info('Using the %s refresh token store', refresh_token_store.name)
+
+def issue_refresh_token(user, expiration_time):
+    """
+    Issue a refresh token for a user, valid for expiration_time (a timedelta)
+    """
+    # in production you would store the user's ID and look the user up on refresh
+    return refresh_token_store.issue(user.to_dict(), expiration_time.total_seconds())
+
+def rotate_refresh_token(token, expiration_time):
+    """
+    Exchange a refresh token for a new one, valid for expiration_time (a timedelta)
+    Returns the new token and the user attributes, or None if the token can't be used
+    """
+    return refresh_token_store.rotate(token, expiration_time.total_seconds())
+
+def revoke_refresh_token(token, user_id):
+    """
+    Revoke a refresh token and every token of its family, if it was issued to user_id
+    Returns False if the token is unknown or belongs to another user
+    """
+    if user_id is None:
+        return False
+    return refresh_token_store.revoke(token, user_id)
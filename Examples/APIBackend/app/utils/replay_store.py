@@ -0,0 +1,219 @@
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+
+# A record of the id_token nonces and JWT IDs (jti) we have already accepted, so the same
+# id_token can't be used to sign in twice.
+# Entries only need to be remembered until the id_token expires. The in-memory store
+# expires them with a hashed timer wheel: an entry goes into the slot for the second it
+# expires, and advancing the clock clears the slots it passes. Inserting and expiring are
+# both O(1) and there is no per-entry timer or heap.
+# With several worker processes, use the SQLite store so every worker sees the same set.
+# An id_token that stays valid for longer than the store can remember it is rejected
+# rather than forgotten early, which would let it be replayed once it's forgotten.
+
+def replay_key(issuer, claim, value):
+    """
+    A short, fixed-size key for a claim value. Hashing keeps the memory use per entry
+    constant however long the carrier's nonces are
+    """
+    key = '\0'.join((issuer or '', claim, value))
+    return hashlib.sha256(key.encode('utf-8')).digest()[:16]
+
+class ReplayWindowExceeded(Exception):
+    """the id_token stays valid for longer than the replay store remembers its values"""
+
+class TimerWheelReplayStore():
+    """
+    An in-memory, per-process replay store
+
+    max_ttl: the longest time (in seconds) an entry is remembered; this is the span of the wheel
+    resolution: the width (in seconds) of each wheel slot
+    max_entries: the memory bound. When the store is full, the entries closest to expiring
+                 are evicted early and counted in the "evictions" metric
+    """
+    name = 'memory'
+
+    def __init__(self, max_ttl=7200, resolution=1, max_entries=100000):
+        self.resolution = resolution
+        self.max_ttl = max_ttl
+        self.max_entries = max_entries
+        # one more slot than the span, so a new entry never lands in the current slot
+        self.slot_count = int(math.ceil(max_ttl / resolution)) + 1
+        self.slots = [set() for _ in range(self.slot_count)]
+        # key: tick the entry expires at
+        self.entries = {}
+        self.current_tick = self._tick(time.monotonic())
+        self.lock = threading.Lock()
+        self.metrics = {'added': 0, 'replays': 0, 'expired': 0, 'evictions': 0}
+
+    def _tick(self, now):
+        return int(now // self.resolution)
+
+    def _advance(self, now_tick):
+        """expire the entries in every slot the clock has passed"""
+        if now_tick - self.current_tick >= self.slot_count:
+            # the whole wheel has turned: everything has expired
+            self.metrics['expired'] += len(self.entries)
+            self.entries.clear()
+            for slot in self.slots:
+                slot.clear()
+        else:
+            for tick in range(self.current_tick + 1, now_tick + 1):
+                self._clear_slot(tick % self.slot_count, 'expired')
+        self.current_tick = max(self.current_tick, now_tick)
+
+    def _clear_slot(self, index, metric):
+        slot = self.slots[index]
+        if slot:
+            self.metrics[metric] += len(slot)
+            for key in slot:
+                del self.entries[key]
+            slot.clear()
+
+    def _evict(self):
+        """make room by dropping the slot that is closest to expiring"""
+        for offset in range(1, self.slot_count):
+            index = (self.current_tick + offset) % self.slot_count
+            if self.slots[index]:
+                self._clear_slot(index, 'evictions')
+                return
+
+    def add(self, key, ttl):
+        """
+        Remember a key for ttl seconds
+        Returns False if the key has already been seen and hasn't expired
+        """
+        ticks = min(max(int(math.ceil(ttl / self.resolution)), 1), self.slot_count - 1)
+        with self.lock:
+            self._advance(self._tick(time.monotonic()))
+            if key in self.entries:
+                self.metrics['replays'] += 1
+                return False
+            if len(self.entries) >= self.max_entries:
+                self._evict()
+            expires_at = self.current_tick + ticks
+            self.entries[key] = expires_at
+            self.slots[expires_at % self.slot_count].add(key)
+            self.metrics['added'] += 1
+            return True
+
+    def stats(self):
+        """counters for monitoring"""
+        return dict(self.metrics, backend=self.name, entries=len(self.entries),
+                    max_entries=self.max_entries)
+
+class SQLiteReplayStore():
+    """
+    A replay store in a SQLite database file shared by every worker on the host
+
+    Expired rows are purged every purge_interval inserts, and the oldest rows are evicted
+    when there are more than max_entries
+    """
+    name = 'sqlite'
+
+    def __init__(self, path, max_ttl=7200, max_entries=1000000, purge_interval=1000):
+        self.path = path
+        self.max_ttl = max_ttl
+        self.max_entries = max_entries
+        self.purge_interval = purge_interval
+        # sqlite3 connections can't be shared between threads
+        self.local = threading.local()
+        self.metrics = {'added': 0, 'replays': 0, 'expired': 0, 'evictions': 0}
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS seen_tokens '
+                           '(key BLOB PRIMARY KEY, expires_at REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS seen_tokens_expires_at '
+                           'ON seen_tokens (expires_at)')
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # autocommit mode: transactions are started explicitly in add()
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def add(self, key, ttl):
+        """
+        Remember a key for ttl seconds
+        Returns False if the key has already been seen and hasn't expired
+        """
+        now = time.time()
+        ttl = min(max(ttl, 1), self.max_ttl)
+        connection = self._connection()
+        # lock the database for writing so two workers can't both add the same key
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM seen_tokens WHERE key = ? AND expires_at <= ?',
+                               (key, now))
+            added = connection.execute(
+                'INSERT OR IGNORE INTO seen_tokens (key, expires_at) VALUES (?, ?)',
+                (key, now + ttl)).rowcount == 1
+            if added:
+                self.metrics['added'] += 1
+                if self.metrics['added'] % self.purge_interval == 0:
+                    self._purge(connection, now)
+            else:
+                self.metrics['replays'] += 1
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return added
+
+    def _purge(self, connection, now):
+        self.metrics['expired'] += connection.execute(
+            'DELETE FROM seen_tokens WHERE expires_at <= ?', (now,)).rowcount
+        self.metrics['evictions'] += connection.execute(
+            'DELETE FROM seen_tokens WHERE key IN (SELECT key FROM seen_tokens '
+            'ORDER BY expires_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,)).rowcount
+
+    def stats(self):
+        """counters for monitoring (the counters are for this process only)"""
+        entries = self._connection().execute('SELECT COUNT(*) FROM seen_tokens').fetchone()[0]
+        return dict(self.metrics, backend=self.name, entries=entries,
+                    max_entries=self.max_entries)
+
+replay_store = TimerWheelReplayStore() # pylint: disable=invalid-name
+
+def init_replay_store(app):
+    """
+    Create the replay store selected by the app configuration
+    """
+    global replay_store # pylint: disable=invalid-name,global-statement
+    backend = app.config['REPLAY_STORE_BACKEND']
+    if backend == TimerWheelReplayStore.name:
+        replay_store = TimerWheelReplayStore(max_ttl=app.config['REPLAY_STORE_MAX_TTL'],
+                                             max_entries=app.config['REPLAY_STORE_MAX_ENTRIES'])
+    elif backend == SQLiteReplayStore.name:
+        replay_store = SQLiteReplayStore(app.config['REPLAY_STORE_PATH'],
+                                         max_ttl=app.config['REPLAY_STORE_MAX_TTL'],
+                                         max_entries=app.config['REPLAY_STORE_MAX_ENTRIES'])
+    else:
+        raise ValueError('unknown replay store backend: %s' % backend)
+    app.logger.info('Using the %s replay store', replay_store.name)
+
+def record_id_token(id_token, leeway=0):
+    """
+    Remember the nonce and jti of an id_token until it expires (plus the clock skew
+    allowed when it was verified)
+    Returns False if either of them has been used before, and raises ReplayWindowExceeded
+    if the id_token expires later than the store can remember them
+    """
+    issuer = id_token.get('iss')
+    ttl = id_token.get('exp', 0) + leeway - time.time()
+    if ttl > replay_store.max_ttl:
+        raise ReplayWindowExceeded('ID token expires in %d seconds, longer than the %d seconds '
+                                   'it can be remembered' % (ttl, replay_store.max_ttl))
+    first_use = True
+    for claim in ('nonce', 'jti'):
+        value = id_token.get(claim)
+        if value:
+            # record both values even if the first is a replay
+            first_use = replay_store.add(replay_key(issuer, claim, value), ttl) and first_use
+    return first_use
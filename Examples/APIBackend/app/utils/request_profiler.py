@@ -0,0 +1,208 @@
+import cProfile
+import hmac
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+# Opt-in profiling of single requests, and a log of the slow ones.
+# The middleware wraps the WSGI app only when profiling or the slow request log is configured,
+# so requests pay nothing for it otherwise. A request is profiled when it has the profiler
+# header set to the profiler secret, or at random for a fraction of the requests:
+# - "sampling" mode samples the request thread's stack every millisecond and writes the
+#   counts as folded stacks (.folded), the input of flamegraph.pl, speedscope and similar tools
+# - "cprofile" mode runs cProfile and writes its stats (.prof) for pstats or snakeviz
+# The time spent in each phase of a request (like the carrier token request) is recorded with
+# phase() and record_phase(), and logged with the slow requests.
+
+logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+SAMPLING = 'sampling'
+CPROFILE = 'cprofile'
+
+# the phases of the request being handled by this thread, or None outside of the middleware
+_local = threading.local() # pylint: disable=invalid-name
+
+def record_phase(name, seconds):
+    """add the time spent in a phase to the current request"""
+    phases = getattr(_local, 'phases', None)
+    if phases is not None:
+        phases.append((name, seconds))
+
+class phase(): # pylint: disable=invalid-name
+    """
+    a context manager that records the time spent in a phase of the current request
+    """
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_phase(self.name, time.perf_counter() - self.started)
+
+def frame_name(frame):
+    """a frame as "directory/file.py:function:line", where line is the function's first line"""
+    code = frame.f_code
+    filename = '/'.join(code.co_filename.replace('\\', '/').split('/')[-2:])
+    return '%s:%s:%d' % (filename, code.co_name, code.co_firstlineno)
+
+class StackSampler():
+    """
+    samples the stack of one thread from a background thread, and counts the folded stacks
+    """
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        """start sampling"""
+        self.thread.start()
+
+    def stop(self):
+        """stop sampling and wait for the sampler thread"""
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id) # pylint: disable=protected-access
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame).replace(';', ':'))
+                frame = frame.f_back
+            if stack:
+                folded = ';'.join(reversed(stack))
+                self.stacks[folded] = self.stacks.get(folded, 0) + 1
+
+    def write(self, path):
+        """write the samples in the folded stack format: "root;...;leaf count" per line"""
+        with open(path, 'w') as profile_file:
+            for stack, count in sorted(self.stacks.items()):
+                profile_file.write('%s %d\n' % (stack, count))
+
+class RequestProfiler():
+    """
+    WSGI middleware that profiles the requests that ask for it, or a random sample of them,
+    and logs the requests that took longer than slow_request_seconds
+
+    secret: requests with the header set to this value are profiled. None disables the header
+    sample_rate: the fraction of the other requests that are profiled
+    slow_request_seconds: 0 disables the slow request log
+    """
+    def __init__(self, wsgi_app, output_dir='profiles', header='X-Profile-Request', secret=None,
+                 sample_rate=0, mode=SAMPLING, slow_request_seconds=0):
+        if mode not in (SAMPLING, CPROFILE):
+            raise ValueError('unknown profiler mode: %s' % mode)
+        self.wsgi_app = wsgi_app
+        self.output_dir = output_dir
+        # the WSGI environ key of the header
+        self.header_key = 'HTTP_' + header.upper().replace('-', '_')
+        self.secret = secret.encode('utf-8') if secret else None
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.slow_request_seconds = slow_request_seconds
+
+    def should_profile(self, environ):
+        """profile requests with the secret header, and a random sample of the others"""
+        if self.secret is not None and self.header_key in environ:
+            return hmac.compare_digest(environ[self.header_key].encode('utf-8'), self.secret)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, environ, start_response):
+        status = []
+        def capture_status(response_status, headers, exc_info=None):
+            status.append(response_status.split(' ', 1)[0])
+            return start_response(response_status, headers, exc_info)
+
+        profiler = None
+        if self.should_profile(environ):
+            if self.mode == CPROFILE:
+                profiler = cProfile.Profile()
+                try:
+                    profiler.enable()
+                except ValueError:
+                    # some Python versions allow one cProfile at a time in the whole process
+                    logger.warning('skipped profiling: another request is being profiled')
+                    profiler = None
+            else:
+                profiler = StackSampler(threading.get_ident())
+                profiler.start()
+
+        _local.phases = []
+        started = time.perf_counter()
+        try:
+            return self.wsgi_app(environ, capture_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            phases = _local.phases
+            _local.phases = None
+            profile_path = None
+            if profiler is not None:
+                profile_path = self.write_profile(profiler, environ, elapsed)
+            if profile_path is not None or (self.slow_request_seconds and
+                                            elapsed > self.slow_request_seconds):
+                self.log_request(environ, status, elapsed, phases, profile_path)
+
+    def write_profile(self, profiler, environ, elapsed):
+        """save the profile of a request, and return its path"""
+        if self.mode == CPROFILE:
+            profiler.disable()
+        else:
+            profiler.stop()
+        path = '%s-%dms-%s-%s-%d.%s' % (
+            time.strftime('%Y%m%dT%H%M%S'),
+            elapsed * 1000,
+            environ.get('REQUEST_METHOD', ''),
+            environ.get('PATH_INFO', '').strip('/').replace('/', '_') or 'index',
+            os.getpid(),
+            'prof' if self.mode == CPROFILE else 'folded')
+        path = os.path.join(self.output_dir, path)
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            if self.mode == CPROFILE:
+                profiler.dump_stats(path)
+            else:
+                profiler.write(path)
+        except OSError:
+            logger.exception('unable to write the profile %s', path)
+            return None
+        return path
+
+    def log_request(self, environ, status, elapsed, phases, profile_path):
+        """log a slow or profiled request with the time spent in each phase"""
+        breakdown = ', '.join('%s %.1f ms' % (name, seconds * 1000) for name, seconds in phases)
+        logger.warning('%s request %s %s %s took %.1f ms (%s)%s',
+                       'profiled' if profile_path else 'slow',
+                       environ.get('REQUEST_METHOD'),
+                       environ.get('PATH_INFO'),
+                       status[0] if status else '-',
+                       elapsed * 1000,
+                       breakdown or 'no phases recorded',
+                       ': %s' % profile_path if profile_path else '')
+
+def init_request_profiler(app):
+    """
+    Wrap the WSGI app with the request profiler, when the app configuration enables
+    profiling or the slow request log
+    """
+    if not (app.config['PROFILER_SECRET'] or app.config['PROFILER_SAMPLE_RATE'] or
+            app.config['SLOW_REQUEST_SECONDS']):
+        return
+    app.wsgi_app = RequestProfiler(app.wsgi_app,
+                                   output_dir=app.config['PROFILER_OUTPUT_DIR'],
+                                   header=app.config['PROFILER_HEADER'],
+                                   secret=app.config['PROFILER_SECRET'],
+                                   sample_rate=app.config['PROFILER_SAMPLE_RATE'],
+                                   mode=app.config['PROFILER_MODE'],
+                                   slow_request_seconds=app.config['SLOW_REQUEST_SECONDS'])
@@ -0,0 +1,91 @@
+import re
+from werkzeug.exceptions import BadRequest
+
+# Declarative request schemas for the routes.
+# A route declares the parameters it reads, in groups of required and optional ones, and the
+# schema is compiled once, at import, into a table of parameter: (group, parser). Validating
+# a request reads the body once (JSON, or the form when there is no JSON), parses each
+# parameter with its parser, and returns a dictionary per group. Every problem with the
+# request is reported in a single 400 error.
+
+# ASCII digits only: \d also matches other scripts' digits, which no carrier uses
+MCCMNC = re.compile(r'[0-9]{6}')
+
+def parse_string(name, value):
+    """a string parameter. Numbers are accepted and converted"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    raise ValueError('%s must be a string' % name)
+
+def parse_mccmnc(name, value):
+    """a mobile country and network code: 6 digits, as a string"""
+    mccmnc = parse_string(name, value)
+    if not MCCMNC.fullmatch(mccmnc):
+        raise ValueError('%s is not a valid mccmnc' % mccmnc)
+    return mccmnc
+
+def parse_acr_values(name, value):
+    """space delimited ACR values, as a list"""
+    if isinstance(value, list) and all(isinstance(acr, str) for acr in value):
+        return value
+    return parse_string(name, value).split()
+
+# the parsers of the parameters that aren't plain strings
+PARSERS = {
+    'mccmnc': parse_mccmnc,
+    'acr_values': parse_acr_values,
+}
+
+class ParamGroup():
+    """parameters that are returned together"""
+    def __init__(self, required=(), optional=()):
+        self.required = tuple(required)
+        self.optional = tuple(optional)
+
+class RequestSchema():
+    """
+    validates the parameters of a request and returns a dictionary for each group
+    of parameters, in order
+    """
+    def __init__(self, *groups):
+        self.group_count = len(groups)
+        # (name, group index, parser, required) for every parameter
+        self.params = tuple((name, index, PARSERS.get(name, parse_string), required)
+                            for index, group in enumerate(groups)
+                            for required, names in ((True, group.required),
+                                                    (False, group.optional))
+                            for name in names)
+
+    @staticmethod
+    def request_body(request):
+        """the JSON body of the request, or its form"""
+        body = request.get_json()
+        if not body:
+            return request.form
+        if not isinstance(body, dict):
+            raise BadRequest('the request body must be a JSON object')
+        return body
+
+    def validate(self, request):
+        """
+        Returns a tuple with a dictionary of the parsed parameters for each group.
+        Raises BadRequest with every missing or invalid parameter
+        """
+        body = self.request_body(request)
+        groups = tuple({} for _ in range(self.group_count))
+        errors = []
+        for name, index, parse, required in self.params:
+            value = body.get(name)
+            if value is None:
+                if required:
+                    errors.append('%s param is missing' % name)
+                continue
+            try:
+                groups[index][name] = parse(name, value)
+            except ValueError as error:
+                errors.append(str(error))
+        if errors:
+            raise BadRequest('; '.join(errors))
+        return groups
@@ -0,0 +1,127 @@
+from flask import current_app, json, request
+
+try:
+    import msgpack
+except ImportError: # pragma: no cover - msgpack is an optional dependency
+    msgpack = None # pylint: disable=invalid-name
+
+try:
+    import cbor2
+except ImportError: # pragma: no cover - cbor2 is an optional dependency
+    cbor2 = None # pylint: disable=invalid-name
+
+# The encodings of the API responses, negotiated with the Accept request header.
+# Every route and the error handler build their response with respond(), which encodes the
+# same payload as JSON (the default), or as MessagePack or CBOR for clients that ask for
+# them: smaller bodies than JSON, and faster to parse on the device. The binary formats are
+# enabled when their optional package is installed. Values that JSON can't represent
+# natively, like dates, are converted the same way as in the JSON responses.
+
+class JSONFormat:
+    """JSON, encoded by the app's JSON backend like jsonify"""
+    name = 'json'
+    mimetypes = ('application/json',)
+    available = True
+
+    @staticmethod
+    def dumps(body):
+        """serialize the body to bytes"""
+        return (json.dumps(body, separators=(',', ':')) + '\n').encode('utf-8')
+
+def to_builtin(value):
+    """convert a value the binary encoders don't know, like a date, as the JSON encoder does"""
+    return current_app.json_encoder().default(value)
+
+class MessagePackFormat:
+    """MessagePack, with the msgpack package"""
+    name = 'msgpack'
+    mimetypes = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+    package = 'msgpack'
+    available = msgpack is not None
+
+    @staticmethod
+    def dumps(body):
+        """serialize the body to bytes"""
+        return msgpack.packb(body, default=to_builtin, use_bin_type=True)
+
+class CBORFormat:
+    """CBOR, with the cbor2 package"""
+    name = 'cbor'
+    mimetypes = ('application/cbor',)
+    package = 'cbor2'
+    available = cbor2 is not None
+
+    @staticmethod
+    def dumps(body):
+        """serialize the body to bytes"""
+        return cbor2.dumps(body, default=lambda encoder, value: encoder.encode(to_builtin(value)))
+
+RESPONSE_FORMATS = {
+    JSONFormat.name: JSONFormat,
+    MessagePackFormat.name: MessagePackFormat,
+    CBORFormat.name: CBORFormat,
+}
+
+def get_response_formats(names='auto'):
+    """
+    Pick the response formats by name, as a comma separated list. "auto" is JSON and every
+    binary format whose package is installed. JSON is always first
+    """
+    if names == 'auto':
+        return [response_format for response_format in RESPONSE_FORMATS.values()
+                if response_format.available]
+    formats = [JSONFormat]
+    for name in names.split(','):
+        name = name.strip()
+        if name == JSONFormat.name or not name:
+            continue
+        try:
+            response_format = RESPONSE_FORMATS[name]
+        except KeyError:
+            raise ValueError('unknown response format: %s' % name)
+        if not response_format.available:
+            raise ImportError('the %s response format requires the %s package'
+                              % (name, response_format.package))
+        formats.append(response_format)
+    return formats
+
+def build_format_table(formats):
+    """mimetype: format, in order of preference"""
+    return {mimetype: response_format
+            for response_format in formats
+            for mimetype in response_format.mimetypes}
+
+format_table = build_format_table(get_response_formats()) # pylint: disable=invalid-name
+
+def negotiate_format():
+    """
+    the mimetype and format the client accepts, JSON when it accepts any or none of them
+    """
+    mimetype = request.accept_mimetypes.best_match(list(format_table), 'application/json')
+    return mimetype, format_table[mimetype]
+
+def encode_body(body):
+    """the body encoded in the format the client accepts, and its mimetype"""
+    mimetype, response_format = negotiate_format()
+    return response_format.dumps(body), mimetype
+
+def respond(body):
+    """
+    A response with the body encoded in the format the client accepts. Use it like jsonify:
+    return respond({...}), 201
+    """
+    data, mimetype = encode_body(body)
+    response = current_app.response_class(data, mimetype=mimetype)
+    # the body depends on the Accept header
+    response.vary.add('Accept')
+    return response
+
+def init_response_formats(app):
+    """
+    Enable the response formats named in the app configuration
+    """
+    global format_table # pylint: disable=invalid-name,global-statement
+    formats = get_response_formats(app.config['RESPONSE_FORMATS'])
+    format_table = build_format_table(formats)
+    app.logger.info('Using the %s response formats',
+                    ', '.join(response_format.name for response_format in formats))
@@ -0,0 +1,116 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+from werkzeug.exceptions import GatewayTimeout
+
+# Auth codes can only be used once. When a mobile client times out and retries
+# /auth/zenkey-signin with the same code, the retry would reach the carrier's token endpoint
+# with a used code and fail, sending the user back to the start of the flow.
+# This cache remembers each sign-in result for a short time so a retry gets the original
+# response, and concurrent duplicates wait for the first request instead of racing it.
+# The cache is per process: with several workers, a retry that lands on a different worker
+# still goes to the carrier.
+# Only PKCE sign-ins are cached: the code_verifier is a secret only the client that started
+# the sign-in knows, so someone who saw the auth code can't replay it to get the response.
+
+def signin_cache_key(client_id, code, code_verifier):
+    """
+    Hash the values that identify a sign-in so the auth code isn't kept in memory
+    """
+    key = '\0'.join((client_id, code, code_verifier))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+class PendingSignin():
+    """a sign-in that is in progress"""
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SigninReplayCache():
+    """
+    a short-lived cache of sign-in results, keyed by signin_cache_key()
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        # key: (expires_at, result). Every entry has the same TTL, so insertion order is
+        # also expiry order and expired entries are always at the front
+        self.results = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    def get_or_create(self, key, create, ttl, timeout=None):
+        """
+        Return the cached result for key, or call create() to make it
+
+        If another thread is already creating the result for the same key, wait for it and
+        return the same result (or raise the same error). Errors are not cached, so a retry
+        after a failed sign-in goes through the whole flow again.
+        Raises a 504 Gateway Timeout if the result isn't ready after timeout seconds.
+        """
+        if ttl <= 0:
+            return create()
+
+        now = time.monotonic()
+        with self.lock:
+            self._remove_expired(now)
+            cached = self.results.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached[1]
+            pending = self.pending.get(key)
+            leader = pending is None
+            if leader:
+                self.misses += 1
+                pending = self.pending[key] = PendingSignin()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not pending.done.wait(timeout):
+                raise GatewayTimeout('The first attempt at this sign-in is still in progress')
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+
+        try:
+            pending.result = create()
+        except Exception as error:
+            pending.error = error
+            raise
+        else:
+            with self.lock:
+                self.results[key] = (time.monotonic() + ttl, pending.result)
+                while len(self.results) > self.max_entries:
+                    self.results.popitem(last=False)
+            return pending.result
+        finally:
+            with self.lock:
+                del self.pending[key]
+            pending.done.set()
+
+    def _remove_expired(self, now):
+        while self.results:
+            key, (expires_at, _) = next(iter(self.results.items()))
+            if expires_at > now:
+                break
+            del self.results[key]
+
+    def stats(self):
+        """counters for monitoring"""
+        return {
+            'entries': len(self.results),
+            'in_flight': len(self.pending),
+            'hits': self.hits,
+            'coalesced': self.coalesced,
+            'misses': self.misses,
+        }
+
+signin_replay_cache = SigninReplayCache() # pylint: disable=invalid-name
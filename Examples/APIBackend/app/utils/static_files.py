@@ -0,0 +1,107 @@
+import hashlib
+import mimetypes
+import os
+
+from flask import Response, request
+from werkzeug.exceptions import NotFound
+
+from app.utils.compression import (available_encodings, compress, is_compressible,
+                                   negotiate_encoding)
+
+# Serves the files of the static directory from memory.
+# The files are read when the app starts and each compressible one is also compressed at the
+# best level, with gzip and with brotli when it is installed, so requests never compress
+# them. Each version of a file has a strong ETag made from its content, and conditional
+# requests get a 304 Not Modified. static_url() adds the content hash to the URL: a request
+# with the current hash is cached for a year, since a new version gets a new URL.
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# not every platform knows the type of the OpenAPI spec
+mimetypes.add_type('application/x-yaml', '.yml')
+mimetypes.add_type('application/x-yaml', '.yaml')
+
+class StaticFile():
+    """a static file, and its compressed versions that are smaller"""
+    __slots__ = ('mimetype', 'digest', 'versions')
+
+    def __init__(self, data, mimetype):
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(data).hexdigest()[:32]
+        # encoding: (body, ETag)
+        self.versions = {'identity': (data, self.digest)}
+        if is_compressible(mimetype):
+            for encoding in available_encodings():
+                compressed = compress(data, encoding, 9)
+                if len(compressed) < len(data):
+                    self.versions[encoding] = (compressed, '%s-%s' % (self.digest, encoding))
+
+class StaticFiles():
+    """
+    the files of a directory, loaded in memory
+
+    max_age: how long (in seconds) browsers and proxies can cache a file requested
+             without its content hash
+    """
+    def __init__(self, directory, max_age=86400):
+        self.directory = directory
+        self.max_age = max_age
+        self.files = {}
+        for root, _, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, directory).replace(os.sep, '/')
+                with open(path, 'rb') as static_file:
+                    data = static_file.read()
+                mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                self.files[name] = StaticFile(data, mimetype)
+
+    def url(self, name):
+        """the URL of a static file, with its content hash"""
+        return '/static/%s?v=%s' % (name, self.files[name].digest)
+
+    def response(self, filename):
+        """the response to a request for a static file"""
+        static_file = self.files.get(filename)
+        if static_file is None:
+            raise NotFound()
+        encoding = negotiate_encoding(request.accept_encodings,
+                                      [encoding for encoding in static_file.versions
+                                       if encoding != 'identity'])
+        body, etag = static_file.versions[encoding or 'identity']
+
+        if request.args.get('v') == static_file.digest:
+            cache_control = 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+        else:
+            cache_control = 'public, max-age=%d' % self.max_age
+        if_none_match = request.if_none_match
+        not_modified = if_none_match.star_tag or if_none_match.contains_weak(etag)
+
+        if not_modified:
+            response = Response(status=304)
+            # a 304 has no body to describe: only send the headers that update the cached copy
+            response.headers.clear()
+        else:
+            response = Response(body, mimetype=static_file.mimetype)
+            if encoding is not None:
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        response.vary.add('Accept-Encoding')
+        return response
+
+static_files = None # pylint: disable=invalid-name
+
+def static_url(name):
+    """the URL of a static file, with its content hash when the file is served by this app"""
+    if static_files is None or name not in static_files.files:
+        return '/static/%s' % name
+    return static_files.url(name)
+
+def init_static_files(app):
+    """
+    Load the static directory and serve it at /static
+    """
+    global static_files # pylint: disable=invalid-name,global-statement
+    static_files = StaticFiles(app.config['STATIC_DIR'], app.config['STATIC_MAX_AGE'])
+    app.add_url_rule('/static/<path:filename>', 'static', static_files.response)
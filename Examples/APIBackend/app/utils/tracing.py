@@ -0,0 +1,300 @@
+import atexit
+import importlib
+import json
+import logging
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+
+from flask import request
+
+from app.utils.request_profiler import record_phase
+
+# Lightweight tracing of the requests to this API, to line up our latency with the carriers'
+# logs. Each traced request gets a trace with a root span, and a child span for each phase
+# of the sign-in (discovery, token, id_token, userinfo, user_lookup, create_jwt). Every span
+# carries the trace ID and the client's correlation ID, and each carrier request gets its
+# own request ID.
+# The carrier requests send these IDs in the headers:
+# - traceparent: the W3C trace context of the carrier request's span
+# - X-Correlation-ID: the correlation ID, when the client sent one
+# - X-Request-ID: the request ID, also recorded on the span
+# A request that comes with a valid traceparent header continues that trace.
+# Finished traces are exported by a background thread, in batches, to a sink: a JSON lines
+# file, the log, or any callable that takes a list of span dictionaries.
+# span() always records the phase for the request profiler, and does nothing else when the
+# request isn't traced.
+
+logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+# the trace of the request being handled by this thread, or None
+_local = threading.local() # pylint: disable=invalid-name
+
+class Span():
+    """a timed operation in a trace"""
+    __slots__ = ('span_id', 'parent_id', 'name', 'started_at', 'duration', 'attributes',
+                 'error')
+
+    def __init__(self, name, parent_id=None, attributes=None):
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.started_at = time.time()
+        self.duration = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    def to_dict(self, trace):
+        """the span as exported"""
+        return {
+            'trace_id': trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'correlation_id': trace.correlation_id,
+            'start': self.started_at,
+            'duration_ms': round(self.duration * 1000, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+class Trace():
+    """the spans of one request"""
+    __slots__ = ('trace_id', 'correlation_id', 'stack', 'finished')
+
+    def __init__(self, trace_id=None, correlation_id=None):
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.correlation_id = correlation_id
+        # the spans in progress, innermost last
+        self.stack = []
+        self.finished = []
+
+def current_trace():
+    """the trace of the current request, or None when it isn't traced"""
+    return getattr(_local, 'trace', None)
+
+def set_correlation_id(correlation_id):
+    """set the correlation ID of the current trace, e.g. from a request parameter"""
+    trace = current_trace()
+    if trace is not None and correlation_id:
+        trace.correlation_id = str(correlation_id)[:128]
+
+class span(): # pylint: disable=invalid-name
+    """
+    a context manager that traces a phase of the current request, and records its time
+    for the request profiler
+    """
+    __slots__ = ('name', 'attributes', 'started', 'trace', 'span')
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started = None
+        self.trace = None
+        self.span = None
+
+    def __enter__(self):
+        self.trace = current_trace()
+        if self.trace is not None:
+            parent_id = self.trace.stack[-1].span_id if self.trace.stack else None
+            self.span = Span(self.name, parent_id, self.attributes)
+            self.trace.stack.append(self.span)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        duration = time.perf_counter() - self.started
+        record_phase(self.name, duration)
+        if self.span is not None:
+            self.span.duration = duration
+            if exc_type is not None:
+                self.span.error = exc_type.__name__
+            self.trace.stack.remove(self.span)
+            self.trace.finished.append(self.span)
+
+    def set(self, name, value):
+        """add an attribute to the span"""
+        if self.span is not None:
+            self.span.attributes[name] = value
+
+    def outbound_headers(self):
+        """
+        the headers that propagate the trace to an outbound request, which get a new
+        request ID. Empty when the request isn't traced
+        """
+        if self.span is None:
+            return {}
+        request_id = secrets.token_hex(8)
+        self.span.attributes['request_id'] = request_id
+        headers = {
+            'traceparent': '00-%s-%s-01' % (self.trace.trace_id, self.span.span_id),
+            'X-Request-ID': request_id,
+        }
+        if self.trace.correlation_id:
+            headers['X-Correlation-ID'] = self.trace.correlation_id
+        return headers
+
+def file_sink(path):
+    """a sink that appends the spans to a JSON lines file"""
+    def write_spans(spans):
+        with open(path, 'a') as trace_file:
+            for finished_span in spans:
+                trace_file.write(json.dumps(finished_span, separators=(',', ':'), default=str))
+                trace_file.write('\n')
+    return write_spans
+
+def log_sink(spans):
+    """a sink that logs the spans"""
+    for finished_span in spans:
+        logger.info('span %s', json.dumps(finished_span, separators=(',', ':'), default=str))
+
+def load_sink(name, path):
+    """the sink called "file" or "log", or a callable given as "package.module:name" """
+    if name == 'file':
+        return file_sink(path)
+    if name == 'log':
+        return log_sink
+    module_name, _, attribute = name.partition(':')
+    if not attribute:
+        raise ValueError('unknown tracing sink: %s' % name)
+    return getattr(importlib.import_module(module_name), attribute)
+
+class BatchSpanExporter():
+    """
+    exports finished traces from a background thread, in batches
+
+    sink: a callable that takes a list of span dictionaries
+    batch_size: the number of spans exported at once
+    flush_interval: the longest time (in seconds) a span waits to be exported
+    queue_size: the number of traces waiting before new ones are dropped
+    """
+    def __init__(self, sink, batch_size=100, flush_interval=5, queue_size=10000):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self.metrics = {'exported': 0, 'dropped': 0, 'export_errors': 0}
+        self.thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def export(self, spans):
+        """queue the spans of a finished trace"""
+        try:
+            self.queue.put_nowait(spans)
+        except queue.Full:
+            self.metrics['dropped'] += len(spans)
+
+    def _run(self):
+        batch = []
+        flush_at = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                spans = self.queue.get(timeout=max(flush_at - time.monotonic(), 0.01))
+            except queue.Empty:
+                spans = []
+            if spans is None:
+                self._flush(batch)
+                return
+            batch.extend(spans)
+            if len(batch) >= self.batch_size or time.monotonic() >= flush_at:
+                self._flush(batch)
+                batch = []
+                flush_at = time.monotonic() + self.flush_interval
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        try:
+            self.sink(batch)
+            self.metrics['exported'] += len(batch)
+        except Exception: # pylint: disable=broad-except
+            self.metrics['export_errors'] += 1
+            logger.exception('unable to export %d spans', len(batch))
+
+    def close(self):
+        """export the queued spans and stop the thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(self.flush_interval + 1)
+
+    def stats(self):
+        """counters for monitoring"""
+        return dict(self.metrics, waiting=self.queue.qsize())
+
+class Tracer():
+    """
+    starts a trace for a sample of the requests, and exports it when the request ends
+
+    sample_rate: the fraction of the requests traced. Requests that come with a sampled
+                 traceparent header are always traced
+    """
+    def __init__(self, exporter, sample_rate=1.0, correlation_header='X-Correlation-ID'):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.correlation_header = correlation_header
+
+    def start_trace(self):
+        """start the trace and the root span of the current request"""
+        match = TRACEPARENT.match(request.headers.get('traceparent', ''))
+        sampled = match is not None and int(match.group(3), 16) & 1
+        if not sampled and random.random() >= self.sample_rate:
+            return
+        trace = Trace(match.group(1) if match else None)
+        _local.trace = trace
+        set_correlation_id(request.headers.get(self.correlation_header))
+        root = Span('%s %s' % (request.method, request.url_rule or request.path),
+                    match.group(2) if match else None)
+        trace.stack.append(root)
+
+    def end_trace(self, error=None):
+        """end the root span of the current request and export the trace"""
+        trace = current_trace()
+        if trace is None:
+            return
+        _local.trace = None
+        root = trace.stack[0]
+        root.duration = time.time() - root.started_at
+        if error is not None:
+            root.error = type(error).__name__
+        trace.finished.append(root)
+        self.exporter.export([finished.to_dict(trace) for finished in trace.finished])
+
+tracer = None # pylint: disable=invalid-name
+
+def tracing_stats():
+    """the counters of the span exporter, or None when tracing is off"""
+    return tracer.exporter.stats() if tracer is not None else None
+
+def init_tracing(app):
+    """
+    Trace the requests when the app configuration sets a tracing sink
+    """
+    global tracer # pylint: disable=invalid-name,global-statement
+    if not app.config['TRACING_SINK']:
+        return
+    exporter = BatchSpanExporter(load_sink(app.config['TRACING_SINK'],
+                                           app.config['TRACING_FILE']),
+                                 batch_size=app.config['TRACING_BATCH_SIZE'],
+                                 flush_interval=app.config['TRACING_FLUSH_INTERVAL'])
+    tracer = Tracer(exporter, app.config['TRACING_SAMPLE_RATE'])
+
+    @app.before_request
+    def start_trace(): # pylint: disable=unused-variable
+        tracer.start_trace()
+
+    @app.after_request
+    def record_status(response): # pylint: disable=unused-variable
+        trace = current_trace()
+        if trace is not None:
+            trace.stack[0].attributes['status'] = response.status_code
+        return response
+
+    @app.teardown_request
+    def end_trace(error): # pylint: disable=unused-variable
+        tracer.end_trace(error)
@@ -1,85 +1,22 @@
 from base64 import b64encode
-import json
-from oic.oauth2.message import Message, TokenErrorResponse, ParamDefinition
-from oic.oauth2.message import (SINGLE_OPTIONAL_STRING, SINGLE_REQUIRED_STRING)
+import time
+from flask import current_app
+from oic.oauth2.message import TokenErrorResponse
 from oic.oic import Client
-from oic.oic.message import AccessTokenResponse, ProviderConfigurationResponse, RegistrationResponse
+from oic.oic.message import ProviderConfigurationResponse, RegistrationResponse
 from oic.utils.authn.client import CLIENT_AUTHN_METHOD
-from oic.exception import (MessageException, PyoidcError)
-from werkzeug.exceptions import Unauthorized
-import requests
-
-def msg_ser(inst, sformat, lev=0):
-    if sformat in ["urlencoded", "json"]:
-        if isinstance(inst, Message):
-            res = inst.serialize(sformat, lev)
-        else:
-            res = inst
-    elif sformat == "dict":
-        if isinstance(inst, Message):
-            res = inst.serialize(sformat, lev)
-        elif isinstance(inst, dict):
-            res = inst
-        elif isinstance(inst, str):  # Iff ID Token
-            res = inst
-        else:
-            raise MessageException("Wrong type: %s" % type(inst))
-    else:
-        raise PyoidcError("Unknown sformat", inst)
-
-    return res
-
-def name_deser(val, sformat="urlencoded"):
-    if sformat in ["dict", "json"]:
-        if not isinstance(val, str):
-            val = json.dumps(val)
-            sformat = "json"
-        elif sformat == "dict":
-            sformat = "json"
-    return NameClaim().deserialize(val, sformat)
-
-class NameClaim(Message):
-    c_param = {
-        "value": SINGLE_OPTIONAL_STRING,
-        "given_name": SINGLE_OPTIONAL_STRING,
-        "family_name": SINGLE_OPTIONAL_STRING
-    }
-
-def value_deser(val, sformat="urlencoded"):
-    if sformat in ["dict", "json"]:
-        if not isinstance(val, str):
-            val = json.dumps(val)
-            sformat = "json"
-        elif sformat == "dict":
-            sformat = "json"
-    return ValueClaim().deserialize(val, sformat)
-
-class ValueClaim(Message):
-    c_param = {
-        "value": SINGLE_OPTIONAL_STRING
-    }
-
-# Here we define our parameters for the ZenKey schema by providing a serializer
-# and deserializer that tells Pyoidc how to read Userinfo JSON.
-# See the Pyoidc implementation for examples of single nested parameters
-# and ParamDefinition method signature:
-# https://github.com/OpenIDC/pyoidc/blob/master/src/oic/oic/message.py
-OPTIONAL_NAME = ParamDefinition(Message, False, msg_ser, name_deser, False)
-OPTIONAL_NESTED_VALUE = ParamDefinition(Message, False, msg_ser, value_deser, False)
-
-class ZenKeySchema(Message):
-    """
-    This is the schema of the data returned from the Userinfo endpoint.
-    The default Pyoidc OpenIDSchema does not support double nested parameters,
-    so we have to define our own using ParamDefinition above. 
-    """
-    c_param = {
-        "sub": SINGLE_REQUIRED_STRING,
-        "name": OPTIONAL_NAME,
-        "email": OPTIONAL_NESTED_VALUE,
-        "phone": OPTIONAL_NESTED_VALUE,
-        "postal_code": OPTIONAL_NESTED_VALUE
-    }
+from werkzeug.exceptions import BadRequest, NotFound, ServiceUnavailable, Unauthorized
+from app.utils import carrier_token_store, discovery_failure_cache, id_token_verifier
+from app.utils.carrier_guard import carrier_request
+from app.utils.replay_store import ReplayWindowExceeded, record_id_token
+from app.utils.tracing import span
+from app.utils.validate_client_credentials import validate_client_credentials
+from app.utils.zenkey_codec import ZenKeyUserInfo, parse_token_response, parse_userinfo_response
+
+# the lifetime of a carrier access token when the token response doesn't say
+DEFAULT_EXPIRES_IN = 300
+# a saved access token this close (in seconds) to its expiry is refreshed before it's used
+ACCESS_TOKEN_LEEWAY = 10
 
 """
 This function deals with the ZenKey OAuth2/OpenID Connect flow
@@ -103,14 +40,16 @@ the auth flow proceeds in this order:
     Once we have these tokens, we know the user is authenticated and we can make requests
     to the Userinfo endpoint.
 """
-def zenkey_oidc_service(required_params, optional_token_request_params, id_token_validator_params):
+def zenkey_oidc_service(required_params, optional_token_request_params, id_token_validator_params,
+                        deadline=None):
     """
     Execute entire flow necessary to:
     - discover provider configuration (based on mccmnc)
     - exchange auth code for an access token
     - use that access token to request user info
 
-    Returns user's zenkey info
+    Returns user's zenkey info, and the carrier's tokens to save with
+    save_carrier_tokens() once the user is found
 
     required_params:
 	client_id:
@@ -127,6 +66,7 @@ def zenkey_oidc_service(required_params, optional_token_request_params, id_token
 	nonce (string): nonce sent in the authorization request
 	acr_values (string): acr_values sent in the authorization request
 	context (string): context sent in the authorization request
+    deadline: (optional) a Deadline shared by every request made to ZenKey and the carrier
     """
     client_id = required_params['client_id']
     client_secret = required_params['client_secret']
@@ -147,7 +87,8 @@ def zenkey_oidc_service(required_params, optional_token_request_params, id_token
     oidc_provider_config = discover_oidc_provider_config(
         oidc_provider_config_endpoint,
         client_id,
-        mccmnc
+        mccmnc,
+        deadline
     )
 
     openid_client = create_openid_client(
@@ -162,32 +103,56 @@ def zenkey_oidc_service(required_params, optional_token_request_params, id_token
         optional_token_request_params
     )
 
+    # throws error if the id token is invalid
     tokens = request_access_token(
         openid_client,
         token_request_payload,
         client_id,
-        client_secret
+        client_secret,
+        id_token_validator_params,
+        deadline
     )
 
-    # throws error if id token is invalid
-    validate_id_token(tokens['id_token'], id_token_validator_params)
-    zenkey_user_info = request_user_info(openid_client, tokens['access_token'])
-    return zenkey_user_info
+    zenkey_user_info = request_user_info(openid_client, tokens['access_token'], deadline)
+
+    return zenkey_user_info, tokens
 
-def discover_oidc_provider_config(oidc_provider_config_endpoint, client_id, mccmnc):
+def discover_oidc_provider_config(oidc_provider_config_endpoint, client_id, mccmnc, deadline=None):
     """
     Make an HTTP request to the ZenKey discovery issuer endpoint to access
         the carrier’s OIDC configuration
+
+    Failed lookups are remembered for a short time, so retries with the same bad
+    mccmnc get the error without another request
     """
+    failure_cache = discovery_failure_cache.discovery_failure_cache
+    if failure_cache.has_failed(client_id, mccmnc):
+        raise BadRequest('unable to fetch provider metadata for mccmnc %s' % mccmnc)
+    if not failure_cache.allow_lookup(mccmnc):
+        raise ServiceUnavailable('too many provider metadata lookups for unknown carriers. '
+                                 'Try again later')
+
     oidc_provider_config_url = '%s?client_id=%s&mccmnc=%s' % (
         oidc_provider_config_endpoint,
         client_id,
         mccmnc
     )
-    config_response = requests.get(oidc_provider_config_url)
-    config_json = config_response.json()
-    if (config_json == {} or config_json.get('issuer') is None):
-        raise Exception('unable to fetch provider metadata')
+    config_response = carrier_request(oidc_provider_config_endpoint, 'discovery',
+                                      'get', oidc_provider_config_url,
+                                      deadline=deadline)
+    if config_response.status_code >= 500:
+        # a discovery outage is not the client's fault: don't remember it
+        raise ServiceUnavailable('unable to fetch provider metadata: ZenKey discovery '
+                                 'returned %s' % config_response.status_code)
+    try:
+        config_json = config_response.json()
+    except ValueError:
+        config_json = {}
+    if not isinstance(config_json, dict) or config_json.get('issuer') is None:
+        failure_cache.add_failure(client_id, mccmnc)
+        raise BadRequest('unable to fetch provider metadata for mccmnc %s' % mccmnc)
+
+    failure_cache.add_success(mccmnc)
     return config_json
 
 def create_openid_client(oidc_provider_config, client_id, client_secret):
@@ -226,74 +191,225 @@ def create_token_request_payload(auth_code, redirect_uri, optional_token_request
     }
     return token_request_payload
 
-def request_access_token(openid_client, token_request_payload, client_id, client_secret):
+def request_access_token(openid_client, token_request_payload, client_id, client_secret,
+                         id_token_validator_params=None, deadline=None):
     """
-    Exchange an auth code for a token and validate the token response
+    Exchange an auth code for a token and validate the token response and id token
     """
-    # build a client secret header
-    client_id_secret = "%s:%s" % (client_id, client_secret)
-    auth_secret = b64encode(client_id_secret.encode('utf-8'))
-    token_request_headers = {
-        'Authorization': 'Basic %s' % auth_secret.decode("ascii"),
-    }
+    token_request_headers = client_secret_headers(client_id, client_secret)
 
     # Pyoidc's do_access_token_request automatically includes a client_id param
     # which Verizon doesn't like. We need to make a manual POST request instead
     # if Verizon ever fixes their bug, we can use do-access_token_request again
-    token_response = requests.post(openid_client.token_endpoint,
-                                   data=token_request_payload,
-                                   headers=token_request_headers,
-                                   timeout=20)
+    token_response = carrier_request(openid_client.provider_info['issuer'], 'token',
+                                     'post', openid_client.token_endpoint,
+                                     data=token_request_payload,
+                                     headers=token_request_headers,
+                                     deadline=deadline)
 
-    # pyoidc handles id_token token verification under the hood
-    tokens = openid_client.parse_request_response(token_response,
-                                                  AccessTokenResponse,
-                                                  body_type="json")
+    tokens = parse_token_response(token_response)
 
     if isinstance(tokens, TokenErrorResponse):
         raise Unauthorized("%s: %s" % (tokens.get('error'),
                                        tokens.get('error_description')))
 
+    # replace the JWT with its verified claims
+    with span('id_token'):
+        tokens.id_token = validate_id_token(openid_client, tokens.id_token,
+                                            id_token_validator_params or {},
+                                            deadline)
     return tokens
 
-def validate_id_token(id_token, id_token_validator_params):
+def client_secret_headers(client_id, client_secret):
     """
-    Manually verify that the ACR, context, and nonce values in the id token match
-    those sent in the authorization request
+    the headers that authenticate a token request with the client secret
     """
-    # manually verify that the ACR values in the id_token match those sent in the
-    # authorization request
-    acr_values = id_token_validator_params.get('acr_values')
-    context = id_token_validator_params.get('context')
-    nonce = id_token_validator_params.get('nonce')
-
-    err_message = None
-
-    if (acr_values and 'acr' in id_token and id_token['acr'] not in acr_values):
-        err_message = "ACR value in ID token does not match"
-
-    if (context and 'context' in id_token and id_token['context'] != context):
-        err_message = "Context value in ID token does not match"
-
-    if (nonce and id_token['nonce'] != nonce):
-        err_message = "Nonce value in ID token does not match"
+    client_id_secret = "%s:%s" % (client_id, client_secret)
+    auth_secret = b64encode(client_id_secret.encode('utf-8'))
+    return {
+        'Authorization': 'Basic %s' % auth_secret.decode("ascii"),
+    }
 
-    if err_message:
-        raise Unauthorized("Invalid ID Token: %s" % err_message)
+def validate_id_token(openid_client, id_token, id_token_validator_params, deadline=None,
+                      check_replay=True):
+    """
+    Verify the id token signature and claims, including that the ACR, context, and nonce
+    values match those sent in the authorization request, and that the id token hasn't
+    been used before (unless check_replay is False: the id tokens of a refresh can repeat
+    the nonce of the sign-in)
 
-def request_user_info(openid_client, access_token):
+    Returns the id token claims
+    """
+    verifier = id_token_verifier.id_token_verifier
+    # downloading the carrier's keys must fit in the deadline too
+    jwks_timeout = (deadline.timeout('the id token verification', verifier.timeout)
+                    if deadline is not None
+                    else None)
+    try:
+        claims = verifier.verify(id_token,
+                                 issuer=openid_client.provider_info['issuer'],
+                                 jwks_uri=openid_client.provider_info['jwks_uri'],
+                                 client_id=openid_client.client_id,
+                                 nonce=id_token_validator_params.get('nonce'),
+                                 acr_values=id_token_validator_params.get('acr_values'),
+                                 context=id_token_validator_params.get('context'),
+                                 timeout=jwks_timeout)
+    except id_token_verifier.InvalidIdToken as error:
+        raise Unauthorized("Invalid ID Token: %s" % error)
+
+    # reject an id token whose nonce or jti we have already accepted
+    try:
+        if check_replay and not record_id_token(claims, leeway=verifier.leeway):
+            raise Unauthorized("Invalid ID Token: ID token has already been used")
+    except ReplayWindowExceeded as error:
+        raise Unauthorized("Invalid ID Token: %s" % error)
+
+    return claims
+
+def request_user_info(openid_client, access_token, deadline=None):
     """
     Make an API call to the carrier to get user info, using the token we received
     """
-    zenkey_user_info = openid_client.do_user_info_request(
-        token=access_token,
-        behavior="use_authorization_header",
-        user_info_schema=ZenKeySchema,
-        method="GET")
-
-    if not isinstance(zenkey_user_info, ZenKeySchema):
+    # some carriers don't support POST requests to this endpoint, so always use GET
+    userinfo_response = carrier_request(openid_client.provider_info['issuer'], 'userinfo',
+                                        'get', openid_client.userinfo_endpoint,
+                                        headers={'Authorization': 'Bearer %s' % access_token},
+                                        deadline=deadline)
+    zenkey_user_info = parse_userinfo_response(openid_client, userinfo_response)
+
+    if not isinstance(zenkey_user_info, ZenKeyUserInfo):
         # the user_info request failed
         raise Unauthorized("%s: %s" % (zenkey_user_info.get('error'),
                                        zenkey_user_info.get('error_description')))
 
     return zenkey_user_info
+
+def save_carrier_tokens(user_id, sub, client_id, mccmnc, tokens, record=None, used=True):
+    """
+    Save the carrier's tokens, encrypted, when the carrier token store is enabled and the
+    carrier issued a refresh token
+
+    user_id: our ID of the user the tokens were issued to, who signed in with ZenKey
+    record: the saved record the tokens were refreshed from. Its refresh token is kept when
+            the carrier doesn't rotate it, and saving it releases its lease
+    used: whether the tokens are saved because the user is active, which keeps them fresh
+    Returns the saved record, or None
+    """
+    store = carrier_token_store.carrier_token_store
+    refresh_token = tokens.get('refresh_token') or (record or {}).get('refresh_token')
+    if store is None or refresh_token is None:
+        return None
+    new_record = dict(record or {},
+                      user_id=user_id,
+                      sub=sub,
+                      client_id=client_id,
+                      mccmnc=mccmnc,
+                      refresh_token=refresh_token,
+                      access_token=tokens['access_token'],
+                      expires_at=time.time() + int(tokens.get('expires_in', DEFAULT_EXPIRES_IN)))
+    store.save(new_record, used)
+    return new_record
+
+def carrier_openid_client(record, deadline=None):
+    """
+    The OpenID client for the carrier and client_id of a saved carrier token record
+    """
+    _, client_secret = validate_client_credentials(current_app.config['ALLOWED_ZENKEY_CLIENTS'],
+                                                   record['client_id'])
+    oidc_provider_config = discover_oidc_provider_config(
+        current_app.config['OIDC_PROVIDER_CONFIG_ENDPOINT'],
+        record['client_id'],
+        record['mccmnc'],
+        deadline
+    )
+    return create_openid_client(oidc_provider_config, record['client_id'], client_secret)
+
+def refresh_carrier_tokens(record, deadline=None, openid_client=None, used=False):
+    """
+    Exchange a saved carrier refresh token for new tokens, server-to-server, and save them
+
+    The caller must hold the record's lease (see CarrierTokenStore.claim), which saving the
+    new tokens releases. Must be called in an app context. The background refresher calls
+    it for the tokens that are about to expire
+    Returns the OpenID client and the new record
+    Raises Unauthorized, and forgets the tokens, when the carrier rejects the refresh token
+    """
+    client_id = record['client_id']
+    _, client_secret = validate_client_credentials(current_app.config['ALLOWED_ZENKEY_CLIENTS'],
+                                                   client_id)
+    if openid_client is None:
+        openid_client = carrier_openid_client(record, deadline)
+
+    token_response = carrier_request(openid_client.provider_info['issuer'], 'token',
+                                     'post', openid_client.token_endpoint,
+                                     data={'grant_type': 'refresh_token',
+                                           'refresh_token': record['refresh_token']},
+                                     headers=client_secret_headers(client_id, client_secret),
+                                     deadline=deadline)
+
+    # the response to a refresh doesn't have to include an id token
+    tokens = parse_token_response(token_response, id_token_required=False)
+
+    if isinstance(tokens, TokenErrorResponse):
+        if tokens.get('error') == 'invalid_grant':
+            # the refresh token has expired or was revoked: the user has to sign in again
+            carrier_token_store.carrier_token_store.delete(record['user_id'])
+        raise Unauthorized("%s: %s" % (tokens.get('error'),
+                                       tokens.get('error_description')))
+
+    if tokens.id_token is not None:
+        with span('id_token'):
+            claims = validate_id_token(openid_client, tokens.id_token, {}, deadline,
+                                       check_replay=False)
+        if claims['sub'] != record['sub']:
+            raise Unauthorized("Invalid ID Token: the sub doesn't match the refreshed user")
+
+    new_record = save_carrier_tokens(record['user_id'], record['sub'], client_id,
+                                     record['mccmnc'], tokens, record, used)
+    return openid_client, new_record
+
+def refresh_zenkey_user_info(user_id, deadline=None):
+    """
+    Get fresh ZenKey user info for a user who signed in before, server-to-server, with the
+    carrier tokens saved at the sign-in: no carrier discovery or authorization redirect.
+    The saved access token is used while it's valid, otherwise it is refreshed first
+
+    user_id: our ID of the user, from their access token
+    Raises NotFound when no tokens are saved for the user
+    """
+    store = carrier_token_store.carrier_token_store
+    record = store.load(user_id) if store is not None and user_id is not None else None
+    if record is None:
+        raise NotFound('No ZenKey tokens are saved for this user. Sign in with ZenKey again')
+
+    openid_client = None
+    if record['expires_at'] - ACCESS_TOKEN_LEEWAY > time.time():
+        openid_client = carrier_openid_client(record, deadline)
+        try:
+            return request_user_info(openid_client, record['access_token'], deadline)
+        except Unauthorized:
+            # the carrier revoked the access token before it expired: refresh it
+            pass
+    stale_access_token = record['access_token']
+
+    # lease the tokens, so no other request or worker uses the same refresh token at the
+    # same time, and read them again: they may have been refreshed while we waited
+    record = store.claim(user_id, deadline.remaining() if deadline is not None else store.lease)
+    if record is None:
+        raise NotFound('No ZenKey tokens are saved for this user. Sign in with ZenKey again')
+    try:
+        if (record['access_token'] != stale_access_token and
+                record['expires_at'] - ACCESS_TOKEN_LEEWAY > time.time()):
+            # another request refreshed the tokens while we waited: save them as used, which
+            # keeps them fresh and releases the lease
+            store.save(record, used=True)
+        else:
+            openid_client, record = refresh_carrier_tokens(record, deadline, openid_client,
+                                                           used=True)
+    except Exception:
+        store.release(user_id)
+        raise
+
+    if openid_client is None:
+        openid_client = carrier_openid_client(record, deadline)
+    return request_user_info(openid_client, record['access_token'], deadline)
@@ -0,0 +1,121 @@
+"""
+Compare the fast ZenKey codec with the generic Pyoidc Message parsing
+
+run from the project root:
+    python -m benchmarks.codec_benchmark
+"""
+import json
+import timeit
+
+from oic.exception import MessageException, PyoidcError
+from oic.oauth2.message import Message, ParamDefinition
+from oic.oauth2.message import SINGLE_OPTIONAL_STRING, SINGLE_REQUIRED_STRING
+from oic.oic.message import AccessTokenResponse
+
+from app.utils.zenkey_codec import decode_token_response, decode_userinfo
+
+def msg_ser(inst, sformat, lev=0):
+    if sformat in ["urlencoded", "json"]:
+        if isinstance(inst, Message):
+            res = inst.serialize(sformat, lev)
+        else:
+            res = inst
+    elif sformat == "dict":
+        if isinstance(inst, Message):
+            res = inst.serialize(sformat, lev)
+        elif isinstance(inst, dict):
+            res = inst
+        elif isinstance(inst, str):  # Iff ID Token
+            res = inst
+        else:
+            raise MessageException("Wrong type: %s" % type(inst))
+    else:
+        raise PyoidcError("Unknown sformat", inst)
+
+    return res
+
+def name_deser(val, sformat="urlencoded"):
+    if sformat in ["dict", "json"]:
+        if not isinstance(val, str):
+            val = json.dumps(val)
+            sformat = "json"
+        elif sformat == "dict":
+            sformat = "json"
+    return NameClaim().deserialize(val, sformat)
+
+class NameClaim(Message):
+    c_param = {
+        "value": SINGLE_OPTIONAL_STRING,
+        "given_name": SINGLE_OPTIONAL_STRING,
+        "family_name": SINGLE_OPTIONAL_STRING
+    }
+
+def value_deser(val, sformat="urlencoded"):
+    if sformat in ["dict", "json"]:
+        if not isinstance(val, str):
+            val = json.dumps(val)
+            sformat = "json"
+        elif sformat == "dict":
+            sformat = "json"
+    return ValueClaim().deserialize(val, sformat)
+
+class ValueClaim(Message):
+    c_param = {
+        "value": SINGLE_OPTIONAL_STRING
+    }
+
+# Here we define our parameters for the ZenKey schema by providing a serializer
+# and deserializer that tells Pyoidc how to read Userinfo JSON.
+# See the Pyoidc implementation for examples of single nested parameters
+# and ParamDefinition method signature:
+# https://github.com/OpenIDC/pyoidc/blob/master/src/oic/oic/message.py
+OPTIONAL_NAME = ParamDefinition(Message, False, msg_ser, name_deser, False)
+OPTIONAL_NESTED_VALUE = ParamDefinition(Message, False, msg_ser, value_deser, False)
+
+class ZenKeySchema(Message):
+    """
+    The Pyoidc schema of the data returned from the Userinfo endpoint, which the
+    services used before the fast codec: kept here as the benchmark's baseline.
+    The default Pyoidc OpenIDSchema does not support double nested parameters,
+    so we have to define our own using ParamDefinition above.
+    """
+    c_param = {
+        "sub": SINGLE_REQUIRED_STRING,
+        "name": OPTIONAL_NAME,
+        "email": OPTIONAL_NESTED_VALUE,
+        "phone": OPTIONAL_NESTED_VALUE,
+        "postal_code": OPTIONAL_NESTED_VALUE
+    }
+
+USERINFO = json.dumps({
+    'sub': 'mno.sub.8f2e5e0c-7a3f-4c1e-9b7d-1b9f2c3d4e5f',
+    'name': {'value': 'Jane Doe', 'given_name': 'Jane', 'family_name': 'Doe'},
+    'email': {'value': 'jane.doe@example.com'},
+    'phone': {'value': '+15555555555'},
+    'postal_code': {'value': '55555'},
+})
+
+TOKENS = json.dumps({
+    'access_token': 'a' * 64,
+    'token_type': 'Bearer',
+    'expires_in': 3600,
+    'refresh_token': 'r' * 64,
+    'scope': 'openid name email phone postal_code',
+    'id_token': 'eyJhbGciOiJSUzI1NiJ9.' + 'p' * 400 + '.' + 's' * 342,
+})
+
+CASES = [
+    ('userinfo: pyoidc ZenKeySchema', lambda: ZenKeySchema().from_json(USERINFO).to_dict()),
+    ('userinfo: zenkey_codec', lambda: decode_userinfo(USERINFO).to_dict()),
+    ('tokens: pyoidc AccessTokenResponse', lambda: AccessTokenResponse().from_json(TOKENS)),
+    ('tokens: zenkey_codec', lambda: decode_token_response(TOKENS)),
+]
+
+def main(number=20000):
+    """time each decoder and print the cost per call"""
+    for label, case in CASES:
+        seconds = min(timeit.repeat(case, number=number, repeat=5))
+        print('%-36s %8.2f us/call' % (label, seconds / number * 1e6))
+
+if __name__ == '__main__':
+    main()
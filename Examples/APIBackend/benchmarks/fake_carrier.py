@@ -0,0 +1,496 @@
+"""
+A stand-in for ZenKey discovery and the carriers, so sign-ins can be load tested offline
+
+It serves:
+- ZenKey discovery: GET /.well-known/openid_configuration?client_id=...&mccmnc=...
+- carrier discovery: GET /ui/discovery-ui, which redirects straight back with an mccmnc
+- a carrier for each mccmnc, with its own issuer and signing key:
+    GET  /<mccmnc>/authorize  redirects back with an auth code
+    POST /<mccmnc>/token      exchanges the code (checking PKCE) for an access token, a
+                              refresh token and a signed id_token, or rotates a refresh token
+    GET  /<mccmnc>/userinfo   the user's attributes in the ZenKey userinfo format
+    GET  /<mccmnc>/jwks       the carrier's public keys
+- GET or PUT /_fake/faults to read or change the injected faults while a test is running,
+  and GET /_fake/stats for the request counts
+
+Latency and errors can be injected for an endpoint ("token") or for one carrier's endpoint
+("310010/token"). "all" applies to every endpoint.
+
+run from the project root:
+    python -m benchmarks.fake_carrier --port 5001 --latency token=0.05:0.2 --error-rate userinfo=0.01
+
+then start the API backend with
+    OIDC_PROVIDER_CONFIG_URL=http://localhost:5001/.well-known/openid_configuration
+"""
+import argparse
+from base64 import b64decode, urlsafe_b64encode
+import hashlib
+import json
+import logging
+import random
+import secrets
+import threading
+import time
+from urllib.parse import urlencode
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from flask import Flask, jsonify, redirect, request
+import jwt
+from jwt.algorithms import RSAAlgorithm
+
+ENDPOINTS = ('discovery', 'carrier_discovery', 'authorize', 'token', 'userinfo', 'jwks')
+DEFAULT_MCCMNCS = ('310010', '310120', '311480')
+SCOPE_CLAIMS = ('name', 'email', 'phone', 'postal_code')
+# how long an auth code can be exchanged
+CODE_TTL = 600
+
+class Faults():
+    """
+    the latency and errors injected into the fake carrier's responses
+
+    Each setting is a dictionary keyed by endpoint, "<mccmnc>/<endpoint>" or "all":
+    latency: (min_seconds, max_seconds), each response is delayed by a random time in the range
+    error_rate: the fraction of requests that get a 500 error
+    hang_rate: the fraction of requests delayed by hang_seconds, to trigger client timeouts
+    """
+    def __init__(self, latency=None, error_rate=None, hang_rate=None, hang_seconds=30):
+        self.latency = latency or {}
+        self.error_rate = error_rate or {}
+        self.hang_rate = hang_rate or {}
+        self.hang_seconds = hang_seconds
+
+    @staticmethod
+    def _setting(settings, mccmnc, endpoint):
+        for key in ('%s/%s' % (mccmnc, endpoint), endpoint, 'all'):
+            if key in settings:
+                return settings[key]
+        return None
+
+    def apply(self, mccmnc, endpoint):
+        """
+        Sleep for the injected latency
+        Returns the name of the injected fault, or None
+        """
+        hang_rate = self._setting(self.hang_rate, mccmnc, endpoint)
+        if hang_rate and random.random() < hang_rate:
+            time.sleep(self.hang_seconds)
+            return 'hang'
+        latency = self._setting(self.latency, mccmnc, endpoint)
+        if latency:
+            time.sleep(random.uniform(*latency))
+        error_rate = self._setting(self.error_rate, mccmnc, endpoint)
+        if error_rate and random.random() < error_rate:
+            return 'error'
+        return None
+
+    def update(self, settings):
+        """replace some of the settings with values from a JSON body like to_dict()"""
+        if 'latency' in settings:
+            self.latency = {key: tuple(value) for key, value in settings['latency'].items()}
+        if 'error_rate' in settings:
+            self.error_rate = dict(settings['error_rate'])
+        if 'hang_rate' in settings:
+            self.hang_rate = dict(settings['hang_rate'])
+        if 'hang_seconds' in settings:
+            self.hang_seconds = settings['hang_seconds']
+
+    def to_dict(self):
+        """the settings as JSON"""
+        return {'latency': self.latency, 'error_rate': self.error_rate,
+                'hang_rate': self.hang_rate, 'hang_seconds': self.hang_seconds}
+
+def pkce_challenge(code_verifier, method):
+    """the code challenge matching a PKCE code verifier"""
+    if method == 'S256':
+        digest = hashlib.sha256(code_verifier.encode('ascii')).digest()
+        return urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+    return code_verifier
+
+def fake_userinfo(sub, scope):
+    """made up, but stable, ZenKey attributes for a user"""
+    number = int(hashlib.sha256(sub.encode('utf-8')).hexdigest()[:8], 16)
+    attributes = {
+        'name': {'value': 'Load Test %d' % number,
+                 'given_name': 'Load',
+                 'family_name': 'Test %d' % number},
+        'email': {'value': 'user%d@example.com' % number},
+        'phone': {'value': '+1555%07d' % (number % 10000000)},
+        'postal_code': {'value': '%05d' % (number % 100000)},
+    }
+    userinfo = {'sub': sub}
+    for claim in SCOPE_CLAIMS:
+        if claim in scope:
+            userinfo[claim] = attributes[claim]
+    return userinfo
+
+class Carrier():
+    """one fake carrier: an issuer and its signing key"""
+    def __init__(self, base_url, mccmnc):
+        self.mccmnc = mccmnc
+        self.issuer = '%s/%s' % (base_url, mccmnc)
+        self.kid = '%s-%s' % (mccmnc, secrets.token_hex(4))
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                                    backend=default_backend())
+        public_jwk = json.loads(RSAAlgorithm.to_jwk(self.private_key.public_key()))
+        public_jwk.update({'kid': self.kid, 'use': 'sig', 'alg': 'RS256'})
+        self.jwks = {'keys': [public_jwk]}
+
+    def provider_config(self):
+        """the carrier's OIDC configuration"""
+        return {
+            'issuer': self.issuer,
+            'authorization_endpoint': self.issuer + '/authorize',
+            'token_endpoint': self.issuer + '/token',
+            'userinfo_endpoint': self.issuer + '/userinfo',
+            'jwks_uri': self.issuer + '/jwks',
+            'response_types_supported': ['code'],
+            'subject_types_supported': ['pairwise'],
+            'id_token_signing_alg_values_supported': ['RS256'],
+            'scopes_supported': ['openid'] + list(SCOPE_CLAIMS),
+            'token_endpoint_auth_methods_supported': ['client_secret_basic',
+                                                      'client_secret_post'],
+            'code_challenge_methods_supported': ['S256', 'plain'],
+        }
+
+class FakeCarrier():
+    """
+    the state shared by the fake endpoints
+
+    clients: {client_id: client_secret}. When empty, any client ID and secret are accepted
+    users: the number of distinct subs handed out when the authorize request has no login_hint
+    """
+    def __init__(self, base_url, mccmncs=DEFAULT_MCCMNCS, clients=None, faults=None,
+                 users=1000, token_ttl=600):
+        self.carriers = {mccmnc: Carrier(base_url, mccmnc) for mccmnc in mccmncs}
+        self.clients = clients or {}
+        self.faults = faults or Faults()
+        self.users = users
+        self.token_ttl = token_ttl
+        # access tokens are self-contained, so only the pending auth codes and the refresh
+        # tokens are kept
+        self.secret = secrets.token_bytes(32)
+        self.codes = {}
+        self.refresh_tokens = {}
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def count(self, endpoint, outcome):
+        """count a response for /_fake/stats"""
+        key = '%s %s' % (endpoint, outcome)
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def issue_code(self, grant):
+        """remember an authorization grant and return its code"""
+        code = secrets.token_urlsafe(24)
+        now = time.monotonic()
+        with self.lock:
+            if len(self.codes) > 10000:
+                # drop the codes that were never exchanged
+                for expired in [code for code, (expires_at, _) in self.codes.items()
+                                if expires_at <= now]:
+                    del self.codes[expired]
+            self.codes[code] = (now + CODE_TTL, grant)
+        return code
+
+    def redeem_code(self, code):
+        """the grant for an auth code, which can only be used once; None if it isn't valid"""
+        with self.lock:
+            expires_at, grant = self.codes.pop(code, (0, None))
+        return grant if expires_at > time.monotonic() else None
+
+    def issue_refresh_token(self, grant):
+        """a refresh token for a grant. Refresh tokens don't expire, but can only be used once"""
+        refresh_token = secrets.token_urlsafe(24)
+        with self.lock:
+            self.refresh_tokens[refresh_token] = grant
+        return refresh_token
+
+    def redeem_refresh_token(self, refresh_token):
+        """the grant for a refresh token, which is rotated on use; None if it isn't valid"""
+        with self.lock:
+            return self.refresh_tokens.pop(refresh_token, None)
+
+    def authenticate_client(self):
+        """the client ID from client_secret_basic or client_secret_post, or None"""
+        client_id = request.form.get('client_id')
+        client_secret = request.form.get('client_secret')
+        authorization = request.headers.get('Authorization', '')
+        if authorization.startswith('Basic '):
+            try:
+                client_id, client_secret = (b64decode(authorization[6:]).decode('utf-8')
+                                            .split(':', 1))
+            except ValueError:
+                return None
+        if client_id is None:
+            return None
+        if self.clients and self.clients.get(client_id) != client_secret:
+            return None
+        return client_id
+
+    def access_token(self, carrier, grant):
+        """a self-contained access token for the userinfo endpoint"""
+        token = jwt.encode({'iss': carrier.issuer, 'sub': grant['sub'],
+                            'scope': grant['scope'],
+                            'exp': int(time.time()) + self.token_ttl},
+                           self.secret, algorithm='HS256')
+        return token.decode('ascii') if isinstance(token, bytes) else token
+
+    def id_token(self, carrier, client_id, grant):
+        """an id_token signed with the carrier's key"""
+        now = int(time.time())
+        claims = {
+            'iss': carrier.issuer,
+            'sub': grant['sub'],
+            'aud': client_id,
+            'iat': now,
+            'exp': now + self.token_ttl,
+            'jti': secrets.token_urlsafe(16),
+            'acr': grant['acr_values'].split(' ')[0] if grant['acr_values'] else 'a1',
+        }
+        if grant['nonce']:
+            claims['nonce'] = grant['nonce']
+        if grant['context']:
+            claims['context'] = grant['context']
+        token = jwt.encode(claims, carrier.private_key, algorithm='RS256',
+                           headers={'kid': carrier.kid})
+        return token.decode('ascii') if isinstance(token, bytes) else token
+
+def oauth_error(error, description, status):
+    """an OAuth error response"""
+    return jsonify({'error': error, 'error_description': description}), status
+
+def create_app(fake_carrier):
+    """a Flask app serving the fake endpoints"""
+    app = Flask(__name__)
+
+    def carrier_or_404(mccmnc):
+        carrier = fake_carrier.carriers.get(mccmnc)
+        if carrier is None:
+            return None, oauth_error('invalid_request', 'unknown mccmnc %s' % mccmnc, 404)
+        return carrier, None
+
+    def inject_faults(mccmnc, endpoint):
+        fault = fake_carrier.faults.apply(mccmnc, endpoint)
+        if fault is not None:
+            fake_carrier.count(endpoint, 'injected_' + fault)
+        if fault == 'error':
+            return oauth_error('server_error', 'injected error', 500)
+        return None
+
+    @app.route('/.well-known/openid_configuration')
+    def discovery():
+        mccmnc = request.args.get('mccmnc')
+        error = inject_faults(mccmnc, 'discovery')
+        if error is not None:
+            return error
+        carrier, error = carrier_or_404(mccmnc)
+        if error is not None:
+            fake_carrier.count('discovery', 'unknown_mccmnc')
+            return error
+        fake_carrier.count('discovery', 'ok')
+        return jsonify(carrier.provider_config())
+
+    @app.route('/ui/discovery-ui')
+    def carrier_discovery():
+        # skip the carrier picker: use the requested mccmnc or a random carrier
+        mccmnc = request.args.get('mccmnc') or random.choice(list(fake_carrier.carriers))
+        error = inject_faults(mccmnc, 'carrier_discovery')
+        if error is not None:
+            return error
+        fake_carrier.count('carrier_discovery', 'ok')
+        return redirect('%s?%s' % (request.args['redirect_uri'],
+                                   urlencode({'mccmnc': mccmnc,
+                                              'state': request.args.get('state', '')})))
+
+    @app.route('/<mccmnc>/authorize')
+    def authorize(mccmnc):
+        carrier, error = carrier_or_404(mccmnc)
+        if error is None:
+            error = inject_faults(mccmnc, 'authorize')
+        if error is not None:
+            return error
+        redirect_uri = request.args.get('redirect_uri')
+        if redirect_uri is None or request.args.get('client_id') is None:
+            return oauth_error('invalid_request', 'client_id and redirect_uri are required', 400)
+        # a login_hint picks the user, otherwise one of the fake users is signing in
+        login_hint = request.args.get('login_hint')
+        sub = ('fake.sub.%s' % login_hint if login_hint
+               else 'fake.sub.%d' % random.randrange(fake_carrier.users))
+        code = fake_carrier.issue_code({
+            'mccmnc': carrier.mccmnc,
+            'client_id': request.args['client_id'],
+            'redirect_uri': redirect_uri,
+            'scope': request.args.get('scope', 'openid'),
+            'nonce': request.args.get('nonce'),
+            'acr_values': request.args.get('acr_values'),
+            'context': request.args.get('context'),
+            'code_challenge': request.args.get('code_challenge'),
+            'code_challenge_method': request.args.get('code_challenge_method', 'plain'),
+            'sub': sub,
+        })
+        fake_carrier.count('authorize', 'ok')
+        return redirect('%s?%s' % (redirect_uri,
+                                   urlencode({'code': code,
+                                              'state': request.args.get('state', '')})))
+
+    @app.route('/<mccmnc>/token', methods=['POST'])
+    def token(mccmnc):
+        carrier, error = carrier_or_404(mccmnc)
+        if error is None:
+            error = inject_faults(mccmnc, 'token')
+        if error is not None:
+            return error
+        client_id = fake_carrier.authenticate_client()
+        if client_id is None:
+            fake_carrier.count('token', 'invalid_client')
+            return oauth_error('invalid_client', 'client authentication failed', 401)
+        grant_type = request.form.get('grant_type')
+        if grant_type == 'refresh_token':
+            return refresh(carrier, client_id)
+        if grant_type != 'authorization_code':
+            return oauth_error('unsupported_grant_type',
+                               'only authorization_code and refresh_token are supported', 400)
+
+        grant = fake_carrier.redeem_code(request.form.get('code', ''))
+        failure = None
+        if grant is None or grant['mccmnc'] != carrier.mccmnc:
+            failure = 'the code is invalid, expired or has already been used'
+        elif grant['client_id'] != client_id:
+            failure = 'the code was issued to another client'
+        elif grant['redirect_uri'] != request.form.get('redirect_uri'):
+            failure = 'redirect_uri does not match'
+        elif grant['code_challenge']:
+            code_verifier = request.form.get('code_verifier')
+            if (code_verifier is None or
+                    pkce_challenge(code_verifier, grant['code_challenge_method']) !=
+                    grant['code_challenge']):
+                failure = 'PKCE verification failed'
+        if failure is not None:
+            fake_carrier.count('token', 'invalid_grant')
+            return oauth_error('invalid_grant', failure, 400)
+
+        fake_carrier.count('token', 'ok')
+        return token_response(carrier, client_id, grant)
+
+    def refresh(carrier, client_id):
+        grant = fake_carrier.redeem_refresh_token(request.form.get('refresh_token', ''))
+        if grant is None or grant['mccmnc'] != carrier.mccmnc or grant['client_id'] != client_id:
+            fake_carrier.count('token', 'invalid_refresh_token')
+            return oauth_error('invalid_grant', 'the refresh token is invalid or has already '
+                                                'been used', 400)
+        fake_carrier.count('token', 'refreshed')
+        # the id tokens of a refresh have no nonce: there was no authorization request
+        return token_response(carrier, client_id, dict(grant, nonce=None))
+
+    def token_response(carrier, client_id, grant):
+        return jsonify({
+            'access_token': fake_carrier.access_token(carrier, grant),
+            'token_type': 'bearer',
+            'expires_in': fake_carrier.token_ttl,
+            'refresh_token': fake_carrier.issue_refresh_token(grant),
+            'id_token': fake_carrier.id_token(carrier, client_id, grant),
+        })
+
+    @app.route('/<mccmnc>/userinfo', methods=['GET', 'POST'])
+    def userinfo(mccmnc):
+        carrier, error = carrier_or_404(mccmnc)
+        if error is None:
+            error = inject_faults(mccmnc, 'userinfo')
+        if error is not None:
+            return error
+        authorization = request.headers.get('Authorization', '')
+        try:
+            claims = jwt.decode(authorization[len('Bearer '):], fake_carrier.secret,
+                                algorithms=['HS256'], issuer=carrier.issuer)
+        except jwt.InvalidTokenError:
+            fake_carrier.count('userinfo', 'invalid_token')
+            return oauth_error('invalid_token', 'the access token is invalid', 401)
+        fake_carrier.count('userinfo', 'ok')
+        return jsonify(fake_userinfo(claims['sub'], claims['scope'].split(' ')))
+
+    @app.route('/<mccmnc>/jwks')
+    def jwks(mccmnc):
+        carrier, error = carrier_or_404(mccmnc)
+        if error is None:
+            error = inject_faults(mccmnc, 'jwks')
+        if error is not None:
+            return error
+        fake_carrier.count('jwks', 'ok')
+        return jsonify(carrier.jwks)
+
+    @app.route('/_fake/faults', methods=['GET', 'PUT'])
+    def faults():
+        if request.method == 'PUT':
+            fake_carrier.faults.update(request.get_json(force=True))
+        return jsonify(fake_carrier.faults.to_dict())
+
+    @app.route('/_fake/stats')
+    def stats():
+        return jsonify(fake_carrier.stats)
+
+    return app
+
+def parse_settings(values, parse_value):
+    """parse repeated KEY=VALUE command line options into a dictionary"""
+    settings = {}
+    for value in values:
+        key, _, setting = value.partition('=')
+        if key.split('/')[-1] not in ENDPOINTS + ('all',):
+            raise argparse.ArgumentTypeError('unknown endpoint in %s' % value)
+        settings[key] = parse_value(setting)
+    return settings
+
+def parse_latency(value):
+    """"0.1" or "0.05:0.2" as a (min_seconds, max_seconds) range"""
+    low, _, high = value.partition(':')
+    return (float(low), float(high or low))
+
+def main():
+    """start the fake carrier"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--base-url',
+                        help='the URL the fake carrier is reached at, if not http://HOST:PORT')
+    parser.add_argument('--mccmnc', default=','.join(DEFAULT_MCCMNCS),
+                        help='comma separated mccmncs of the fake carriers')
+    parser.add_argument('--client', action='append', default=[],
+                        help='an allowed "client_id:client_secret". Any client is allowed '
+                             'when there are none')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='the number of distinct users signing in')
+    parser.add_argument('--token-ttl', type=int, default=600,
+                        help='the lifetime in seconds of the tokens. Use a long one when '
+                             'recording a cassette, so the id tokens are still valid when '
+                             'they are replayed')
+    parser.add_argument('--latency', action='append', default=[],
+                        help='ENDPOINT=SECONDS or ENDPOINT=MIN:MAX, e.g. token=0.05:0.2')
+    parser.add_argument('--error-rate', action='append', default=[],
+                        help='ENDPOINT=FRACTION of requests answered with a 500')
+    parser.add_argument('--hang-rate', action='append', default=[],
+                        help='ENDPOINT=FRACTION of requests delayed by --hang-seconds')
+    parser.add_argument('--hang-seconds', type=float, default=30)
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    faults = Faults(latency=parse_settings(args.latency, parse_latency),
+                    error_rate=parse_settings(args.error_rate, float),
+                    hang_rate=parse_settings(args.hang_rate, float),
+                    hang_seconds=args.hang_seconds)
+    base_url = args.base_url or 'http://%s:%s' % (args.host, args.port)
+    fake_carrier = FakeCarrier(base_url,
+                               mccmncs=args.mccmnc.split(','),
+                               clients=dict(client.split(':', 1) for client in args.client),
+                               faults=faults,
+                               users=args.users,
+                               token_ttl=args.token_ttl)
+    print('fake carriers %s at %s' % (', '.join(fake_carrier.carriers), base_url))
+    print('OIDC_PROVIDER_CONFIG_URL=%s/.well-known/openid_configuration' % base_url)
+    create_app(fake_carrier).run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Compare the id_token verifier with Pyoidc's verify_id_token()
+
+run from the project root:
+    python -m benchmarks.id_token_benchmark
+"""
+import logging
+import time
+import timeit
+
+from Cryptodome.PublicKey import RSA
+from jwkest.jwk import RSAKey
+from oic.oic.message import IdToken, verify_id_token
+from oic.utils.keyio import KeyBundle, KeyJar
+
+from app.utils.id_token_verifier import IdTokenVerifier
+
+ISSUER = 'https://oidc.example.com'
+CLIENT_ID = 'zenkey-client-id'
+
+def main(number=2000):
+    """time each verifier and print the cost per call"""
+    # Pyoidc logs every step at debug level: leave that out of the timings
+    logging.disable(logging.INFO)
+    signing_key = RSAKey(key=RSA.generate(2048), kid='key-1')
+    now = int(time.time())
+    id_token = IdToken(iss=ISSUER, sub='mno.sub.1234', aud=[CLIENT_ID], exp=now + 600, iat=now,
+                       nonce='nonce-1234', acr='a3').to_jwt([signing_key], 'RS256')
+
+    # Pyoidc looks the key up in a KeyJar
+    keyjar = KeyJar()
+    key_bundle = KeyBundle()
+    key_bundle.append(signing_key)
+    keyjar.add_kb(ISSUER, key_bundle)
+
+    # the verifier keeps the parsed JWKS in memory
+    verifier = IdTokenVerifier()
+    verifier.load_jwks(ISSUER, {'keys': [signing_key.serialize(private=False)]})
+
+    cases = [
+        ('pyoidc verify_id_token', lambda: verify_id_token({'id_token': id_token},
+                                                           keyjar=keyjar,
+                                                           iss=ISSUER,
+                                                           client_id=CLIENT_ID)),
+        ('IdTokenVerifier.verify', lambda: verifier.verify(id_token, ISSUER,
+                                                           ISSUER + '/jwks', CLIENT_ID,
+                                                           nonce='nonce-1234',
+                                                           acr_values='a3')),
+    ]
+    for label, case in cases:
+        seconds = min(timeit.repeat(case, number=number, repeat=5))
+        print('%-28s %8.2f us/call' % (label, seconds / number * 1e6))
+
+if __name__ == '__main__':
+    main()
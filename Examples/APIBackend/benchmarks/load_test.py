@@ -0,0 +1,300 @@
+"""
+Drive the API backend with concurrent requests and report throughput and latency
+
+Point the API backend at the fake carrier (benchmarks/fake_carrier.py) so no real carrier is
+involved. Each worker thread sends one request at a time, so --concurrency is the number of
+requests in flight.
+
+scenarios:
+    signin        get an auth code from the carrier's authorize endpoint, like the mobile
+                  SDK does, then POST /auth/zenkey-signin
+    async-signin  POST /auth/zenkey-async-signin, then GET /auth/zenkey-async-signin/<id>
+    users-me      GET /users/me with a token from POST /users
+    mixed         the three scenarios in turn
+
+With --replay, the API backend is expected to replay a cassette (HTTP_CASSETTE_MODE=replay):
+the load test makes up the auth codes instead of asking the carrier, and sends no nonce,
+since the replayed id tokens carry the nonces of the recording.
+
+run from the project root:
+    python -m benchmarks.load_test --api-key my_api_key --client-id my_id \\
+        --scenario signin --concurrency 20 --duration 30
+"""
+import argparse
+from base64 import urlsafe_b64encode
+import bisect
+import hashlib
+import json
+import secrets
+import threading
+import time
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import requests
+
+# the upper bounds of the histogram buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, float('inf'))
+
+class OperationStats():
+    """the latencies and outcomes of one kind of request"""
+    def __init__(self):
+        self.latencies = []
+        self.outcomes = {}
+
+    def record(self, seconds, outcome):
+        """record one request"""
+        self.latencies.append(seconds)
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def merge(self, other):
+        """add another worker's results"""
+        self.latencies.extend(other.latencies)
+        for outcome, count in other.outcomes.items():
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + count
+
+    def percentile(self, fraction):
+        """a latency percentile in milliseconds"""
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return 0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+
+    def histogram(self):
+        """the number of requests in each bucket"""
+        counts = [0] * len(BUCKETS)
+        for seconds in self.latencies:
+            counts[bisect.bisect_left(BUCKETS, seconds * 1000)] += 1
+        return counts
+
+    def report(self, elapsed):
+        """a summary for the JSON report"""
+        errors = sum(count for outcome, count in self.outcomes.items() if outcome != 'ok')
+        return {
+            'requests': len(self.latencies),
+            'errors': errors,
+            'requests_per_second': len(self.latencies) / elapsed if elapsed else 0,
+            'latency_ms': {'p50': self.percentile(0.5),
+                           'p90': self.percentile(0.9),
+                           'p99': self.percentile(0.99),
+                           'max': self.percentile(1)},
+            'outcomes': self.outcomes,
+            'histogram_ms': {str(bound): count
+                             for bound, count in zip(BUCKETS, self.histogram()) if count},
+        }
+
+class LoadTest():
+    """the scenarios, run by each worker with its own HTTP session"""
+    def __init__(self, args):
+        self.args = args
+        self.carrier_configs = {}
+        self.access_token = None
+
+    def session(self):
+        """an HTTP session for one worker"""
+        session = requests.Session()
+        session.headers['X-API-Key'] = self.args.api_key
+        # Talisman redirects plain HTTP requests to HTTPS unless they came through a TLS proxy
+        session.headers['X-Forwarded-Proto'] = 'https'
+        return session
+
+    def setup(self):
+        """discover the fake carriers and get an access token for /users/me"""
+        session = self.session()
+        for mccmnc in self.args.mccmnc.split(','):
+            if self.args.replay:
+                # no carrier to ask
+                self.carrier_configs[mccmnc] = None
+                continue
+            config_response = session.get(self.args.discovery_url,
+                                          params={'client_id': self.args.client_id,
+                                                  'mccmnc': mccmnc})
+            config_response.raise_for_status()
+            self.carrier_configs[mccmnc] = config_response.json()
+
+        user_response = session.post(self.args.target + '/users',
+                                     json={'zenkey_sub': 'fake.sub.load-test'})
+        user_response.raise_for_status()
+        self.access_token = user_response.json()['token']
+
+    def timed(self, stats, name, send):
+        """send a request and record its latency and outcome"""
+        started = time.perf_counter()
+        try:
+            response = send()
+            outcome = 'ok' if response.status_code < 400 else str(response.status_code)
+        except requests.RequestException as error:
+            response = None
+            outcome = type(error).__name__
+        stats.setdefault(name, OperationStats()).record(time.perf_counter() - started, outcome)
+        return response
+
+    def signin(self, session, stats):
+        """get an auth code from the carrier and sign in with it"""
+        mccmnc = secrets.choice(list(self.carrier_configs))
+        code_verifier = secrets.token_urlsafe(32)
+        code_challenge = urlsafe_b64encode(
+            hashlib.sha256(code_verifier.encode('ascii')).digest()).rstrip(b'=').decode('ascii')
+        signin_params = {'client_id': self.args.client_id,
+                         'redirect_uri': self.args.redirect_uri,
+                         'mccmnc': mccmnc,
+                         'code_verifier': code_verifier}
+        if self.args.replay:
+            # the carrier's token response is replayed whatever the code is
+            signin_params['code'] = secrets.token_urlsafe(24)
+            self.timed(stats, 'POST /auth/zenkey-signin',
+                       lambda: session.post(self.args.target + '/auth/zenkey-signin',
+                                            json=signin_params))
+            return
+
+        nonce = secrets.token_urlsafe(16)
+        authorize_url = '%s?%s' % (self.carrier_configs[mccmnc]['authorization_endpoint'],
+                                   urlencode({'client_id': self.args.client_id,
+                                              'redirect_uri': self.args.redirect_uri,
+                                              'response_type': 'code',
+                                              'scope': 'openid name email phone postal_code',
+                                              'state': secrets.token_urlsafe(8),
+                                              'nonce': nonce,
+                                              'code_challenge': code_challenge,
+                                              'code_challenge_method': 'S256'}))
+        response = self.timed(stats, 'carrier authorize',
+                              lambda: session.get(authorize_url, allow_redirects=False))
+        if response is None or 'Location' not in response.headers:
+            return
+        signin_params['code'] = parse_qs(urlparse(response.headers['Location']).query)['code'][0]
+        signin_params['nonce'] = nonce
+        self.timed(stats, 'POST /auth/zenkey-signin',
+                   lambda: session.post(self.args.target + '/auth/zenkey-signin',
+                                        json=signin_params))
+
+    def async_signin(self, session, stats):
+        """start a server initiated sign-in and get its result"""
+        mccmnc = secrets.choice(list(self.carrier_configs))
+        response = self.timed(stats, 'POST /auth/zenkey-async-signin',
+                              lambda: session.post(self.args.target + '/auth/zenkey-async-signin',
+                                                   json={'login_hint': '+15555550100',
+                                                         'client_id': self.args.client_id,
+                                                         'scope': 'openid name',
+                                                         'mccmnc': mccmnc,
+                                                         'redirect_uri': self.args.redirect_uri}))
+        if response is None or response.status_code >= 400:
+            return
+        auth_req_id = response.json()['auth_req_id']
+        self.timed(stats, 'GET /auth/zenkey-async-signin/<id>',
+                   lambda: session.get('%s/auth/zenkey-async-signin/%s' % (self.args.target,
+                                                                            auth_req_id)))
+
+    def users_me(self, session, stats):
+        """get the current user"""
+        self.timed(stats, 'GET /users/me',
+                   lambda: session.get(self.args.target + '/users/me',
+                                       headers={'Authorization':
+                                                'Bearer %s' % self.access_token}))
+
+    def scenario(self):
+        """the operations a worker runs in turn"""
+        scenarios = {
+            'signin': [self.signin],
+            'async-signin': [self.async_signin],
+            'users-me': [self.users_me],
+            'mixed': [self.signin, self.async_signin, self.users_me],
+        }
+        return scenarios[self.args.scenario]
+
+    def worker(self, stop, remaining, stats):
+        """run the scenario until the test is over"""
+        session = self.session()
+        operations = self.scenario()
+        turn = 0
+        while not stop.is_set():
+            if remaining is not None:
+                with remaining['lock']:
+                    if remaining['count'] <= 0:
+                        return
+                    remaining['count'] -= 1
+            operations[turn % len(operations)](session, stats)
+            turn += 1
+
+    def run(self):
+        """run the workers and return the merged stats and the elapsed time"""
+        self.setup()
+        stop = threading.Event()
+        remaining = ({'count': self.args.requests, 'lock': threading.Lock()}
+                     if self.args.requests else None)
+        worker_stats = [{} for _ in range(self.args.concurrency)]
+        workers = [threading.Thread(target=self.worker, args=(stop, remaining, stats), daemon=True)
+                   for stats in worker_stats]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        if remaining is None:
+            time.sleep(self.args.duration)
+            stop.set()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        merged = {}
+        for stats in worker_stats:
+            for name, operation_stats in stats.items():
+                merged.setdefault(name, OperationStats()).merge(operation_stats)
+        return merged, elapsed
+
+def print_report(stats, elapsed):
+    """print a table of the results and a latency histogram for each operation"""
+    print('%-36s %9s %7s %9s %9s %9s %9s %9s' % ('operation', 'requests', 'errors', 'req/s',
+                                                 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for name, operation_stats in sorted(stats.items()):
+        report = operation_stats.report(elapsed)
+        print('%-36s %9d %7d %9.1f %9.1f %9.1f %9.1f %9.1f' % (
+            name, report['requests'], report['errors'], report['requests_per_second'],
+            report['latency_ms']['p50'], report['latency_ms']['p90'],
+            report['latency_ms']['p99'], report['latency_ms']['max']))
+    for name, operation_stats in sorted(stats.items()):
+        report = operation_stats.report(elapsed)
+        print('\n%s  %s' % (name, report['outcomes']))
+        counts = operation_stats.histogram()
+        largest = max(counts) or 1
+        for bound, count in zip(BUCKETS, counts):
+            if count:
+                print('  <= %8s ms %8d %s' % (bound, count, '#' * max(1, 40 * count // largest)))
+
+def main():
+    """parse the options, run the load test and print the results"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--target', default='http://localhost:5000',
+                        help='the API backend URL')
+    parser.add_argument('--discovery-url',
+                        default='http://localhost:5001/.well-known/openid_configuration',
+                        help='the OIDC_PROVIDER_CONFIG_URL the API backend uses')
+    parser.add_argument('--api-key', required=True, help='one of the API_KEYS')
+    parser.add_argument('--client-id', required=True,
+                        help='a client ID in ALLOWED_ZENKEY_CLIENTS')
+    parser.add_argument('--redirect-uri', default='http://localhost/callback')
+    parser.add_argument('--mccmnc', default='310010,310120,311480',
+                        help='comma separated mccmncs to sign in with')
+    parser.add_argument('--scenario', default='signin',
+                        choices=('signin', 'async-signin', 'users-me', 'mixed'))
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run for')
+    parser.add_argument('--requests', type=int,
+                        help='stop after this many scenario runs instead of after --duration')
+    parser.add_argument('--replay', action='store_true',
+                        help='the API backend replays a cassette: don\'t contact the carrier')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    stats, elapsed = LoadTest(args).run()
+    print('%s: %d workers for %.1f seconds\n' % (args.scenario, args.concurrency, elapsed))
+    print_report(stats, elapsed)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump({'scenario': args.scenario,
+                       'concurrency': args.concurrency,
+                       'replay': args.replay,
+                       'elapsed': elapsed,
+                       'operations': {name: operation_stats.report(elapsed)
+                                      for name, operation_stats in stats.items()}},
+                      report_file, indent=2)
+
+if __name__ == '__main__':
+    main()
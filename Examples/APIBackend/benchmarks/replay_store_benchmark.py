@@ -0,0 +1,42 @@
+"""
+Measure the cost of recording an id token in each replay store
+
+run from the project root:
+    python -m benchmarks.replay_store_benchmark
+"""
+import os
+import tempfile
+import time
+import timeit
+
+from oic import rndstr
+
+from app.utils import replay_store
+from app.utils.replay_store import SQLiteReplayStore, TimerWheelReplayStore
+
+def id_token():
+    """a new set of id token claims with a random nonce and jti"""
+    return {
+        'iss': 'https://oidc.example.com',
+        'exp': time.time() + 600,
+        'nonce': rndstr(32),
+        'jti': rndstr(32),
+    }
+
+def main(number=20000):
+    """time record_id_token() with each store and print the cost per call"""
+    with tempfile.TemporaryDirectory() as directory:
+        stores = [
+            TimerWheelReplayStore(),
+            SQLiteReplayStore(os.path.join(directory, 'replay_store.sqlite3')),
+        ]
+        for store in stores:
+            replay_store.replay_store = store
+            tokens = [id_token() for _ in range(number)]
+            tokens_iter = iter(tokens)
+            seconds = timeit.timeit(lambda: replay_store.record_id_token(next(tokens_iter)),
+                                    number=number)
+            print('%-8s %8.2f us/call %s' % (store.name, seconds / number * 1e6, store.stats()))
+
+if __name__ == '__main__':
+    main()
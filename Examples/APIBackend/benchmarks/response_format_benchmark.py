@@ -0,0 +1,53 @@
+"""
+Compare the size and parse time of the sign-in responses in each response format
+
+run from the project root:
+    python -m benchmarks.response_format_benchmark
+
+MessagePack and CBOR are measured when the msgpack and cbor2 packages are installed
+"""
+import gzip
+import json
+import timeit
+
+from app.utils.response_format import cbor2, msgpack
+
+TOKEN = {
+    'token': 'eyJ0eXAiOiJKV1QiLCJhbGciOiJIUzI1NiJ9.' + 'p' * 320 + '.' + 's' * 43,
+    'refresh_token': 'omitted',
+    'token_type': 'bearer',
+    'expires': 2592000.0,
+}
+
+# the 403 response to a sign-in by a user who hasn't registered yet
+NEW_USER = {
+    'zenkey_attributes': {
+        'sub': 'mno.sub.8f2e5e0c-7a3f-4c1e-9b7d-1b9f2c3d4e5f',
+        'name': {'value': 'Jane Doe', 'given_name': 'Jane', 'family_name': 'Doe'},
+        'email': {'value': 'jane.doe@example.com'},
+        'phone': {'value': '+15555555555'},
+        'postal_code': {'value': '55555'},
+    },
+    'error': 'ZenKey user does not exist',
+    'error_description': 'Unable to find a user with a matching "zenkey_sub" value',
+}
+
+def formats():
+    """(name, dumps, loads) for each format that can be measured"""
+    yield 'json', lambda body: json.dumps(body, separators=(',', ':')).encode(), json.loads
+    if msgpack is not None:
+        yield 'msgpack', msgpack.packb, msgpack.unpackb
+    if cbor2 is not None:
+        yield 'cbor', cbor2.dumps, cbor2.loads
+
+def main(number=50000):
+    """print the size, gzipped size and parse cost of each response in each format"""
+    for label, body in (('token', TOKEN), ('new user', NEW_USER)):
+        for name, dumps, loads in formats():
+            data = dumps(body)
+            seconds = min(timeit.repeat(lambda: loads(data), number=number, repeat=5))
+            print('%-8s %-8s %5d bytes %5d gzipped %8.2f us/parse'
+                  % (label, name, len(data), len(gzip.compress(data)), seconds / number * 1e6))
+
+if __name__ == '__main__':
+    main()
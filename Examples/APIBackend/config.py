@@ -26,13 +26,173 @@ ALLOWED_ZENKEY_CLIENTS = ([c.split(':') for c in ALLOWED_ZENKEY_CLIENTS.split(',
 API_KEYS = os.getenv('API_KEYS')
 API_KEYS = API_KEYS.split(',') if API_KEYS else []
 
-# we use a very long expiration value because this example app does
-# not support refresh tokens. Your production code should use a much shorter expiration time
-TOKEN_EXPIRATION_TIME = timedelta(days=30)
+# The ADMIN_API_KEYS environment variable is a whitelist of API keys for the diagnostics
+# routes (/admin/...). Don't give these keys to API clients. The routes are unusable when
+# there are none
+ADMIN_API_KEYS = os.getenv('ADMIN_API_KEYS')
+ADMIN_API_KEYS = ADMIN_API_KEYS.split(',') if ADMIN_API_KEYS else []
+
+# the access tokens are short-lived: clients get a new one with their refresh token
+TOKEN_EXPIRATION_TIME = timedelta(seconds=int(os.getenv('TOKEN_EXPIRATION_SECONDS', '900')))
+# how long a refresh token can be used. Each use returns a new refresh token
+REFRESH_TOKEN_EXPIRATION_TIME = timedelta(days=int(os.getenv('REFRESH_TOKEN_EXPIRATION_DAYS',
+                                                             '30')))
+# where the hashes of the refresh tokens are stored: "memory" (per process) or "sqlite" (a
+# database file at REFRESH_TOKEN_STORE_PATH shared by every worker on the host)
+REFRESH_TOKEN_STORE_BACKEND = os.getenv('REFRESH_TOKEN_STORE_BACKEND', 'memory')
+REFRESH_TOKEN_STORE_PATH = os.getenv('REFRESH_TOKEN_STORE_PATH', 'refresh_tokens.sqlite3')
+# the time (in seconds) between two sweeps of the expired refresh tokens
+REFRESH_TOKEN_SWEEP_INTERVAL = int(os.getenv('REFRESH_TOKEN_SWEEP_INTERVAL', '60'))
+# save the carriers' refresh tokens, encrypted, to get fresh ZenKey user info without a
+# redirect: "off", "memory" (per process) or "sqlite" (a database file at
+# CARRIER_TOKEN_STORE_PATH shared by every worker on the host)
+CARRIER_TOKEN_STORE_BACKEND = os.getenv('CARRIER_TOKEN_STORE_BACKEND', 'off')
+CARRIER_TOKEN_STORE_PATH = os.getenv('CARRIER_TOKEN_STORE_PATH', 'carrier_tokens.sqlite3')
+# how long (in seconds) before a carrier access token expires it is refreshed in the background
+CARRIER_TOKEN_REFRESH_AHEAD = int(os.getenv('CARRIER_TOKEN_REFRESH_AHEAD', '60'))
+# how long (in seconds) after the user last signed in or refreshed their ZenKey info their
+# carrier tokens are kept fresh in the background
+CARRIER_TOKEN_KEEP_FRESH = int(os.getenv('CARRIER_TOKEN_KEEP_FRESH', '3600'))
+# how long (in seconds) after the user last signed in or refreshed their ZenKey info their
+# carrier tokens are forgotten
+CARRIER_TOKEN_MAX_IDLE = int(os.getenv('CARRIER_TOKEN_MAX_IDLE', '2592000'))
+# the time (in seconds) between two checks for carrier tokens due for a refresh. 0 disables
+# the background refresh
+CARRIER_TOKEN_REFRESH_INTERVAL = float(os.getenv('CARRIER_TOKEN_REFRESH_INTERVAL', '15'))
+# the claims of the JWTs we issue: "full" (the user attributes) or "minimal" (the user's IDs
+# and expiry only; the rest of the profile is available from /users/me)
+JWT_CLAIM_PROFILE = os.getenv('JWT_CLAIM_PROFILE', 'full')
+# use short claim names, like "em" instead of "email", in the JWTs we issue
+JWT_SHORT_CLAIMS = os.getenv('JWT_SHORT_CLAIMS', 'false').lower() == 'true'
 
 # Endpoint from which to get oidc provider configuration
 OIDC_PROVIDER_CONFIG_ENDPOINT = os.getenv('OIDC_PROVIDER_CONFIG_URL')
 
+# JSON backend used by Flask: "auto" uses orjson when it is installed, or choose
+# "orjson" or "stdlib" explicitly
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto')
+# the encodings of the responses, negotiated with the Accept header: "json,msgpack,cbor".
+# "auto" is JSON and the binary formats whose package (msgpack, cbor2) is installed
+RESPONSE_FORMATS = os.getenv('RESPONSE_FORMATS', 'auto')
+
+# compress the responses of at least this many bytes with gzip, or brotli when the brotli
+# package is installed, for the clients that accept it. 0 disables compression
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '500'))
+# from 1 (fastest) to 9 (smallest)
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', '6'))
+# the static files served at /static, loaded and compressed when the app starts
+STATIC_DIR = os.getenv('STATIC_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                  'static'))
+# how long (in seconds) a static file can be cached. Its versioned URL is cached for a year
+STATIC_MAX_AGE = int(os.getenv('STATIC_MAX_AGE', '86400'))
+
+# how long (in seconds) a /auth/zenkey-signin response is kept for clients that retry
+# with the same auth code. 0 disables the cache
+SIGNIN_REPLAY_CACHE_TTL = int(os.getenv('SIGNIN_REPLAY_CACHE_TTL', '60'))
+
+# the clock skew (in seconds) allowed when checking the exp and iat claims of id tokens
+ID_TOKEN_LEEWAY = int(os.getenv('ID_TOKEN_LEEWAY', '60'))
+# the minimum time (in seconds) between two downloads of a carrier's signing keys when an
+# id token is signed with an unknown key ID
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv('JWKS_MIN_REFRESH_INTERVAL', '60'))
+
+# where the nonces and JWT IDs of accepted id tokens are remembered: "memory" (per process)
+# or "sqlite" (a database file at REPLAY_STORE_PATH shared by every worker on the host)
+REPLAY_STORE_BACKEND = os.getenv('REPLAY_STORE_BACKEND', 'memory')
+REPLAY_STORE_PATH = os.getenv('REPLAY_STORE_PATH', 'replay_store.sqlite3')
+REPLAY_STORE_MAX_ENTRIES = int(os.getenv('REPLAY_STORE_MAX_ENTRIES', '100000'))
+# the longest time (in seconds) an id token is remembered. ID tokens that expire later (with
+# the ID_TOKEN_LEEWAY added) are rejected
+REPLAY_STORE_MAX_TTL = int(os.getenv('REPLAY_STORE_MAX_TTL', '7200'))
+
+# circuit breakers for each carrier endpoint: a breaker opens, and requests to that endpoint
+# fail fast with a 503, when at least CIRCUIT_BREAKER_FAILURE_RATE of the last
+# CIRCUIT_BREAKER_WINDOW_SIZE calls failed or CIRCUIT_BREAKER_SLOW_CALL_RATE of them took
+# longer than CIRCUIT_BREAKER_SLOW_CALL_SECONDS. It lets a trial call through after
+# CIRCUIT_BREAKER_OPEN_SECONDS
+CIRCUIT_BREAKER_FAILURE_RATE = float(os.getenv('CIRCUIT_BREAKER_FAILURE_RATE', '0.5'))
+CIRCUIT_BREAKER_SLOW_CALL_SECONDS = float(os.getenv('CIRCUIT_BREAKER_SLOW_CALL_SECONDS', '5'))
+CIRCUIT_BREAKER_SLOW_CALL_RATE = float(os.getenv('CIRCUIT_BREAKER_SLOW_CALL_RATE', '0.5'))
+CIRCUIT_BREAKER_WINDOW_SIZE = int(os.getenv('CIRCUIT_BREAKER_WINDOW_SIZE', '20'))
+CIRCUIT_BREAKER_MIN_CALLS = int(os.getenv('CIRCUIT_BREAKER_MIN_CALLS', '10'))
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.getenv('CIRCUIT_BREAKER_OPEN_SECONDS', '30'))
+# the maximum number of concurrent requests from each worker to one carrier
+CARRIER_MAX_CONCURRENT_REQUESTS = int(os.getenv('CARRIER_MAX_CONCURRENT_REQUESTS', '20'))
+# each carrier endpoint's timeout is twice the p99 latency of its recent calls, between
+# these two values (in seconds)
+CARRIER_TIMEOUT_MIN_SECONDS = float(os.getenv('CARRIER_TIMEOUT_MIN_SECONDS', '1'))
+CARRIER_TIMEOUT_MAX_SECONDS = float(os.getenv('CARRIER_TIMEOUT_MAX_SECONDS', '10'))
+# the time budget (in seconds) of a whole /auth/zenkey-signin request. Clients can ask for a
+# shorter one with the SIGNIN_DEADLINE_HEADER header, but not below SIGNIN_DEADLINE_MIN_SECONDS
+SIGNIN_DEADLINE_SECONDS = float(os.getenv('SIGNIN_DEADLINE_SECONDS', '15'))
+SIGNIN_DEADLINE_MIN_SECONDS = float(os.getenv('SIGNIN_DEADLINE_MIN_SECONDS', '2'))
+SIGNIN_DEADLINE_HEADER = 'X-Request-Timeout'
+
+# how long (in seconds) a failed discovery lookup for a client ID and mccmnc is remembered
+DISCOVERY_FAILURE_CACHE_TTL = int(os.getenv('DISCOVERY_FAILURE_CACHE_TTL', '60'))
+# the number of discovery lookups per second allowed for each mccmnc that has never been
+# discovered successfully. 0 disables the limit
+DISCOVERY_UNKNOWN_MCCMNC_RATE = float(os.getenv('DISCOVERY_UNKNOWN_MCCMNC_RATE', '5'))
+
+# record the requests made to ZenKey and the carriers to a cassette file, or replay them from
+# one without any network, for repeatable benchmarks: "off", "record" or "replay"
+HTTP_CASSETTE_MODE = os.getenv('HTTP_CASSETTE_MODE', 'off')
+HTTP_CASSETTE_PATH = os.getenv('HTTP_CASSETTE_PATH', 'carrier_cassette.jsonl.gz')
+# replayed responses take as long as they did when they were recorded
+HTTP_CASSETTE_REPLAY_TIMING = os.getenv('HTTP_CASSETTE_REPLAY_TIMING', 'false').lower() == 'true'
+
+# "async" writes the logs from a background thread through a bounded queue, and applies the
+# settings below. "sync" (the default) writes them from the thread that logs
+LOG_MODE = os.getenv('LOG_MODE', 'sync')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
+# "json" or "text"
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# the fraction of the records below WARNING that are kept, per logger: "urllib3=0.1,oic=0.5"
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES')
+# the number of records below WARNING kept per second, per logger: "urllib3=50"
+LOG_RATE_LIMITS = os.getenv('LOG_RATE_LIMITS')
+# omit a traceback that was already logged from the same place within this many seconds.
+# 0 keeps every traceback
+LOG_EXCEPTION_DEDUP_SECONDS = int(os.getenv('LOG_EXCEPTION_DEDUP_SECONDS', '60'))
+# the number of records waiting to be written before new ones are dropped
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+# profile a request when its PROFILER_HEADER header is set to PROFILER_SECRET, or at random for
+# PROFILER_SAMPLE_RATE of the requests. "sampling" mode writes folded stacks for flame graphs,
+# "cprofile" mode writes cProfile stats. The profiles are saved in PROFILER_OUTPUT_DIR
+PROFILER_SECRET = os.getenv('PROFILER_SECRET')
+PROFILER_HEADER = 'X-Profile-Request'
+PROFILER_SAMPLE_RATE = float(os.getenv('PROFILER_SAMPLE_RATE', '0'))
+PROFILER_MODE = os.getenv('PROFILER_MODE', 'sampling')
+PROFILER_OUTPUT_DIR = os.getenv('PROFILER_OUTPUT_DIR', 'profiles')
+# log the requests that take longer than this many seconds, with the time spent in each
+# phase. 0 disables the log
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', '0'))
+
+# trace a sample of the requests, with a span for each phase of the sign-in, and export the
+# spans in batches to a sink: "file" (JSON lines in TRACING_FILE), "log", or a callable that
+# takes a list of spans, as "package.module:name". Unset disables tracing
+TRACING_SINK = os.getenv('TRACING_SINK')
+TRACING_FILE = os.getenv('TRACING_FILE', 'traces.jsonl')
+TRACING_SAMPLE_RATE = float(os.getenv('TRACING_SAMPLE_RATE', '1'))
+TRACING_BATCH_SIZE = int(os.getenv('TRACING_BATCH_SIZE', '100'))
+# the longest time (in seconds) a finished span waits to be exported
+TRACING_FLUSH_INTERVAL = float(os.getenv('TRACING_FLUSH_INTERVAL', '5'))
+
+# trace memory allocations with tracemalloc from the start, instead of from the first
+# snapshot taken with POST /admin/memory/snapshots. Tracing slows down every allocation
+MEMORY_TRACEMALLOC = os.getenv('MEMORY_TRACEMALLOC', 'false').lower() == 'true'
+# the number of frames kept for each traced allocation
+MEMORY_TRACEMALLOC_FRAMES = int(os.getenv('MEMORY_TRACEMALLOC_FRAMES', '10'))
+# take a snapshot and log the top allocation growth when a worker's RSS goes over this
+# many megabytes, then again each time it grows by MEMORY_RSS_STEP_MB. 0 disables it
+MEMORY_RSS_THRESHOLD_MB = int(os.getenv('MEMORY_RSS_THRESHOLD_MB', '0'))
+MEMORY_RSS_STEP_MB = int(os.getenv('MEMORY_RSS_STEP_MB', '64'))
+# the minimum time (in seconds) between two RSS checks
+MEMORY_RSS_CHECK_INTERVAL = float(os.getenv('MEMORY_RSS_CHECK_INTERVAL', '60'))
+# also dump the snapshots to this directory, for offline analysis with tracemalloc
+MEMORY_SNAPSHOT_DIR = os.getenv('MEMORY_SNAPSHOT_DIR')
+
 BASE_URL = os.getenv('BASE_URL')
 PARSED_URL = urlparse(BASE_URL)
 HOSTNAME = PARSED_URL.hostname
@@ -14,20 +14,25 @@
 import logging
 import os
 from urllib.parse import urlparse
-import json
 from flask import Flask, redirect, render_template, request, session
 from flask.helpers import url_for
-from werkzeug.exceptions import Unauthorized
+from werkzeug.exceptions import BadRequest, Unauthorized
 from oic.oauth2.message import TokenErrorResponse
-from oic.oic import Client
-from oic.oic.message import (ProviderConfigurationResponse,
-                             RegistrationResponse)
-from oic.utils.authn.client import CLIENT_AUTHN_METHOD
 from oic.utils.http_util import Redirect
-from zenkey_oidc_service import ZenKeyOIDCService, ZenKeySchema
+from zenkey_oidc_service import ZenKeyOIDCService
+from zenkey_codec import ZenKeyTokens, ZenKeyUserInfo
 from authorization_flow_handler import AuthorizationFlowHandler
-from utilities import get_current_user
+from utilities import get_current_user, set_current_user
+from json_provider import init_json_provider
+from log_pipeline import ASYNC, LogPipeline, parse_logger_settings
 from session_service import SessionService
+from flow_state_service import FlowStateService
+from remembered_carrier_service import RememberedCarrierService
+from carrier_token_service import CarrierTokenService
+from openid_client_cache import OpenIDClientCache
+from id_token_verifier import IdTokenVerifier
+from http_cassette import create_http_session
+from request_profiler import RequestProfiler
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -36,6 +41,62 @@ CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
 SECRET_KEY_BASE = os.getenv('SECRET_KEY_BASE')
 BASE_URL = os.getenv('BASE_URL')
+# JSON backend: "auto" uses orjson when it is installed, or choose "orjson" or "stdlib"
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto')
+# keep the in-flight auth flow values in an encrypted state parameter instead of the session
+STATELESS_FLOW_STATE = os.getenv('STATELESS_FLOW_STATE', 'false').lower() == 'true'
+# how long (in seconds) a stateless flow state stays valid
+FLOW_STATE_MAX_AGE = int(os.getenv('FLOW_STATE_MAX_AGE', '600'))
+# remember the user's carrier in a cookie so returning users can skip carrier discovery
+REMEMBER_CARRIER = os.getenv('REMEMBER_CARRIER', 'false').lower() == 'true'
+# how long (in seconds) to remember the carrier, defaults to 90 days
+REMEMBER_CARRIER_MAX_AGE = int(os.getenv('REMEMBER_CARRIER_MAX_AGE', str(90 * 24 * 60 * 60)))
+# keep the carrier's tokens, encrypted, in the session to refresh the userinfo server-to-server
+# instead of signing in again
+SAVE_CARRIER_TOKENS = os.getenv('SAVE_CARRIER_TOKENS', 'false').lower() == 'true'
+# how long (in seconds) before the carrier's access token expires it is refreshed
+CARRIER_TOKEN_REFRESH_AHEAD = int(os.getenv('CARRIER_TOKEN_REFRESH_AHEAD', '60'))
+# how long (in seconds) each worker reuses a carrier's discovered OIDC configuration
+PROVIDER_CONFIG_CACHE_TTL = int(os.getenv('PROVIDER_CONFIG_CACHE_TTL', '3600'))
+# how long (in seconds) each worker remembers that a carrier's OIDC configuration couldn't be
+# discovered
+PROVIDER_CONFIG_FAILURE_TTL = int(os.getenv('PROVIDER_CONFIG_FAILURE_TTL', '60'))
+# the clock skew (in seconds) allowed when checking the exp and iat claims of id tokens
+ID_TOKEN_LEEWAY = int(os.getenv('ID_TOKEN_LEEWAY', '60'))
+# the minimum time (in seconds) between two downloads of a carrier's signing keys
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv('JWKS_MIN_REFRESH_INTERVAL', '60'))
+# record the requests made to ZenKey and the carriers to a cassette file, or replay them from
+# one without any network, for repeatable benchmarks: "off", "record" or "replay"
+HTTP_CASSETTE_MODE = os.getenv('HTTP_CASSETTE_MODE', 'off')
+HTTP_CASSETTE_PATH = os.getenv('HTTP_CASSETTE_PATH', 'carrier_cassette.jsonl.gz')
+# replayed responses take as long as they did when they were recorded
+HTTP_CASSETTE_REPLAY_TIMING = os.getenv('HTTP_CASSETTE_REPLAY_TIMING', 'false').lower() == 'true'
+# profile a request when its X-Profile-Request header is set to PROFILER_SECRET, or at random
+# for PROFILER_SAMPLE_RATE of the requests: "sampling" or "cprofile"
+PROFILER_SECRET = os.getenv('PROFILER_SECRET')
+PROFILER_SAMPLE_RATE = float(os.getenv('PROFILER_SAMPLE_RATE', '0'))
+PROFILER_MODE = os.getenv('PROFILER_MODE', 'sampling')
+PROFILER_OUTPUT_DIR = os.getenv('PROFILER_OUTPUT_DIR', 'profiles')
+# log the requests that take longer than this many seconds. 0 disables the log
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', '0'))
+# "async" writes the logs from a background thread through a bounded queue, as JSON or text,
+# with per-logger sampling ("urllib3=0.1") and rate limits ("urllib3=50" records per second)
+# for the records below WARNING, and omits repeated tracebacks
+LOG_MODE = os.getenv('LOG_MODE', 'sync')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES')
+LOG_RATE_LIMITS = os.getenv('LOG_RATE_LIMITS')
+LOG_EXCEPTION_DEDUP_SECONDS = int(os.getenv('LOG_EXCEPTION_DEDUP_SECONDS', '60'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+if LOG_MODE == ASYNC:
+    LogPipeline(level=LOG_LEVEL,
+                log_format=LOG_FORMAT,
+                sample_rates=parse_logger_settings(LOG_SAMPLE_RATES),
+                rate_limits=parse_logger_settings(LOG_RATE_LIMITS),
+                dedup_window=LOG_EXCEPTION_DEDUP_SECONDS,
+                queue_size=LOG_QUEUE_SIZE).install()
 
 # configure the app based on the base URL
 PARSED_URL = urlparse(BASE_URL)
@@ -53,11 +114,130 @@ application = Flask(__name__) # pylint: disable=invalid-name
 application.config.update({'SERVER_NAME': SERVER_NAME,
                            'SESSION_COOKIE_DOMAIN': SESSION_COOKIE_DOMAIN,
                            'SECRET_KEY': SECRET_KEY_BASE})
+# use the fastest available JSON backend for the session and the userinfo we store in it
+init_json_provider(application, JSON_BACKEND)
+# profile requests on demand and log the slow ones, when configured
+if PROFILER_SECRET or PROFILER_SAMPLE_RATE or SLOW_REQUEST_SECONDS:
+    application.wsgi_app = RequestProfiler(application.wsgi_app,
+                                           output_dir=PROFILER_OUTPUT_DIR,
+                                           secret=PROFILER_SECRET,
+                                           sample_rate=PROFILER_SAMPLE_RATE,
+                                           mode=PROFILER_MODE,
+                                           slow_request_seconds=SLOW_REQUEST_SECONDS)
 
 SCOPE = ['openid', 'name', 'email', 'phone', 'postal_code']
 PROVIDER_NAME = 'zenkey'
 
 session_service = SessionService(session) # pylint: disable=invalid-name
+flow_state_service = (FlowStateService(SECRET_KEY_BASE, session, # pylint: disable=invalid-name
+                                       FLOW_STATE_MAX_AGE)
+                      if STATELESS_FLOW_STATE
+                      else None)
+remembered_carrier_service = (RememberedCarrierService( # pylint: disable=invalid-name
+    SECRET_KEY_BASE,
+    REMEMBER_CARRIER_MAX_AGE,
+    cookie_domain=SESSION_COOKIE_DOMAIN,
+    secure=not IS_LOCAL) if REMEMBER_CARRIER else None)
+carrier_token_service = (CarrierTokenService( # pylint: disable=invalid-name
+    SECRET_KEY_BASE,
+    CARRIER_TOKEN_REFRESH_AHEAD) if SAVE_CARRIER_TOKENS else None)
+
+openid_client_cache = OpenIDClientCache(CLIENT_ID, CLIENT_SECRET, # pylint: disable=invalid-name
+                                        PROVIDER_CONFIG_CACHE_TTL,
+                                        PROVIDER_CONFIG_FAILURE_TTL)
+# one requests session for every request to ZenKey and the carriers
+http_session = create_http_session(HTTP_CASSETTE_MODE, # pylint: disable=invalid-name
+                                   HTTP_CASSETTE_PATH,
+                                   HTTP_CASSETTE_REPLAY_TIMING)
+id_token_verifier = IdTokenVerifier(leeway=ID_TOKEN_LEEWAY, # pylint: disable=invalid-name
+                                    min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                                    session=http_session)
+# built once per process, before the first request, by configure_zenkey_oidc_service()
+zenkey_oidc_service = None # pylint: disable=invalid-name
+
+def auth_code_redirect(openid_client, auth_flow_handler, login_hint_token, state, mccmnc):
+    """
+    Request an auth code
+    Send the user to the ZenKey authorization endpoint. After authorization, this endpoint
+    will redirect back to our app with an auth code.
+    """
+    if auth_flow_handler.authorization_in_progress():
+        # authorization is in progress
+        auth_kwargs = {
+            # only openid scope is needed for this auth request
+            'scope':  ['openid'],
+            # add the context and acr value to the auth request
+            'context': auth_flow_handler.get_authorization_details().get('context'),
+            'acr_values': 'a3'
+        }
+    else:
+        # no authorization in progress: do a standard login authorization
+        auth_kwargs = {
+            'scope': SCOPE
+        }
+
+    authorization_url = zenkey_oidc_service.get_auth_code_request_url(openid_client,
+                                                                      login_hint_token,
+                                                                      state,
+                                                                      mccmnc,
+                                                                      **auth_kwargs)
+    return Redirect(authorization_url)
+
+@application.before_first_request
+def configure_zenkey_oidc_service():
+    """
+    Precompute per-process values: the redirect URI never changes, so the
+    ZenKeyOIDCService is built once instead of on every request
+    """
+    global zenkey_oidc_service # pylint: disable=invalid-name,global-statement
+    redirect_uri = url_for('auth_callback',
+                           _external=True,
+                           _scheme=('http' if IS_LOCAL else 'https'))
+    zenkey_oidc_service = ZenKeyOIDCService(CLIENT_ID, CLIENT_SECRET, redirect_uri, session_service,
+                                            flow_state_service, id_token_verifier, http_session)
+
+@application.before_request
+def refresh_carrier_tokens():
+    """
+    Refresh the saved carrier tokens ahead of their expiry, server-to-server, while the user
+    is browsing: the tokens live in the session, which can only be updated by a request
+    """
+    if (carrier_token_service is None or request.endpoint in ('static', 'logout') or
+            not carrier_token_service.refresh_due(session)):
+        return
+    try:
+        fresh_carrier_tokens()
+    except Exception: # pylint: disable=broad-except
+        # the saved tokens are refreshed again on the next request
+        application.logger.exception('unable to refresh the carrier tokens')
+
+def fresh_carrier_tokens():
+    """
+    Get the saved carrier tokens, refreshed first when their access token is about to expire
+    Returns the OpenID client and the tokens, or None when no tokens are saved or the
+    carrier rejected the refresh token
+    """
+    record = carrier_token_service.load(session)
+    if record is None:
+        return None
+    current_user = get_current_user(session)
+    openid_client = openid_client_cache.get_client(zenkey_oidc_service, record['mccmnc'])
+    if current_user is None or openid_client is None:
+        carrier_token_service.clear(session)
+        return None
+    if not carrier_token_service.needs_refresh(record):
+        return openid_client, record
+
+    def refresh_tokens(refresh_token):
+        tokens = zenkey_oidc_service.refresh_tokens(openid_client, refresh_token,
+                                                    current_user['sub'])
+        return tokens if isinstance(tokens, ZenKeyTokens) else None
+
+    record = carrier_token_service.refresh(session, record, refresh_tokens)
+    if record is None:
+        # the refresh token has expired or was revoked: fresh userinfo needs a sign in
+        return None
+    return openid_client, record
 
 @application.errorhandler(500)
 def internal_server_error(error):
@@ -69,7 +249,10 @@ def index():
     """homepage route"""
     current_user = get_current_user(session)
     message = request.args.get('message')
-    return render_template('home.html', current_user=current_user, message=message)
+    can_refresh_userinfo = (current_user is not None and carrier_token_service is not None and
+                            carrier_token_service.load(session) is not None)
+    return render_template('home.html', current_user=current_user, message=message,
+                           can_refresh_userinfo=can_refresh_userinfo)
 
 @application.route('/auth')
 def carrier_discovery():
@@ -79,13 +262,26 @@ def carrier_discovery():
     This endpoint will redirect the user back to our app, giving us
     the mccmnc that identifes the user's carrier.
     """
-    redirect_uri = url_for('auth_callback',
-                           _external=True,
-                           _scheme=('http' if IS_LOCAL else 'https'))
+    remembered_mccmnc = (remembered_carrier_service.get_mccmnc(request)
+                         if remembered_carrier_service is not None
+                         else None)
+    if remembered_mccmnc is not None:
+        openid_client = openid_client_cache.get_client(zenkey_oidc_service, remembered_mccmnc)
+        if openid_client is not None:
+            # returning user: we already know their carrier, so skip the carrier discovery UI
+            # and go straight to the authorization endpoint
+            return auth_code_redirect(openid_client,
+                                      AuthorizationFlowHandler(session),
+                                      None,
+                                      zenkey_oidc_service.create_discovery_state(),
+                                      remembered_mccmnc)
 
-    zenkey_oidc_service = ZenKeyOIDCService(CLIENT_ID, CLIENT_SECRET, redirect_uri, session_service)
     carrier_discovery_url = zenkey_oidc_service.carrier_discovery_redirect()
-    return redirect(carrier_discovery_url)
+    response = redirect(carrier_discovery_url)
+    if remembered_mccmnc is not None:
+        # the remembered carrier is no longer valid
+        remembered_carrier_service.forget(response)
+    return response
 
 
 @application.route('/auth/cb')
@@ -98,17 +294,18 @@ def auth_callback():
     state = request.args.get('state')
     code = request.args.get('code')
     current_user = get_current_user(session)
-    redirect_uri = url_for('auth_callback', _external=True,
-                           _scheme=('http' if IS_LOCAL else 'https'))
-
-    zenkey_oidc_service = ZenKeyOIDCService(CLIENT_ID, CLIENT_SECRET, redirect_uri, session_service)
     auth_flow_handler = AuthorizationFlowHandler(session)
 
     # handle errors returned from ZenKey
     if error is not None:
+        session_service.clear()
+        if (error != 'access_denied' and remembered_carrier_service is not None and
+                remembered_carrier_service.get_mccmnc(request) is not None):
+            # the carrier rejected the remembered carrier hint: forget it and restart
+            # with the full carrier discovery flow
+            return remembered_carrier_service.forget(redirect('/auth'))
         # if an error happens, delete the auth information saved in the session
         auth_flow_handler.delete_authorization_details()
-        session_service.clear()
         raise Exception(error)
 
     # check if the user is already logged in
@@ -116,7 +313,9 @@ def auth_callback():
         return redirect('/')
 
     # use a cached MCCMNC if needed
-    mccmnc = request.args.get('mccmnc', session_service.get_mccmnc())
+    mccmnc = request.args.get('mccmnc')
+    if mccmnc is None:
+        mccmnc = zenkey_oidc_service.get_cached_mccmnc(state)
 
     # If we have no mccmnc, begin the carrier discovery process
     if mccmnc is None:
@@ -127,52 +326,19 @@ def auth_callback():
         auth_flow_handler.delete_authorization_details()
         raise Exception('missing state')
 
-    # build our OpenID client
-    openid_client = Client(client_authn_method=CLIENT_AUTHN_METHOD, client_id=CLIENT_ID)
-    # save the client information to the OIDC client
-    client_registration_info = RegistrationResponse(**{
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET})
-    openid_client.store_registration_info(client_registration_info)
-    # discover the carrier OIDC endpoint configuration
-    oidc_configuration = zenkey_oidc_service.discover_oidc_provider_metadata(mccmnc)
-    # save the provider config to the OIDC client after we've discovered it
-    provider_configuration = ProviderConfigurationResponse(**oidc_configuration)
-    openid_client.handle_provider_config(
-        provider_configuration,
-        provider_configuration['issuer'],
-        True,
-        True)
+    # the client configured for this carrier is shared by both legs of the flow
+    openid_client = openid_client_cache.get_client(zenkey_oidc_service, mccmnc)
+    if openid_client is None:
+        # an unknown or unsupported mccmnc
+        auth_flow_handler.delete_authorization_details()
+        raise BadRequest('unable to fetch provider metadata')
 
     if code is None:
         # Request an auth code
         # The carrier discovery endpoint has redirected back to our app with the mccmnc.
         # Now we can start the authorize flow by requesting an auth code.
-        # Send the user to the ZenKey authorization endpoint. After authorization, this endpoint
-        # will redirect back to our app with an auth code.
-
-
-        if auth_flow_handler.authorization_in_progress():
-            # authorization is in progress
-            auth_kwargs = {
-                # only openid scope is needed for this auth request
-                'scope':  ['openid'],
-                # add the context and acr value to the auth request
-                'context': auth_flow_handler.get_authorization_details().get('context'),
-                'acr_values': 'a3'
-            }
-        else:
-            # no authorization in progress: do a standard login authorization
-            auth_kwargs = {
-                'scope': SCOPE
-            }
-
-        authorization_url = zenkey_oidc_service.get_auth_code_request_url(openid_client,
-                                                                          login_hint_token,
-                                                                          state,
-                                                                          mccmnc,
-                                                                          **auth_kwargs)
-        return Redirect(authorization_url)
+        return auth_code_redirect(openid_client, auth_flow_handler, login_hint_token, state,
+                                  mccmnc)
 
     if code:
         # Token exchange:
@@ -190,12 +356,12 @@ def auth_callback():
         # if auth in progress, do the auth thing
         # otherwise do the userinfo call and login
         if auth_flow_handler.authorization_in_progress():
-            return auth_flow_handler.success_router(token_response)
+            return remember_carrier(auth_flow_handler.success_router(token_response), mccmnc)
 
         # fetch the userinfo from the API
         userinfo = zenkey_oidc_service.get_userinfo(openid_client, token_response["access_token"])
 
-        if not isinstance(userinfo, ZenKeySchema):
+        if not isinstance(userinfo, ZenKeyUserInfo):
             # the userinfo request failed
             raise Unauthorized("%s: %s" % (userinfo.get('error'),
                                            userinfo.get('error_description')))
@@ -207,12 +373,44 @@ def auth_callback():
         # these values can be saved for the user or used to auto-populate a registration form
 
         # save the userinfo in the session and return to the homepage: now the user is logged in
-        session['userinfo'] = json.dumps(userinfo.to_dict())
-        return redirect('/')
+        set_current_user(session, userinfo.to_dict())
+        if carrier_token_service is not None:
+            # keep the carrier's tokens to refresh the userinfo later without a redirect
+            carrier_token_service.save(session, mccmnc, token_response)
+        return remember_carrier(redirect('/'), mccmnc)
 
     # If we have no mccmnc, begin the carrier discovery process
     return redirect('/auth')
 
+def remember_carrier(response, mccmnc):
+    """
+    After a successful sign in, remember the user's carrier for next time
+    """
+    if remembered_carrier_service is not None:
+        remembered_carrier_service.remember(response, mccmnc)
+    return response
+
+@application.route('/refresh-userinfo', methods=['POST'])
+def refresh_userinfo():
+    """
+    Get fresh userinfo from the carrier with the saved tokens: one server-to-server call
+    instead of carrier discovery and the authorization redirect. Without usable saved
+    tokens, the user signs in again
+    """
+    carrier_tokens = fresh_carrier_tokens() if carrier_token_service is not None else None
+    if carrier_tokens is None:
+        return redirect('/auth')
+    openid_client, record = carrier_tokens
+
+    userinfo = zenkey_oidc_service.get_userinfo(openid_client, record['access_token'])
+    if not isinstance(userinfo, ZenKeyUserInfo):
+        # the carrier revoked the access token: sign in again
+        carrier_token_service.clear(session)
+        return redirect('/auth')
+
+    set_current_user(session, userinfo.to_dict())
+    return redirect(url_for('index', message='Your user info is up to date'))
+
 @application.route('/authorize-transaction', methods=['POST'])
 def authorize_transaction():
     """
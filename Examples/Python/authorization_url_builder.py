@@ -0,0 +1,79 @@
+# Copyright 2020 ZenKey, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from functools import lru_cache
+from urllib.parse import quote, quote_plus
+
+# These helpers build the carrier discovery and authorization redirect URLs.
+# The parameters that are the same for every login (endpoint, client ID, redirect URI and
+# scope) are encoded once into a cached prefix, and only the per-request values are encoded
+# on each login. The output is byte-identical to the URLs built by Pyoidc's
+# construct_AuthorizationRequest(...).request(authorization_endpoint).
+
+def join_scope(scope):
+    """scopes can be given as a list or a space separated string"""
+    if isinstance(scope, str):
+        return scope
+    return ' '.join(scope)
+
+@lru_cache(maxsize=64)
+def carrier_discovery_url_prefix(carrier_discovery_endpoint, client_id, redirect_uri):
+    """
+    The static, already encoded part of the carrier discovery URL
+    """
+    return '%s?client_id=%s&redirect_uri=%s&state=' % (carrier_discovery_endpoint,
+                                                        quote(client_id, safe=''),
+                                                        quote(redirect_uri, safe=''))
+
+def build_carrier_discovery_url(carrier_discovery_endpoint, client_id, redirect_uri, state):
+    """
+    Build the URL that sends the user to the ZenKey carrier discovery UI
+    """
+    return (carrier_discovery_url_prefix(carrier_discovery_endpoint, client_id, redirect_uri) +
+            quote(state, safe=''))
+
+@lru_cache(maxsize=64)
+def authorization_url_prefix(authorization_endpoint, client_id, redirect_uri, scope):
+    """
+    The static, already encoded part of the authorization URL
+    """
+    return '%s%sclient_id=%s&response_type=code&scope=%s&redirect_uri=%s' % (
+        authorization_endpoint,
+        '&' if '?' in authorization_endpoint else '?',
+        quote_plus(client_id),
+        quote_plus(scope),
+        quote_plus(redirect_uri))
+
+def build_authorization_url(authorization_endpoint, client_id, redirect_uri, scope, state, nonce,
+                            login_hint_token, code_challenge, code_challenge_method, context=None,
+                            acr_values=None):
+    """
+    Build the URL that sends the user to the carrier's authorization endpoint to
+    request an auth code
+
+    Like Pyoidc, optional parameters that are None or empty are left out
+    """
+    url = authorization_url_prefix(authorization_endpoint, client_id, redirect_uri,
+                                   join_scope(scope))
+    per_request_params = (
+        ('state', state),
+        ('nonce', nonce),
+        ('login_hint_token', login_hint_token),
+        ('code_challenge', code_challenge),
+        ('code_challenge_method', code_challenge_method),
+        ('context', context),
+        ('acr_values', None if acr_values is None else join_scope(acr_values)),
+    )
+    return url + ''.join('&%s=%s' % (key, quote_plus(value))
+                         for key, value in per_request_params
+                         if value)
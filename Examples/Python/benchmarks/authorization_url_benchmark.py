@@ -0,0 +1,114 @@
+"""
+Compare the authorization URL builder with Pyoidc's construct_AuthorizationRequest()
+
+Before timing, this checks that both produce byte-identical URLs for a few thousand
+randomized requests.
+
+run from the project root:
+    python -m benchmarks.authorization_url_benchmark
+"""
+import random
+import string
+import timeit
+
+from oic import rndstr
+from oic.oic import Client
+from oic.utils.authn.client import CLIENT_AUTHN_METHOD
+
+from authorization_url_builder import build_authorization_url
+
+ENDPOINTS = [
+    'https://oidc.example.com/authorize',
+    'https://oidc.example.com/authorize?tenant=zenkey',
+]
+REDIRECT_URIS = [
+    'http://localhost:5000/auth/cb',
+    'https://example.com/auth/cb?next=/checkout&x=1',
+]
+SCOPES = [
+    'openid',
+    ['openid'],
+    ['openid', 'name', 'email', 'phone', 'postal_code'],
+]
+# characters that need escaping, including non-ASCII text
+ALPHABET = string.ascii_letters + string.digits + ' -._~!*\'()/?&=+%#:;,@$' + 'éü€漢'
+
+def random_text(rng, max_length=24):
+    """a random string that is never empty"""
+    return ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(1, max_length)))
+
+def build_client(authorization_endpoint, client_id):
+    """an OpenID client with just the settings the authorization URL needs"""
+    openid_client = Client(client_authn_method=CLIENT_AUTHN_METHOD, client_id=client_id)
+    openid_client.authorization_endpoint = authorization_endpoint
+    return openid_client
+
+def pyoidc_url(openid_client, request_args):
+    """the URL the way ZenKeyOIDCService built it with Pyoidc"""
+    request_args = dict((key, value) for key, value in request_args.items()
+                        if key not in ('context', 'acr_values') or value is not None)
+    auth_request = openid_client.construct_AuthorizationRequest(request_args=request_args)
+    return auth_request.request(openid_client.authorization_endpoint)
+
+def builder_url(openid_client, request_args):
+    """the URL built with the authorization URL builder"""
+    return build_authorization_url(openid_client.authorization_endpoint,
+                                   request_args['client_id'],
+                                   request_args['redirect_uri'],
+                                   request_args['scope'],
+                                   state=request_args['state'],
+                                   nonce=request_args['nonce'],
+                                   login_hint_token=request_args['login_hint_token'],
+                                   code_challenge=request_args['code_challenge'],
+                                   code_challenge_method=request_args['code_challenge_method'],
+                                   context=request_args['context'],
+                                   acr_values=request_args['acr_values'])
+
+def random_request(rng):
+    """random inputs for one authorization redirect"""
+    openid_client = build_client(rng.choice(ENDPOINTS), random_text(rng))
+    pkce_args, _ = openid_client.add_code_challenge()
+    request_args = {
+        'client_id': openid_client.client_id,
+        'response_type': 'code',
+        'scope': rng.choice(SCOPES),
+        'redirect_uri': rng.choice(REDIRECT_URIS),
+        'state': random_text(rng, 64),
+        'nonce': rndstr(),
+        'login_hint_token': rng.choice([None, random_text(rng, 128)]),
+        'code_challenge': pkce_args['code_challenge'],
+        'code_challenge_method': pkce_args['code_challenge_method'],
+        'context': rng.choice([None, random_text(rng)]),
+        'acr_values': rng.choice([None, 'a1', 'a3', 'a1 a3']),
+    }
+    return openid_client, request_args
+
+def check_equivalence(count=2000, seed=0):
+    """raise an AssertionError if the two implementations ever disagree"""
+    rng = random.Random(seed)
+    for _ in range(count):
+        openid_client, request_args = random_request(rng)
+        expected = pyoidc_url(openid_client, request_args)
+        actual = builder_url(openid_client, request_args)
+        assert actual == expected, '%s != %s' % (actual, expected)
+    print('%d randomized requests produced identical URLs' % count)
+
+def main(number=20000):
+    """check the builder then time each implementation and print the cost per call"""
+    check_equivalence()
+
+    rng = random.Random(1)
+    openid_client, request_args = random_request(rng)
+    request_args.update(client_id='zenkey-client-id', scope=SCOPES[-1], context=None,
+                        acr_values=None)
+    openid_client.client_id = request_args['client_id']
+    cases = [
+        ('pyoidc construct_AuthorizationRequest', lambda: pyoidc_url(openid_client, request_args)),
+        ('authorization_url_builder', lambda: builder_url(openid_client, request_args)),
+    ]
+    for label, case in cases:
+        seconds = min(timeit.repeat(case, number=number, repeat=5))
+        print('%-40s %8.2f us/call' % (label, seconds / number * 1e6))
+
+if __name__ == '__main__':
+    main()
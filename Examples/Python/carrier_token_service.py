@@ -0,0 +1,159 @@
+# Copyright 2020 ZenKey, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from base64 import urlsafe_b64encode
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+from cryptography.fernet import Fernet, InvalidToken
+
+class PendingRefresh:
+    """a refresh of one refresh token, and its result once it is done"""
+    __slots__ = ('lock', 'done', 'record')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = False
+        self.record = None
+
+class CarrierTokenService:
+    """
+    a service for keeping the carrier's tokens in the session, encrypted, so fresh userinfo
+    can be fetched server-to-server later instead of sending the user through carrier
+    discovery and authorization again
+
+    Flask sessions are signed but not encrypted cookies, so the tokens are encrypted and
+    authenticated with a Fernet key derived from the secret key before they are saved.
+    The time of the next refresh is saved in the clear, so requests can tell whether the
+    tokens are due for a refresh without decrypting them.
+
+    Concurrent requests from the same browser carry the same refresh token. The first one
+    refreshes it and the others wait for its result, which is kept for result_ttl seconds,
+    instead of using the refresh token again: carriers can rotate them. This is per process.
+    """
+
+    session_key = 'zenkey_carrier_tokens'
+    refresh_at_key = 'zenkey_carrier_tokens_refresh_at'
+
+    def __init__(self, secret_key, refresh_ahead=60, result_ttl=60, lock_timeout=30):
+        # derive a dedicated Fernet key so the session signing key is never used directly
+        key_material = hashlib.sha256(('zenkey-carrier-tokens:%s' % secret_key).encode('utf-8'))
+        self.fernet = Fernet(urlsafe_b64encode(key_material.digest()))
+        # how long (in seconds) before the access token expires it is refreshed
+        self.refresh_ahead = refresh_ahead
+        self.result_ttl = result_ttl
+        # how long (in seconds) a request waits for another one refreshing the same token
+        self.lock_timeout = lock_timeout
+        # refresh token hash: (expires_at, PendingRefresh). Every entry has the same TTL, so
+        # insertion order is also expiry order
+        self.refreshes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def save(self, session, mccmnc, tokens, previous=None):
+        """
+        save the tokens in the session. The previous refresh token is kept when the carrier
+        doesn't rotate it; nothing is saved when there is no refresh token
+        """
+        refresh_token = tokens.get('refresh_token') or (previous or {}).get('refresh_token')
+        if refresh_token is None:
+            return None
+        # a carrier that doesn't say how long its access token lasts gets 5 minutes
+        record = {
+            'mccmnc': mccmnc,
+            'refresh_token': refresh_token,
+            'access_token': tokens['access_token'],
+            'expires_at': time.time() + int(tokens.get('expires_in', 300)),
+        }
+        self._save_record(session, record)
+        return record
+
+    def _save_record(self, session, record):
+        serialized = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        session[self.session_key] = self.fernet.encrypt(serialized).decode('ascii')
+        session[self.refresh_at_key] = record['expires_at'] - self.refresh_ahead
+
+    def load(self, session):
+        """
+        get the saved tokens from the session, or None if there aren't any valid ones
+        """
+        encrypted = session.get(self.session_key)
+        if encrypted is None:
+            return None
+        try:
+            return json.loads(self.fernet.decrypt(encrypted.encode('ascii')))
+        except (InvalidToken, UnicodeEncodeError, ValueError):
+            # encrypted with another secret key
+            self.clear(session)
+            return None
+
+    def clear(self, session):
+        """
+        forget the saved tokens, e.g. when the carrier has revoked them
+        """
+        session.pop(self.session_key, None)
+        session.pop(self.refresh_at_key, None)
+
+    def needs_refresh(self, record):
+        """
+        whether the access token expires within refresh_ahead seconds
+        """
+        return record['expires_at'] - self.refresh_ahead <= time.time()
+
+    def refresh_due(self, session):
+        """
+        whether the session has saved tokens that need a refresh, without decrypting them
+        """
+        refresh_at = session.get(self.refresh_at_key)
+        return refresh_at is not None and refresh_at <= time.time()
+
+    def refresh(self, session, record, refresh_tokens):
+        """
+        Refresh the saved tokens and save the new ones in the session, unless another
+        request is already refreshing the same refresh token: then wait for its result.
+        refresh_tokens(refresh_token) returns the new tokens, or None when the carrier
+        rejects the refresh token. Returns the new record, or None after a rejection
+        """
+        key = hashlib.sha256(record['refresh_token'].encode('utf-8')).digest()
+        now = time.time()
+        with self.lock:
+            while self.refreshes:
+                oldest, (expires_at, _) = next(iter(self.refreshes.items()))
+                if expires_at > now:
+                    break
+                del self.refreshes[oldest]
+            pending = self.refreshes.get(key, (None, None))[1]
+            if pending is None:
+                pending = PendingRefresh()
+                self.refreshes[key] = (now + self.result_ttl, pending)
+
+        if not pending.lock.acquire(timeout=self.lock_timeout):
+            raise Exception('timed out waiting for another refresh of the carrier tokens')
+        try:
+            if pending.done:
+                # another request refreshed the tokens while we waited: save its result
+                if pending.record is not None:
+                    self._save_record(session, pending.record)
+            else:
+                tokens = refresh_tokens(record['refresh_token'])
+                if tokens is not None:
+                    pending.record = self.save(session, record['mccmnc'], tokens, record)
+                pending.done = True
+        finally:
+            pending.lock.release()
+
+        if pending.record is None:
+            # the refresh token has expired or was revoked
+            self.clear(session)
+        return pending.record
@@ -0,0 +1,124 @@
+# Copyright 2020 ZenKey, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from base64 import urlsafe_b64encode
+import hashlib
+import hmac
+import json
+import secrets
+from cryptography.fernet import Fernet, InvalidToken
+
+class FlowStateError(Exception):
+    """
+    the state parameter is missing, invalid, expired, already used or was issued to
+    another browser
+    """
+
+class FlowStateService:
+    """
+    a stateless alternative to the SessionService for the values the ZenKey
+    redirect flow needs between its legs
+
+    Instead of saving the state, nonce, MCCMNC and PKCE code verifier in the session,
+    they are packed into the OAuth "state" parameter itself as an encrypted and
+    authenticated Fernet token with an embedded timestamp. Any worker that knows the
+    secret key can validate and unpack it, so no sticky sessions or shared store are needed.
+
+    Each state is bound to the browser that started the flow: a random value is saved in
+    its session cookie and the state carries a hash of it. A state sent by another browser,
+    like a callback link an attacker sends to a victim, is rejected. The value is removed
+    once the state is used, so each state is only accepted once.
+    """
+
+    # a discovery state is issued before carrier discovery, an auth state before the
+    # authorize redirect. One can't be used in place of the other.
+    discovery_step = 'd'
+    auth_step = 'a'
+
+    binding_cache_key = 'zenkey_flow_binding'
+
+    def __init__(self, secret_key, session, max_age=600):
+        # derive a dedicated Fernet key so the session signing key is never used directly
+        key_material = hashlib.sha256(('zenkey-flow-state:%s' % secret_key).encode('utf-8'))
+        self.fernet = Fernet(urlsafe_b64encode(key_material.digest()))
+        self.session = session
+        self.max_age = max_age
+
+    def create_discovery_state(self):
+        """
+        build the state sent to carrier discovery
+        """
+        return self._pack({'s': self.discovery_step})
+
+    def create_auth_state(self, nonce, mccmnc, code_verifier):
+        """
+        build the state sent to the authorization endpoint, carrying everything the
+        token exchange will need
+        """
+        return self._pack({
+            's': self.auth_step,
+            'n': nonce,
+            'm': mccmnc,
+            'v': code_verifier
+        })
+
+    def read_discovery_state(self, state):
+        """
+        validate the state returned from carrier discovery and use it up
+        """
+        self._unpack(state, self.discovery_step, consume=True)
+
+    def read_auth_state(self, state, consume=True):
+        """
+        validate the state returned from the authorization endpoint and unpack its values.
+        It is used up unless consume is False
+        """
+        payload = self._unpack(state, self.auth_step, consume)
+        return {
+            'nonce': payload.get('n'),
+            'mccmnc': payload.get('m'),
+            'code_verifier': payload.get('v')
+        }
+
+    def _pack(self, payload):
+        # a new flow replaces the binding of any earlier one in this browser
+        binding = secrets.token_urlsafe(32)
+        self.session[self.binding_cache_key] = binding
+        payload['b'] = self._binding_hash(binding)
+        # compact JSON keeps the state parameter as short as possible
+        serialized = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        return self.fernet.encrypt(serialized).decode('ascii')
+
+    def _unpack(self, state, step, consume):
+        if state is None:
+            raise FlowStateError('missing state')
+        try:
+            # decrypt also checks the HMAC and rejects tokens older than max_age
+            payload = json.loads(self.fernet.decrypt(state.encode('ascii'), ttl=self.max_age))
+        except (InvalidToken, UnicodeEncodeError, ValueError):
+            raise FlowStateError('invalid or expired state')
+        if not isinstance(payload, dict) or payload.get('s') != step:
+            raise FlowStateError('state used in the wrong step of the auth flow')
+        binding = self.session.get(self.binding_cache_key)
+        if binding is None or not hmac.compare_digest(str(payload.get('b')),
+                                                      self._binding_hash(binding)):
+            raise FlowStateError('state already used or issued to another browser')
+        if consume:
+            del self.session[self.binding_cache_key]
+        return payload
+
+    @staticmethod
+    def _binding_hash(binding):
+        # 128 bits of the digest are plenty and keep the state short
+        digest = hashlib.sha256(binding.encode('utf-8')).digest()[:16]
+        return urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
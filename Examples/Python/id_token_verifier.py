@@ -0,0 +1,247 @@
+# Copyright 2020 ZenKey, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import threading
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+import jwt
+from jwt.algorithms import RSAAlgorithm
+from jwt.utils import base64url_decode
+import requests
+
+# A dedicated verifier for the id_tokens returned by the carriers' token endpoints.
+# Each issuer's JWKS is downloaded once and kept as parsed public key objects indexed by
+# "kid", so verifying a token is a dictionary lookup plus the signature check. The
+# signature and every claim we care about (iss, aud, exp, iat, nonce, acr and context)
+# are checked in one pass.
+# When a token is signed with a kid we don't know, the carrier has probably rotated its
+# keys: the JWKS is downloaded again, at most once per min_refresh_interval per issuer.
+
+EC_CURVES = {
+    'P-256': ec.SECP256R1,
+    'P-384': ec.SECP384R1,
+    'P-521': ec.SECP521R1,
+}
+
+def rsa_key_from_jwk(jwk):
+    """an RSA public key object from a JWK"""
+    return RSAAlgorithm.from_jwk(json.dumps(jwk))
+
+def ec_key_from_jwk(jwk):
+    """an EC public key object from a JWK (PyJWT 1.7 can't parse these)"""
+    public_numbers = ec.EllipticCurvePublicNumbers(
+        int.from_bytes(base64url_decode(jwk['x'].encode('ascii')), 'big'),
+        int.from_bytes(base64url_decode(jwk['y'].encode('ascii')), 'big'),
+        EC_CURVES[jwk['crv']]())
+    return public_numbers.public_key(default_backend())
+
+# only asymmetric algorithms: a carrier's id_token must never be verified with a shared secret
+KEY_TYPES = {
+    'RSA': (rsa_key_from_jwk, ('RS256', 'RS384', 'RS512', 'PS256', 'PS384', 'PS512')),
+    'EC': (ec_key_from_jwk, ('ES256', 'ES384', 'ES512')),
+}
+
+class InvalidIdToken(Exception):
+    """the id_token failed verification"""
+
+def parse_jwks(jwks):
+    """
+    Parse the signing keys in a JWKS into {kid: (key object, allowed algorithms)}
+    Keys with an unsupported type or meant for encryption are skipped
+    """
+    keys = {}
+    for jwk in jwks.get('keys', []):
+        if jwk.get('use', 'sig') != 'sig' or jwk.get('kty') not in KEY_TYPES:
+            continue
+        key_from_jwk, algorithms = KEY_TYPES[jwk['kty']]
+        if jwk.get('alg'):
+            algorithms = tuple(alg for alg in algorithms if alg == jwk['alg'])
+        try:
+            key = key_from_jwk(jwk)
+        except (ValueError, KeyError, TypeError, AttributeError, jwt.InvalidKeyError):
+            continue
+        keys[jwk.get('kid')] = (key, algorithms)
+    return keys
+
+class IssuerKeys():
+    """the parsed signing keys of one issuer"""
+    __slots__ = ('keys', 'fetched_at', 'lock')
+
+    def __init__(self):
+        self.keys = {}
+        self.fetched_at = None
+        self.lock = threading.Lock()
+
+class IdTokenVerifier():
+    """
+    Verifies id_tokens against each issuer's cached JWKS
+
+    leeway: the allowed clock skew in seconds for the exp and iat claims
+    min_refresh_interval: the minimum time in seconds between two JWKS downloads for an issuer
+    max_key_age: keys are downloaded again after this many seconds, even if every kid is known
+    session: the requests session used to download the keys
+    fetch_jwks: (optional) a callable fetch_jwks(issuer, jwks_uri, timeout) that downloads
+                an issuer's JWKS, instead of a GET request with session
+    """
+    def __init__(self, leeway=60, min_refresh_interval=60, max_key_age=86400, timeout=10,
+                 session=None, fetch_jwks=None):
+        self.leeway = leeway
+        self.min_refresh_interval = min_refresh_interval
+        self.max_key_age = max_key_age
+        self.timeout = timeout
+        self.session = session or requests
+        self.fetch_jwks = fetch_jwks or self._get_jwks
+        self.issuers = {}
+        self.lock = threading.Lock()
+        self.metrics = {'verified': 0, 'rejected': 0, 'jwks_fetches': 0}
+
+    def _issuer_keys(self, issuer):
+        issuer_keys = self.issuers.get(issuer)
+        if issuer_keys is None:
+            with self.lock:
+                issuer_keys = self.issuers.setdefault(issuer, IssuerKeys())
+        return issuer_keys
+
+    def load_jwks(self, issuer, jwks):
+        """
+        Cache an issuer's keys from a JWKS we already have
+        """
+        issuer_keys = self._issuer_keys(issuer)
+        issuer_keys.keys = parse_jwks(jwks)
+        issuer_keys.fetched_at = time.monotonic()
+
+    def _get_jwks(self, issuer, jwks_uri, timeout): # pylint: disable=unused-argument
+        jwks_response = self.session.get(jwks_uri, timeout=timeout)
+        jwks_response.raise_for_status()
+        return jwks_response.json()
+
+    def _keys_current(self, issuer_keys, kid):
+        """True if the keys were downloaded less than max_key_age seconds ago and have kid"""
+        return (issuer_keys.fetched_at is not None and
+                time.monotonic() - issuer_keys.fetched_at <= self.max_key_age and
+                (kid is None or kid in issuer_keys.keys))
+
+    def _refresh(self, issuer, issuer_keys, jwks_uri, kid, timeout):
+        """
+        Download the JWKS again unless another thread just did, or it was downloaded
+        less than min_refresh_interval seconds ago
+        If another thread is still downloading it after timeout seconds, keep the keys we have
+        """
+        timeout = timeout or self.timeout
+        started = time.monotonic()
+        if not issuer_keys.lock.acquire(timeout=timeout):
+            return
+        try:
+            if self._keys_current(issuer_keys, kid):
+                # another thread refreshed the keys while we were waiting
+                return
+            if (issuer_keys.fetched_at is not None and
+                    time.monotonic() - issuer_keys.fetched_at < self.min_refresh_interval):
+                return
+            try:
+                # the time spent waiting for the lock comes out of the timeout
+                jwks = self.fetch_jwks(issuer, jwks_uri, timeout - (time.monotonic() - started))
+            except (requests.RequestException, ValueError) as error:
+                raise InvalidIdToken('unable to fetch the JWKS from %s: %s' % (jwks_uri, error))
+            finally:
+                # a failed download also counts towards the rate limit
+                issuer_keys.fetched_at = time.monotonic()
+                self.metrics['jwks_fetches'] += 1
+            issuer_keys.keys = parse_jwks(jwks)
+        finally:
+            issuer_keys.lock.release()
+
+    def _signing_keys(self, issuer, jwks_uri, kid, timeout):
+        issuer_keys = self._issuer_keys(issuer)
+        if not self._keys_current(issuer_keys, kid):
+            self._refresh(issuer, issuer_keys, jwks_uri, kid, timeout)
+
+        if kid is not None:
+            signing_key = issuer_keys.keys.get(kid)
+            if signing_key is None:
+                raise InvalidIdToken('unknown signing key: %s' % kid)
+            return [signing_key]
+        # without a kid, try each of the issuer's keys
+        return list(issuer_keys.keys.values())
+
+    def verify(self, id_token, issuer, jwks_uri, client_id, nonce=None, acr_values=None,
+               context=None, timeout=None):
+        """
+        Verify an id_token JWT and return its claims
+
+        nonce, acr_values and context are the values sent in the authorization request and
+        are only checked when they're provided. acr_values can be a list or a space
+        separated string. timeout overrides the timeout of a JWKS download.
+        Raises InvalidIdToken if the token isn't valid
+        """
+        try:
+            claims = self._verify(id_token, issuer, jwks_uri, client_id, nonce, acr_values,
+                                  context, timeout)
+        except InvalidIdToken:
+            self.metrics['rejected'] += 1
+            raise
+        self.metrics['verified'] += 1
+        return claims
+
+    def _verify(self, id_token, issuer, jwks_uri, client_id, nonce, acr_values, context,
+                timeout):
+        try:
+            header = jwt.get_unverified_header(id_token)
+        except jwt.InvalidTokenError as error:
+            raise InvalidIdToken('malformed token: %s' % error)
+
+        alg = header.get('alg')
+        claims = None
+        for key, algorithms in self._signing_keys(issuer, jwks_uri, header.get('kid'), timeout):
+            if alg not in algorithms:
+                continue
+            try:
+                claims = jwt.decode(id_token, key,
+                                    algorithms=[alg],
+                                    audience=client_id,
+                                    issuer=issuer,
+                                    leeway=self.leeway,
+                                    options={'require_exp': True, 'require_iat': True})
+                break
+            except jwt.InvalidSignatureError:
+                continue
+            except jwt.InvalidTokenError as error:
+                raise InvalidIdToken(str(error))
+        if claims is None:
+            raise InvalidIdToken('no key matches the token signature')
+
+        if claims['iat'] > time.time() + self.leeway:
+            raise InvalidIdToken('Issued At claim (iat) is in the future')
+        # a token with several audiences must name us as the authorized party
+        audience = claims['aud']
+        if isinstance(audience, list) and len(audience) > 1 and claims.get('azp') != client_id:
+            raise InvalidIdToken('Authorized party (azp) does not match')
+
+        if nonce and claims.get('nonce') != nonce:
+            raise InvalidIdToken('Nonce value in ID token does not match')
+        if isinstance(acr_values, str):
+            acr_values = acr_values.split(' ')
+        if acr_values and 'acr' in claims and claims['acr'] not in acr_values:
+            raise InvalidIdToken('ACR value in ID token does not match')
+        if context and 'context' in claims and claims['context'] != context:
+            raise InvalidIdToken('Context value in ID token does not match')
+        return claims
+
+    def stats(self):
+        """counters for monitoring"""
+        return dict(self.metrics, issuers=len(self.issuers))
+
+id_token_verifier = IdTokenVerifier() # pylint: disable=invalid-name
@@ -0,0 +1,129 @@
+# Copyright 2020 ZenKey, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+from flask.json import JSONDecoder, JSONEncoder
+
+try:
+    import orjson
+except ImportError: # pragma: no cover - orjson is an optional dependency
+    orjson = None # pylint: disable=invalid-name
+
+# A pluggable JSON backend for Flask's JSON handling.
+# When the optional orjson package is installed it is used for encoding and decoding,
+# otherwise (or if orjson can't handle a value) we fall back to the standard library.
+# Flask's JSONEncoder.default() still handles dates, UUIDs and dataclasses so the
+# output stays compatible with the standard Flask encoder.
+
+class StdlibJSONBackend:
+    """the standard library json module"""
+    name = 'stdlib'
+
+    @staticmethod
+    def dumps(obj, default=None, sort_keys=False):
+        """serialize obj to a compact JSON string"""
+        return json.dumps(obj, default=default, sort_keys=sort_keys, separators=(',', ':'))
+
+    @staticmethod
+    def loads(text):
+        """deserialize a JSON string or bytes"""
+        return json.loads(text)
+
+class OrjsonBackend:
+    """the orjson package"""
+    name = 'orjson'
+
+    @staticmethod
+    def dumps(obj, default=None, sort_keys=False):
+        """serialize obj to a compact JSON string"""
+        # let the Flask default() serialize dates and dataclasses like the standard encoder
+        option = (orjson.OPT_NON_STR_KEYS
+                  | orjson.OPT_PASSTHROUGH_DATETIME
+                  | orjson.OPT_PASSTHROUGH_DATACLASS)
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=default, option=option).decode('utf-8')
+
+    @staticmethod
+    def loads(text):
+        """deserialize a JSON string or bytes"""
+        return orjson.loads(text)
+
+JSON_BACKENDS = {
+    StdlibJSONBackend.name: StdlibJSONBackend,
+    OrjsonBackend.name: OrjsonBackend,
+}
+
+def get_json_backend(name='auto'):
+    """
+    Pick a JSON backend by name. "auto" uses the fastest one available
+    """
+    if name == 'auto':
+        return OrjsonBackend if orjson is not None else StdlibJSONBackend
+    if name == OrjsonBackend.name and orjson is None:
+        raise ImportError('the orjson JSON backend requires the orjson package')
+    try:
+        return JSON_BACKENDS[name]
+    except KeyError:
+        raise ValueError('unknown JSON backend: %s' % name)
+
+json_backend = get_json_backend() # pylint: disable=invalid-name
+
+def dumps(obj):
+    """serialize obj to a JSON string with the configured backend"""
+    return json_backend.dumps(obj)
+
+def loads(text):
+    """deserialize JSON with the configured backend"""
+    return json_backend.loads(text)
+
+class FastJSONEncoder(JSONEncoder):
+    """
+    Flask JSON encoder that uses the configured backend for the common case: compact
+    output, optionally with sorted keys. Pretty-printed output and anything the backend
+    can't serialize go through the standard encoder.
+    """
+    def encode(self, o):
+        if self.indent is None and json_backend is not StdlibJSONBackend:
+            try:
+                return json_backend.dumps(o, default=self.default, sort_keys=self.sort_keys)
+            except TypeError:
+                pass
+        return super(FastJSONEncoder, self).encode(o)
+
+class FastJSONDecoder(JSONDecoder):
+    """
+    Flask JSON decoder that uses the configured backend. The backend can't call an
+    object_hook or object_pairs_hook (Flask's session serializer uses one to restore tagged
+    values), so the standard decoder handles those
+    """
+    def decode(self, s, *args, **kwargs): # pylint: disable=arguments-differ
+        if (json_backend is StdlibJSONBackend
+                or self.object_hook is not None or self.object_pairs_hook is not None):
+            return super(FastJSONDecoder, self).decode(s, *args, **kwargs)
+        try:
+            return json_backend.loads(s)
+        except ValueError:
+            # let the standard decoder raise its usual error
+            return super(FastJSONDecoder, self).decode(s, *args, **kwargs)
+
+def init_json_provider(app, name='auto'):
+    """
+    Select the JSON backend and plug it into the Flask app's JSON handling
+    (jsonify, request.get_json, flask.json.dumps/loads and the session serializer)
+    """
+    global json_backend # pylint: disable=invalid-name,global-statement
+    json_backend = get_json_backend(name)
+    app.json_encoder = FastJSONEncoder
+    app.json_decoder = FastJSONDecoder
+    app.logger.info('Using the %s JSON backend', json_backend.name)
@@ -0,0 +1,254 @@
+# Copyright 2020 ZenKey, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import sys
+import threading
+import time
+import traceback
+
+import json_provider
+
+# An optional logging pipeline that keeps log I/O out of the request threads.
+# By default both apps log synchronously at DEBUG: every urllib3 and Pyoidc debug line is
+# written to stderr by the thread that makes the carrier request. In async mode:
+# - records are put on a bounded queue and written by a background thread. When the queue
+#   is full, records are dropped and counted rather than blocking the request
+# - noisy loggers can be sampled and rate limited. Only records below WARNING are dropped
+# - a traceback that was already logged within the dedup window is replaced by a note, and
+#   the next full traceback says how many were omitted
+# - records are written as JSON lines, or as text
+
+SYNC = 'sync'
+ASYNC = 'async'
+
+# the attributes of every LogRecord, which aren't extra fields
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime'}
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+def parse_logger_settings(value, parse=float):
+    """parse "logger=value,other.logger=value" into a dictionary"""
+    settings = {}
+    for setting in (value or '').split(','):
+        if setting.strip():
+            name, _, setting_value = setting.partition('=')
+            settings[name.strip()] = parse(setting_value)
+    return settings
+
+class JSONFormatter(logging.Formatter):
+    """formats records as JSON lines, with their extra fields"""
+    def format(self, record):
+        entry = {
+            'time': '%s.%03dZ' % (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)),
+                                  record.msecs),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+            'source': '%s:%d' % (record.module, record.lineno),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES and name not in entry:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json_provider.json_backend.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    """
+    samples and rate limits the records below WARNING of some loggers and their children
+
+    sample_rates: logger name: the fraction of its records that are kept
+    rate_limits: logger name: the number of records kept per second, with bursts of a second
+    """
+    def __init__(self, sample_rates=None, rate_limits=None):
+        super(SamplingFilter, self).__init__()
+        self.sample_rates = sample_rates or {}
+        self.rate_limits = rate_limits or {}
+        # logger name: the configured logger it falls under, or None
+        self.rules = {}
+        # configured logger: [tokens, updated at]
+        self.buckets = {name: [limit, time.monotonic()]
+                        for name, limit in self.rate_limits.items()}
+        # configured logger: records seen, for sampling without a random number per record
+        self.seen = {}
+        self.lock = threading.Lock()
+        self.metrics = {'sampled_out': 0, 'rate_limited': 0}
+
+    def rule(self, logger_name):
+        """the most specific configured logger that logger_name falls under"""
+        if logger_name not in self.rules:
+            name = logger_name
+            while name and name not in self.sample_rates and name not in self.rate_limits:
+                name = name.rpartition('.')[0]
+            self.rules[logger_name] = name or None
+        return self.rules[logger_name]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rule = self.rule(record.name)
+        if rule is None:
+            return True
+        with self.lock:
+            sample_rate = self.sample_rates.get(rule)
+            if sample_rate is not None:
+                # keep one record in every 1 / sample_rate
+                seen = self.seen.get(rule, 0) + 1
+                self.seen[rule] = seen
+                if sample_rate <= 0 or int(seen * sample_rate) == int((seen - 1) * sample_rate):
+                    self.metrics['sampled_out'] += 1
+                    return False
+            bucket = self.buckets.get(rule)
+            if bucket is not None:
+                now = time.monotonic()
+                limit = self.rate_limits[rule]
+                bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * limit)
+                bucket[1] = now
+                if bucket[0] < 1:
+                    self.metrics['rate_limited'] += 1
+                    return False
+                bucket[0] -= 1
+        return True
+
+class ExceptionDeduplicator(logging.Filter):
+    """
+    omits the traceback of an exception that was already logged from the same place
+    within the last window seconds
+    """
+    max_tracked = 1000
+
+    def __init__(self, window=60):
+        super(ExceptionDeduplicator, self).__init__()
+        self.window = window
+        # (exception type, frames): [window end, omitted count]
+        self.seen = {}
+        self.lock = threading.Lock()
+        self.metrics = {'tracebacks_omitted': 0}
+
+    @staticmethod
+    def key(exc_info):
+        """the exception type and the places it went through"""
+        frames = []
+        trace = exc_info[2]
+        while trace is not None:
+            frames.append((trace.tb_frame.f_code.co_filename, trace.tb_lineno))
+            trace = trace.tb_next
+        return exc_info[0], tuple(frames)
+
+    def filter(self, record):
+        if not record.exc_info or record.exc_info[0] is None:
+            return True
+        key = self.key(record.exc_info)
+        now = time.monotonic()
+        with self.lock:
+            seen = self.seen.get(key)
+            if seen is not None and seen[0] > now:
+                seen[1] += 1
+                self.metrics['tracebacks_omitted'] += 1
+                record.exc_info = None
+                record.exc_text = None
+                record.traceback_omitted = '%s, logged in the last %ds' % (key[0].__name__,
+                                                                           self.window)
+                return True
+            if len(self.seen) >= self.max_tracked:
+                self.seen = {other: value for other, value in self.seen.items()
+                             if value[0] > now}
+            if seen is not None and seen[1]:
+                record.tracebacks_omitted = seen[1]
+            self.seen[key] = [now + self.window, 0]
+        return True
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    a queue handler that drops records when the queue is full, and leaves the formatting
+    of their traceback to the writer thread
+    """
+    def __init__(self, log_queue):
+        super(NonBlockingQueueHandler, self).__init__(log_queue)
+        self.metrics = {'queued': 0, 'dropped': 0}
+
+    def prepare(self, record):
+        # merge the arguments now, since they may change once the call returns
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.metrics['queued'] += 1
+        except queue.Full:
+            self.metrics['dropped'] += 1
+
+class OmittedTracebackFormatter(logging.Formatter):
+    """a text formatter that mentions the omitted tracebacks"""
+    def format(self, record):
+        text = super(OmittedTracebackFormatter, self).format(record)
+        if getattr(record, 'traceback_omitted', None):
+            text += ' [traceback omitted: %s]' % record.traceback_omitted
+        if getattr(record, 'tracebacks_omitted', None):
+            text += ' [%d similar tracebacks omitted]' % record.tracebacks_omitted
+        return text
+
+class LogPipeline():
+    """
+    replaces the root logger's handlers with a queue, written to a stream by a background
+    thread
+
+    level: the root logger level
+    log_format: "json" or "text"
+    sample_rates, rate_limits: see SamplingFilter
+    dedup_window: see ExceptionDeduplicator. 0 keeps every traceback
+    queue_size: the number of records waiting to be written before new ones are dropped
+    """
+    def __init__(self, level=logging.DEBUG, log_format='json', sample_rates=None,
+                 rate_limits=None, dedup_window=60, queue_size=10000, stream=None):
+        self.level = level
+        writer = logging.StreamHandler(stream or sys.stderr)
+        writer.setFormatter(JSONFormatter() if log_format == 'json'
+                            else OmittedTracebackFormatter(TEXT_FORMAT))
+        self.handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+        self.filters = [SamplingFilter(sample_rates, rate_limits)]
+        if dedup_window > 0:
+            self.filters.append(ExceptionDeduplicator(dedup_window))
+        for log_filter in self.filters:
+            self.handler.addFilter(log_filter)
+        self.listener = QueueListener(self.handler.queue, writer)
+
+    def install(self):
+        """start the writer thread and route every record through the queue"""
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+        self.listener.start()
+        # write the records still in the queue when the process exits
+        atexit.register(self.listener.stop)
+
+    def stats(self):
+        """counters for monitoring"""
+        stats = dict(self.handler.metrics, waiting=self.handler.queue.qsize())
+        for log_filter in self.filters:
+            stats.update(log_filter.metrics)
+        return stats
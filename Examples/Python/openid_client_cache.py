@@ -0,0 +1,106 @@
+# Copyright 2020 ZenKey, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+from oic.oic import Client
+from oic.oic.message import (ProviderConfigurationResponse,
+                             RegistrationResponse)
+from oic.utils.authn.client import CLIENT_AUTHN_METHOD
+
+class OpenIDClientCache:
+    """
+    a per-process cache of OpenID clients configured for each carrier, keyed by MCCMNC
+
+    Both legs of the auth flow (the authorize redirect and the token exchange) need a client
+    configured with the carrier's OIDC provider metadata and keys. Caching it means the
+    discovery request and the JWKS download happen once per carrier instead of on every leg.
+
+    The cached clients are shared between requests, so they must be treated as read-only:
+    don't call methods like parse_response() that store per-flow grants on the client.
+
+    Failed discoveries (an unknown or unsupported MCCMNC) are cached too, for failure_ttl
+    seconds, so a client retrying a bad MCCMNC doesn't cost a discovery request every time.
+    """
+
+    def __init__(self, client_id, client_secret, ttl=3600, failure_ttl=60):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        # mccmnc: (expires_at, client), the client is None for a failed discovery
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.metrics = {'hits': 0, 'failure_hits': 0, 'discoveries': 0, 'failures': 0}
+
+    def get_client(self, zenkey_oidc_service, mccmnc):
+        """
+        Get an OpenID client configured for the user's carrier
+        Returns None if the carrier's OIDC configuration can't be discovered
+        """
+        now = time.monotonic()
+        cached = self.clients.get(mccmnc)
+        if cached is not None and cached[0] > now:
+            self.metrics['hits' if cached[1] is not None else 'failure_hits'] += 1
+            return cached[1]
+
+        self.metrics['discoveries'] += 1
+        openid_client = self.build_client(zenkey_oidc_service, mccmnc)
+        if openid_client is not None:
+            with self.lock:
+                self.clients[mccmnc] = (now + self.ttl, openid_client)
+        else:
+            self.metrics['failures'] += 1
+            if self.failure_ttl > 0:
+                with self.lock:
+                    self._drop_expired_failures(now)
+                    self.clients[mccmnc] = (now + self.failure_ttl, None)
+        return openid_client
+
+    def _drop_expired_failures(self, now):
+        """
+        Forget the expired failures, so random MCCMNCs can't grow the cache without bound
+        """
+        expired = [mccmnc for mccmnc, (expires_at, openid_client) in self.clients.items()
+                   if openid_client is None and expires_at <= now]
+        for mccmnc in expired:
+            del self.clients[mccmnc]
+
+    def stats(self):
+        """counters for monitoring"""
+        return dict(self.metrics, entries=len(self.clients))
+
+    def build_client(self, zenkey_oidc_service, mccmnc):
+        """
+        Build an OpenID client configured for the user's carrier
+        """
+        # discover the carrier OIDC endpoint configuration
+        oidc_configuration = zenkey_oidc_service.discover_oidc_provider_metadata(mccmnc)
+        if oidc_configuration is None:
+            return None
+
+        # build our OpenID client
+        openid_client = Client(client_authn_method=CLIENT_AUTHN_METHOD, client_id=self.client_id)
+        # save the client information to the OIDC client
+        client_registration_info = RegistrationResponse(**{
+            "client_id": self.client_id,
+            "client_secret": self.client_secret})
+        openid_client.store_registration_info(client_registration_info)
+        # save the provider config to the OIDC client after we've discovered it
+        provider_configuration = ProviderConfigurationResponse(**oidc_configuration)
+        openid_client.handle_provider_config(
+            provider_configuration,
+            provider_configuration['issuer'],
+            True,
+            True)
+        return openid_client
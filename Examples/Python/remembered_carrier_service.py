@@ -0,0 +1,64 @@
+# Copyright 2020 ZenKey, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+class RememberedCarrierService:
+    """
+    a service for remembering the user's carrier (MCCMNC) in a long-lived signed cookie
+
+    A returning user with this cookie can skip the carrier discovery UI: the app goes
+    straight to OIDC discovery and the authorization redirect for the remembered carrier.
+    """
+
+    cookie_name = 'zenkey_carrier'
+
+    def __init__(self, secret_key, max_age, cookie_domain=None, secure=True):
+        self.serializer = URLSafeTimedSerializer(secret_key, salt='zenkey-remembered-carrier')
+        self.max_age = max_age
+        self.cookie_domain = cookie_domain
+        self.secure = secure
+
+    def get_mccmnc(self, request):
+        """
+        get the remembered MCCMNC from the request cookies, or None if there isn't
+        a valid one
+        """
+        cookie = request.cookies.get(self.cookie_name)
+        if cookie is None:
+            return None
+        try:
+            return self.serializer.loads(cookie, max_age=self.max_age)
+        except BadSignature:
+            # tampered with or expired
+            return None
+
+    def remember(self, response, mccmnc):
+        """
+        save the MCCMNC in a signed cookie on the response
+        """
+        response.set_cookie(self.cookie_name,
+                            self.serializer.dumps(mccmnc),
+                            max_age=self.max_age,
+                            domain=self.cookie_domain,
+                            secure=self.secure,
+                            httponly=True,
+                            samesite='Lax')
+        return response
+
+    def forget(self, response):
+        """
+        delete the remembered MCCMNC cookie
+        """
+        response.delete_cookie(self.cookie_name, domain=self.cookie_domain)
+        return response
@@ -19,7 +19,7 @@ class SessionService:
     state_cache_key = "zenkey_state"
     nonce_cache_key = "zenkey_nonce"
     mccmnc_cache_key = "zenkey_mccmnc"
-    code_verifier_cache_key = "zenkey_mccmnc"
+    code_verifier_cache_key = "zenkey_code_verifier"
 
     def __init__(self, session):
         self.session = session
@@ -11,8 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import json
 from json import JSONDecodeError
+from flask import g
+import json_provider
 
 def normalize_port(port):
     """Normalize a port into a number or false."""
@@ -24,10 +25,21 @@ def normalize_port(port):
         return False
 
 def get_current_user(flask_session):
-    """get the current user info from the session"""
+    """get the current user info from the session, decoded at most once per request"""
+    if 'current_user' not in g:
+        g.current_user = load_current_user(flask_session)
+    return g.current_user
+
+def load_current_user(flask_session):
+    """decode the current user info saved in the session"""
     if 'userinfo' in flask_session:
         try:
-            return json.loads(flask_session['userinfo'])
+            return json_provider.loads(flask_session['userinfo'])
         except JSONDecodeError:
             return None
     return None
+
+def set_current_user(flask_session, userinfo):
+    """save the current user info in the session"""
+    flask_session['userinfo'] = json_provider.dumps(userinfo)
+    g.current_user = userinfo
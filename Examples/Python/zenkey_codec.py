@@ -0,0 +1,201 @@
+# Copyright 2020 ZenKey, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+from oic.exception import PyoidcError
+from oic.oauth2.message import Message, MissingRequiredAttribute
+from oic.oic.message import TokenErrorResponse, UserInfoErrorResponse
+
+# These classes are a fast path for the two ZenKey responses we parse on every sign-in.
+# Instead of going through the generic Pyoidc Message machinery (which re-serializes
+# every nested claim to JSON just to deserialize it again), the JSON body is parsed once
+# and copied into compact __slots__ objects while the required fields are checked.
+# The objects support the same dict-style access as Pyoidc messages: record['sub'],
+# record.get('name'), 'email' in record and record.to_dict()
+
+class SlotsRecord:
+    """
+    Base class for the compact response records.
+    Attributes that were absent from the response are stored as None and behave
+    like missing keys. Unknown keys are kept in `extra` so to_dict() doesn't lose them.
+    """
+    __slots__ = ('extra',)
+    fields = ()
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self.extra[key]
+
+    def __contains__(self, key):
+        if key in self.fields:
+            return getattr(self, key) is not None
+        return key in self.extra
+
+    def get(self, key, default=None):
+        """get a value like dict.get()"""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        """convert the record (and any nested records) to a plain dictionary"""
+        result = {}
+        for field in self.fields:
+            value = getattr(self, field)
+            if value is not None:
+                result[field] = value.to_dict() if hasattr(value, 'to_dict') else value
+        result.update(self.extra)
+        return result
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.to_dict())
+
+class ValueClaim(SlotsRecord):
+    """a nested userinfo claim like {"value": "..."}"""
+    __slots__ = ('value',)
+    fields = __slots__
+
+class NameClaim(SlotsRecord):
+    """the nested userinfo name claim"""
+    __slots__ = ('value', 'given_name', 'family_name')
+    fields = __slots__
+
+class ZenKeyUserInfo(SlotsRecord):
+    """the data returned from the Userinfo endpoint"""
+    __slots__ = ('sub', 'name', 'email', 'phone', 'postal_code')
+    fields = __slots__
+
+class ZenKeyTokens(SlotsRecord):
+    """the data returned from the token endpoint"""
+    __slots__ = ('access_token', 'token_type', 'expires_in', 'refresh_token', 'scope', 'id_token')
+    fields = __slots__
+
+def decode_claim(claim_class, raw_claim):
+    """
+    Copy a nested claim into a record
+
+    Different mobile carriers return different formats, so we don't validate the
+    claim values. A plain string is treated as the claim's value.
+    """
+    if raw_claim is None:
+        return None
+    if not isinstance(raw_claim, dict):
+        raw_claim = {'value': raw_claim}
+    claim = claim_class()
+    for field in claim_class.fields:
+        setattr(claim, field, raw_claim.get(field))
+    claim.extra = {key: value for key, value in raw_claim.items()
+                   if key not in claim_class.fields}
+    return claim
+
+def userinfo_from_dict(raw_userinfo):
+    """
+    Build a ZenKeyUserInfo record from an already parsed userinfo dictionary
+    """
+    sub = raw_userinfo.get('sub')
+    if not isinstance(sub, str):
+        raise MissingRequiredAttribute('sub')
+
+    userinfo = ZenKeyUserInfo()
+    userinfo.sub = sub
+    userinfo.name = decode_claim(NameClaim, raw_userinfo.get('name'))
+    userinfo.email = decode_claim(ValueClaim, raw_userinfo.get('email'))
+    userinfo.phone = decode_claim(ValueClaim, raw_userinfo.get('phone'))
+    userinfo.postal_code = decode_claim(ValueClaim, raw_userinfo.get('postal_code'))
+    userinfo.extra = {key: value for key, value in raw_userinfo.items()
+                      if key not in ZenKeyUserInfo.fields}
+    return userinfo
+
+def decode_userinfo(text):
+    """
+    Parse a JSON Userinfo response body
+
+    Returns a ZenKeyUserInfo, or a UserInfoErrorResponse if the carrier returned an error
+    """
+    raw_userinfo = json.loads(text)
+    if 'error' in raw_userinfo:
+        return UserInfoErrorResponse(**raw_userinfo)
+    return userinfo_from_dict(raw_userinfo)
+
+def decode_token_response(text, id_token_required=True):
+    """
+    Parse a JSON token endpoint response body
+
+    Returns a ZenKeyTokens record holding the raw id_token JWT, or a TokenErrorResponse
+    if the carrier returned an error. The id_token must still be verified by the caller.
+    The response to a refresh token grant doesn't have to include an id_token
+    (id_token_required=False)
+    """
+    raw_tokens = json.loads(text)
+    if 'error' in raw_tokens:
+        return TokenErrorResponse(**raw_tokens)
+
+    tokens = ZenKeyTokens()
+    for field in ('access_token', 'token_type', 'id_token'):
+        value = raw_tokens.get(field)
+        if value is None and field == 'id_token' and not id_token_required:
+            tokens.id_token = None
+            continue
+        if not isinstance(value, str):
+            raise MissingRequiredAttribute(field)
+        setattr(tokens, field, value)
+    tokens.expires_in = raw_tokens.get('expires_in')
+    tokens.refresh_token = raw_tokens.get('refresh_token')
+    tokens.scope = raw_tokens.get('scope')
+    tokens.extra = {key: value for key, value in raw_tokens.items()
+                    if key not in ZenKeyTokens.fields}
+    return tokens
+
+def parse_token_response(token_response, id_token_required=True):
+    """
+    Decode an HTTP response from the token endpoint
+
+    The id_token is left as a JWT: verify it with the IdTokenVerifier
+    """
+    if token_response.status_code not in (200, 400, 401):
+        raise PyoidcError("HTTP ERROR: %s [%s] on %s" % (token_response.text,
+                                                          token_response.status_code,
+                                                          token_response.url))
+
+    return decode_token_response(token_response.text, id_token_required)
+
+def parse_userinfo_response(openid_client, userinfo_response):
+    """
+    Decode an HTTP response from the Userinfo endpoint
+
+    Signed (application/jwt) responses are verified by pyoidc before being decoded
+    """
+    if 400 <= userinfo_response.status_code < 500:
+        # the response text might be an OIDC error message
+        try:
+            return UserInfoErrorResponse().from_json(userinfo_response.text)
+        except ValueError:
+            raise PyoidcError(userinfo_response.text)
+    if userinfo_response.status_code != 200:
+        raise PyoidcError("ERROR: Something went wrong [%s]: %s" % (userinfo_response.status_code,
+                                                                   userinfo_response.text))
+
+    content_type = userinfo_response.headers.get('content-type', '')
+    if 'application/json' in content_type:
+        return decode_userinfo(userinfo_response.text)
+    if 'application/jwt' in content_type:
+        signed_userinfo = Message().from_jwt(userinfo_response.text,
+                                             keyjar=openid_client.keyjar,
+                                             sender=openid_client.provider_info['issuer'])
+        return userinfo_from_dict(signed_userinfo.to_dict())
+    raise PyoidcError("ERROR: Unexpected content-type: %s" % content_type)
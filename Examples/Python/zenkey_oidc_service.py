@@ -13,91 +13,18 @@
 # limitations under the License.
 from base64 import b64encode
 import os
-import json
-import urllib.parse
 from oic import rndstr
-from oic.oauth2.message import Message
-from oic.oauth2.message import ParamDefinition
-from oic.oauth2.message import (SINGLE_OPTIONAL_STRING, SINGLE_REQUIRED_STRING)
-from oic.oic.message import (AuthorizationResponse, AccessTokenResponse)
-from oic.exception import (MessageException, PyoidcError)
+from oic.oic.message import AuthorizationResponse
 import requests
+from authorization_url_builder import build_authorization_url, build_carrier_discovery_url
+from flow_state_service import FlowStateError
+from id_token_verifier import InvalidIdToken, id_token_verifier as default_id_token_verifier
+from request_profiler import phase
+from zenkey_codec import ZenKeyTokens, parse_token_response, parse_userinfo_response
 
 OIDC_PROVIDER_CONFIG_ENDPOINT = os.getenv('OIDC_PROVIDER_CONFIG_URL')
 CARRIER_DISCOVERY_ENDPOINT = os.getenv('CARRIER_DISCOVERY_URL')
 
-def msg_ser(inst, sformat, lev=0):
-    if sformat in ["urlencoded", "json"]:
-        if isinstance(inst, Message):
-            res = inst.serialize(sformat, lev)
-        else:
-            res = inst
-    elif sformat == "dict":
-        if isinstance(inst, Message):
-            res = inst.serialize(sformat, lev)
-        elif isinstance(inst, dict):
-            res = inst
-        elif isinstance(inst, str):  # Iff ID Token
-            res = inst
-        else:
-            raise MessageException("Wrong type: %s" % type(inst))
-    else:
-        raise PyoidcError("Unknown sformat", inst)
-
-    return res
-
-def name_deser(val, sformat="urlencoded"):
-    if sformat in ["dict", "json"]:
-        if not isinstance(val, str):
-            val = json.dumps(val)
-            sformat = "json"
-        elif sformat == "dict":
-            sformat = "json"
-    return NameClaim().deserialize(val, sformat)
-
-class NameClaim(Message):
-    c_param = {
-        "value": SINGLE_OPTIONAL_STRING,
-        "given_name": SINGLE_OPTIONAL_STRING,
-        "family_name": SINGLE_OPTIONAL_STRING
-    }
-
-def value_deser(val, sformat="urlencoded"):
-    if sformat in ["dict", "json"]:
-        if not isinstance(val, str):
-            val = json.dumps(val)
-            sformat = "json"
-        elif sformat == "dict":
-            sformat = "json"
-    return ValueClaim().deserialize(val, sformat)
-
-class ValueClaim(Message):
-    c_param = {
-        "value": SINGLE_OPTIONAL_STRING
-    }
-
-# Here we define our parameters for the ZenKey schema by providing a serializer
-# and deserializer that tells Pyoidc how to read Userinfo JSON.
-# See the Pyoidc implementation for examples of single nested parameters
-# and ParamDefinition method signature:
-# https://github.com/OpenIDC/pyoidc/blob/master/src/oic/oic/message.py
-OPTIONAL_NAME = ParamDefinition(Message, False, msg_ser, name_deser, False)
-OPTIONAL_NESTED_VALUE = ParamDefinition(Message, False, msg_ser, value_deser, False)
-
-class ZenKeySchema(Message):
-    """
-    This is the schema of the data returned from the Userinfo endpoint.
-    The default Pyoidc OpenIDSchema does not support double nested parameters,
-    so we have to define our own using ParamDefinition above. 
-    """
-    c_param = {
-        "sub": SINGLE_REQUIRED_STRING,
-        "name": OPTIONAL_NAME,
-        "email": OPTIONAL_NESTED_VALUE,
-        "phone": OPTIONAL_NESTED_VALUE,
-        "postal_code": OPTIONAL_NESTED_VALUE
-    }
-
 class ZenKeyOIDCService:
     """
     This class deals with the ZenKey OAuth2/OpenID Connect flow
@@ -122,11 +49,20 @@ class ZenKeyOIDCService:
         to the Userinfo endpoint.
     """
 
-    def __init__(self, client_id, client_secret, redirect_uri, session_service):
+    def __init__(self, client_id, client_secret, redirect_uri, session_service,
+                 flow_state_service=None, id_token_verifier=None, http_session=None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
         self.session_service = session_service
+        # when a FlowStateService is provided, the in-flight auth values travel in the
+        # state parameter instead of the session
+        self.flow_state_service = flow_state_service
+        # verifies the id_token signature and claims with the carrier's cached keys
+        self.id_token_verifier = id_token_verifier or default_id_token_verifier
+        # the requests session for the discovery, token and userinfo requests, which can
+        # record them to a cassette or replay them from one
+        self.http_session = http_session or requests
 
     def carrier_discovery_redirect(self):
         """
@@ -135,15 +71,26 @@ class ZenKeyOIDCService:
         This endpoint will redirect the user back to our app, giving us
         the mccmnc that identifies the user's carrier.
         """
+        new_state = self.create_discovery_state()
+
+        return build_carrier_discovery_url(CARRIER_DISCOVERY_ENDPOINT,
+                                           self.client_id,
+                                           self.redirect_uri,
+                                           new_state)
+
+    def create_discovery_state(self):
+        """
+        Create the state value that get_auth_code_request_url() expects back from
+        carrier discovery
+        """
+        if self.flow_state_service is not None:
+            # stateless mode: the state is a self-contained, expiring token
+            return self.flow_state_service.create_discovery_state()
+
         # save a random state value to prevent request forgeries
         new_state = rndstr()
         self.session_service.set_state(new_state)
-
-        return '%s?client_id=%s&redirect_uri=%s&state=%s' % (
-            CARRIER_DISCOVERY_ENDPOINT,
-            urllib.parse.quote(self.client_id, safe=''),
-            urllib.parse.quote(self.redirect_uri, safe=''),
-            urllib.parse.quote(new_state, safe=''))
+        return new_state
 
     def discover_oidc_provider_metadata(self, mccmnc):
         """
@@ -153,12 +100,32 @@ class ZenKeyOIDCService:
         config_url = '%s?client_id=%s&mccmnc=%s' % (OIDC_PROVIDER_CONFIG_ENDPOINT,
                                                     self.client_id,
                                                     mccmnc)
-        config_response = requests.get(config_url)
-        config_json = config_response.json()
-        if (config_json == {} or config_json['issuer'] is None):
+        with phase('discovery'):
+            config_response = self.http_session.get(config_url, timeout=20)
+        try:
+            config_json = config_response.json()
+        except ValueError:
+            return None
+        if not isinstance(config_json, dict) or config_json.get('issuer') is None:
             return None
         return config_json
 
+    def get_cached_mccmnc(self, state):
+        """
+        Get the MCCMNC saved earlier in the auth flow: from the session, or from
+        the state parameter itself when using stateless flow state
+        """
+        if self.flow_state_service is None:
+            return self.session_service.get_mccmnc()
+        if state is None:
+            return None
+        try:
+            # the token exchange uses the state up, not this lookup
+            return self.flow_state_service.read_auth_state(state, consume=False)['mccmnc']
+        except FlowStateError:
+            # a discovery, expired or foreign state: start the carrier discovery again
+            return None
+
     def get_auth_code_request_url(self, openid_client, login_hint_token, state, mccmnc, **kwargs):
         """
         Get the user an auth code
@@ -174,19 +141,27 @@ class ZenKeyOIDCService:
         :key acr_values: request a3 ACR value for strong authentication assertion
         """
         # prevent request forgeries by checking that the incoming state matches
-        if state != self.session_service.get_state():
+        if self.flow_state_service is not None:
+            self.flow_state_service.read_discovery_state(state)
+        elif state != self.session_service.get_state():
             raise Exception('state mismatch after carrier discovery')
 
         # generate code verifier and code challenge for PKCE
         # and a state and nonce value for the auth redirect
-        # persist the mccmnc and these generated values in the session
         pkce_args, code_verifier = openid_client.add_code_challenge()
-        auth_request_state = rndstr()
         auth_request_nonce = rndstr()
-        self.session_service.set_state(auth_request_state)
-        self.session_service.set_nonce(auth_request_nonce)
-        self.session_service.set_mccmnc(mccmnc)
-        self.session_service.set_code_verifier(code_verifier)
+        if self.flow_state_service is not None:
+            # pack the mccmnc and these generated values into the state itself
+            auth_request_state = self.flow_state_service.create_auth_state(auth_request_nonce,
+                                                                           mccmnc,
+                                                                           code_verifier)
+        else:
+            # persist the mccmnc and these generated values in the session
+            auth_request_state = rndstr()
+            self.session_service.set_state(auth_request_state)
+            self.session_service.set_nonce(auth_request_nonce)
+            self.session_service.set_mccmnc(mccmnc)
+            self.session_service.set_code_verifier(code_verifier)
 
         # default to just the basic openid scope
         scope = kwargs.get('scope', 'openid')
@@ -194,46 +169,48 @@ class ZenKeyOIDCService:
         acr_values = kwargs.get('acr_values')
 
         # send user to the ZenKey authorization endpoint to request an auth code
-        request_args = {
-            "client_id": self.client_id,
-            "response_type": "code",
-            "scope": scope,
-            "redirect_uri": self.redirect_uri,
-            "state": auth_request_state,
-            "nonce": auth_request_nonce,
-            "login_hint_token": login_hint_token,
-            "code_challenge": pkce_args['code_challenge'],
-            "code_challenge_method": pkce_args['code_challenge_method']
-        }
-        if context is not None:
-            request_args['context'] = context
-        if acr_values is not None:
-            request_args['acr_values'] = acr_values
-        auth_request = openid_client.construct_AuthorizationRequest(request_args=request_args)
-        return auth_request.request(openid_client.authorization_endpoint)
+        # the URL is the same one Pyoidc's construct_AuthorizationRequest() would build, but
+        # the static part of it is only encoded once per carrier
+        return build_authorization_url(openid_client.authorization_endpoint,
+                                       self.client_id,
+                                       self.redirect_uri,
+                                       scope,
+                                       state=auth_request_state,
+                                       nonce=auth_request_nonce,
+                                       login_hint_token=login_hint_token,
+                                       code_challenge=pkce_args['code_challenge'],
+                                       code_challenge_method=pkce_args['code_challenge_method'],
+                                       context=context,
+                                       acr_values=acr_values)
 
     def request_token(self, openid_client, query_string):
         """
         We have an auth code, we can now exchange it for a token
 	    First parse the request information to make sure we got a code successfully
         """
-        auth_response = openid_client.parse_response(AuthorizationResponse,
-                                                     info=query_string,
-                                                     sformat="urlencoded")
+        # parse the response directly rather than with openid_client.parse_response(), which
+        # would store a grant on the client: the client is shared between requests
+        auth_response = AuthorizationResponse().deserialize(query_string, "urlencoded")
+        auth_response.verify()
 
         # prevent request forgeries by checking that the incoming state matches
-        if auth_response["state"] != self.session_service.get_state():
-            raise Exception('state mismatch after receiving auth code')
+        if self.flow_state_service is not None:
+            flow_state = self.flow_state_service.read_auth_state(auth_response["state"])
+            code_verifier = flow_state['code_verifier']
+            expected_nonce = flow_state['nonce']
+        else:
+            if auth_response["state"] != self.session_service.get_state():
+                raise Exception('state mismatch after receiving auth code')
+            code_verifier = self.session_service.get_code_verifier()
+            expected_nonce = self.session_service.get_nonce()
+        # the id_token must echo the nonce of this auth request, so a token issued for
+        # another request can't be replayed: never skip the check
+        if not expected_nonce:
+            raise Exception('no nonce for the auth request after receiving auth code')
 
         auth_code = auth_response["code"]
-        code_verifier = self.session_service.get_code_verifier()
 
-        # use an Authorization header to send the basic auth's client ID and secret
-        client_id_secret = "%s:%s" % (self.client_id, self.client_secret)
-        auth_secret = b64encode(client_id_secret.encode('utf-8'))
-        token_request_headers = {
-            'Authorization': 'Basic %s' % auth_secret.decode("ascii"),
-        }
+        token_request_headers = self._token_request_headers()
 
         # Pyoidc's do_access_token_request automatically includes a client_id param
         # which Verizon doesn't like. We need to make a manual POST request instead
@@ -255,35 +232,88 @@ class ZenKeyOIDCService:
             'code_verifier': code_verifier,
             # Don't include client_id param: Verizon doesn't like it
         }
-        token_response = requests.post(openid_client.token_endpoint,
-                                       data=token_request_payload,
-                                       headers=token_request_headers,
-                                       timeout=20)
+        with phase('token'):
+            token_response = self.http_session.post(openid_client.token_endpoint,
+                                                    data=token_request_payload,
+                                                    headers=token_request_headers,
+                                                    timeout=20)
 
-        # pyoidc handles id_token token verification under the hood
-        tokens = openid_client.parse_request_response(token_response, AccessTokenResponse,
-                                                      body_type="json")
+        tokens = parse_token_response(token_response)
 
-        if not isinstance(token_response, AccessTokenResponse):
+        if not isinstance(tokens, ZenKeyTokens):
             # clear the state and nonce
-            self.session_service.clear()
+            self._clear_session_state()
             # return the error response object for handling
             return tokens
 
-        # validate that the nonce matches the one we sent in the auth request
-        if tokens['id_token']['nonce'] != self.session_service.get_nonce():
-            raise Exception("The id_token nonce does not match.")
+        # verify the id_token signature and claims, including that the nonce matches
+        # the one we sent in the auth request, and replace the JWT with its claims
+        with phase('id_token'):
+            tokens.id_token = self.id_token_verifier.verify(
+                tokens.id_token,
+                issuer=openid_client.provider_info['issuer'],
+                jwks_uri=openid_client.provider_info['jwks_uri'],
+                client_id=self.client_id,
+                nonce=expected_nonce)
 
         # clear the state and nonce
-        self.session_service.clear()
+        self._clear_session_state()
+
+        return tokens
+
+    def refresh_tokens(self, openid_client, refresh_token, sub):
+        """
+        Exchange a refresh token for new tokens, server-to-server: no redirect is needed
+        The id_token, if the carrier sends one, is verified and must be for the same user
+        (sub). Returns the tokens, or the error response object for handling
+        """
+        token_request_payload = {
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+        }
+        with phase('token'):
+            token_response = self.http_session.post(openid_client.token_endpoint,
+                                                    data=token_request_payload,
+                                                    headers=self._token_request_headers(),
+                                                    timeout=20)
+
+        # the response to a refresh doesn't have to include an id_token
+        tokens = parse_token_response(token_response, id_token_required=False)
+
+        if isinstance(tokens, ZenKeyTokens) and tokens.id_token is not None:
+            # there was no auth request, so there is no nonce to check
+            with phase('id_token'):
+                tokens.id_token = self.id_token_verifier.verify(
+                    tokens.id_token,
+                    issuer=openid_client.provider_info['issuer'],
+                    jwks_uri=openid_client.provider_info['jwks_uri'],
+                    client_id=self.client_id)
+            if tokens.id_token.get('sub') != sub:
+                raise InvalidIdToken('the refreshed id_token is for another user')
 
         return tokens
 
+    def _token_request_headers(self):
+        # use an Authorization header to send the basic auth's client ID and secret
+        client_id_secret = "%s:%s" % (self.client_id, self.client_secret)
+        auth_secret = b64encode(client_id_secret.encode('utf-8'))
+        return {
+            'Authorization': 'Basic %s' % auth_secret.decode("ascii"),
+        }
+
+    def _clear_session_state(self):
+        # there is nothing to clear when the flow state lives in the state parameter
+        if self.flow_state_service is None:
+            self.session_service.clear()
+
     def get_userinfo(self, openid_client, access_token):
         """
         Make an API call to the carrier to get user info, using the token we received
         """
-        return openid_client.do_user_info_request(token=access_token,
-                                                  behavior="use_authorization_header",
-                                                  user_info_schema=ZenKeySchema,
-                                                  method="GET")
+        # some carriers don't support POST requests to this endpoint, so always use GET
+        with phase('userinfo'):
+            userinfo_response = self.http_session.get(
+                openid_client.userinfo_endpoint,
+                headers={'Authorization': 'Bearer %s' % access_token},
+                timeout=20)
+        return parse_userinfo_response(openid_client, userinfo_response)